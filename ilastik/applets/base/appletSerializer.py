@@ -341,7 +341,18 @@ class SerialListSlot(SerialSlot):
         self.dirty = False
 
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """A slot which only saves nonzero blocks.
+
+    Dirty regions of the slot are tracked per lane, so that saving
+    a project that was already saved before only rewrites the blocks
+    that changed since then (and removes blocks that became empty).
+    """
+    #: Compression options used for the saved blocks
+    COMPRESSION = { 'compression' : 'gzip', 'compression_opts' : 1 }
+
+    #: Whether serialize() may update an existing group instead of rewriting it
+    supportsIncrementalSave = True
+
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
                  default=None, depends=None, selfdepends=True, shrink_to_bb=False):
         """
@@ -351,6 +362,7 @@ class SerialBlockSlot(SerialSlot):
 
         """
         assert isinstance(slot, OutputSlot), "slot is of wrong type: '{}' is not an OutputSlot".format( slot.name )
+        self._resetDirtyBlocks()
         super(SerialBlockSlot, self).__init__(
             slot, inslot, name, subname, default, depends, selfdepends
         )
@@ -358,6 +370,40 @@ class SerialBlockSlot(SerialSlot):
         self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
 
+        # See deserialize()
+        self.deferLoading = False
+        self._deferredGroup = None
+
+    def setDirty(self, *args, **kwargs):
+        """Record the dirty region, if the notification provides one.
+
+        Dirty notifications provide (subslot, roi).  Anything else
+        (value changes, removed lanes) invalidates the whole slot.
+        """
+        if self.ignoreDirty:
+            return
+        super(SerialBlockSlot, self).setDirty(*args, **kwargs)
+        if len(args) == 2 and hasattr(args[1], 'start') and len(getattr(args[0], 'subindex', ())) == 1:
+            subslot, roi = args
+            dirtyRoi = ( numpy.array(roi.start), numpy.array(roi.stop) )
+            self._dirtyRois.setdefault( subslot.subindex[0], [] ).append( dirtyRoi )
+        else:
+            self._allBlocksDirty = True
+
+    def _resetDirtyBlocks(self):
+        self._dirtyRois = {}
+        self._allBlocksDirty = False
+
+    def _isBlockDirty(self, index, slicing):
+        dirtyRois = self._dirtyRois.get(index)
+        if not dirtyRois:
+            return False
+        start, stop = sliceToRoi( slicing, (0,)*len(slicing) )
+        for dirtyStart, dirtyStop in dirtyRois:
+            if ( numpy.less(dirtyStart, stop) & numpy.less(start, dirtyStop) ).all():
+                return True
+        return False
+
     def shouldSerialize(self, group):
         # Should this be a docstring?
         #
@@ -368,6 +414,10 @@ class SerialBlockSlot(SerialSlot):
 
         logger.debug("Checking whether to serialize BlockSlot: {}".format( self.name ))
 
+        if self.hasDeferredData:
+            # The stored data hasn't even been loaded, so it can't have changed.
+            return self.dirty
+
         if self.dirty:
             logger.debug("BlockSlot \"" + self.name + "\" appears to be dirty. Should serialize.")
             return True
@@ -396,20 +446,35 @@ class SerialBlockSlot(SerialSlot):
 
             subgroup = mygroup[subname]
 
+            # Blocks are not necessarily named in order (see _serializeIncrementally),
+            # so we just check that there is one entry per block.
             nonZeroBlocks = self.blockslot[index].value
-            for blockIndex in xrange(len(nonZeroBlocks)):
-                blockName = 'block{:04d}'.format(blockIndex)
-
-                if blockName not in subgroup:
-                    logger.debug("Missing \"" + blockName + "\" from \"" + repr(subgroup) + "\". Should serialize.")
-                    return True
-                else:
-                    logger.debug("Found \"" + blockName + "\" from \"" + repr(subgroup) + "\" belonging to BlockSlot \"" + self.name + "\".")
+            if len(subgroup) != len(nonZeroBlocks):
+                logger.debug("Found {} blocks in \"{}\", expected {}. Should serialize.".format( len(subgroup), repr(subgroup), len(nonZeroBlocks) ))
+                return True
 
         logger.debug("Everything belonging to BlockSlot \"" + self.name + "\" appears to be in order. Should not serialize.")
 
         return False
 
+    def serialize(self, group):
+        """Like SerialSlot.serialize(), but if this slot was saved to
+        the group before, only the blocks that changed are rewritten.
+
+        """
+        if not self.shouldSerialize(group):
+            return
+        self.loadDeferred()
+        if self.supportsIncrementalSave and not self._allBlocksDirty \
+           and self.name in group and self.slot.ready():
+            self._serializeIncrementally(group[self.name])
+        else:
+            deleteIfPresent(group, self.name)
+            if self.slot.ready():
+                self._serialize(group, self.name, self.slot)
+        self._resetDirtyBlocks()
+        self.dirty = False
+
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
         logger.debug("Serializing BlockSlot: {}".format( self.name ))
@@ -422,43 +487,140 @@ class SerialBlockSlot(SerialSlot):
             for blockIndex, slicing in enumerate(nonZeroBlocks):
                 if not isinstance(slicing[0], slice):
                     slicing = roiToSlice(*slicing)
-
-                block = self.slot[index][slicing].wait()
                 blockName = 'block{:04d}'.format(blockIndex)
+                self._writeBlock(mygroup, subgroup, blockName, index, slicing)
 
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
-                        block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                # If we have a masked array, convert it to a structured array so that h5py can handle it.
-                if slot[index].meta.has_mask:
-                    mygroup.attrs["meta.has_mask"] = True
+    @timeLogged(logger, logging.DEBUG)
+    def _serializeIncrementally(self, mygroup):
+        """Update an existing group in place: write new and dirty
+        blocks, delete blocks that are no longer nonzero, and leave
+        everything else untouched.
 
-                    block_group = subgroup.create_group(blockName)
+        """
+        logger.debug("Incrementally serializing BlockSlot: {}".format( self.name ))
+        num = len(self.blockslot)
 
-                    block_group.create_dataset("data", data=block.data)
-                    block_group.create_dataset(
-                        "mask",
-                        data=block.mask,
-                        compression="gzip",
-                        compression_opts=2
-                    )
-                    block_group.create_dataset("fill_value", data=block.fill_value)
+        # Remove the groups of lanes that no longer exist
+        for subname in mygroup.keys():
+            if subname not in [ self.subname.format(index) for index in range(num) ]:
+                del mygroup[subname]
 
-                    block_group.attrs['blockSlice'] = slicingToString(slicing)
+        written = 0
+        for index in range(num):
+            subgroup = getOrCreateGroup(mygroup, self.subname.format(index))
+
+            # Map the source block of each stored dataset to its name.
+            storedBlocks = {}
+            for blockName, blockData in subgroup.items():
+                sourceBlock = blockData.attrs.get( 'sourceBlock', blockData.attrs['blockSlice'] )
+                storedBlocks[sourceBlock] = blockName
+
+            nonZeroBlocks = self.blockslot[index].value
+            currentBlocks = set()
+            nextIndex = 0
+            for slicing in nonZeroBlocks:
+                if not isinstance(slicing[0], slice):
+                    slicing = roiToSlice(*slicing)
+                sourceBlock = slicingToString(slicing)
+                currentBlocks.add(sourceBlock)
+
+                if sourceBlock in storedBlocks:
+                    if not self._isBlockDirty(index, slicing):
+                        continue
+                    del subgroup[storedBlocks[sourceBlock]]
+                    blockName = storedBlocks[sourceBlock]
                 else:
-                    subgroup.create_dataset(blockName, data=block)
-                    subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+                    while 'block{:04d}'.format(nextIndex) in subgroup:
+                        nextIndex += 1
+                    blockName = 'block{:04d}'.format(nextIndex)
+
+                self._writeBlock(mygroup, subgroup, blockName, index, slicing)
+                written += 1
+
+            # Blocks that have become empty
+            for sourceBlock, blockName in storedBlocks.items():
+                if sourceBlock not in currentBlocks:
+                    del subgroup[blockName]
+
+        logger.debug("BlockSlot \"{}\": rewrote {} blocks.".format( self.name, written ))
+
+    def _writeBlock(self, mygroup, subgroup, blockName, index, slicing):
+        """Read the given block of slot[index] and store it as subgroup[blockName]."""
+        sourceBlock = slicingToString(slicing)
+        block = self.slot[index][slicing].wait()
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
+                block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
+                block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
+                block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+                
+                # Overwrite the vars that are written to the file
+                slicing = roiToSlice(*bounding_box_roi)
+                block = block[block_slicing]
+
+        # If we have a masked array, convert it to a structured array so that h5py can handle it.
+        if self.slot[index].meta.has_mask:
+            mygroup.attrs["meta.has_mask"] = True
+
+            block_group = subgroup.create_group(blockName)
+
+            block_group.create_dataset("data", data=block.data, chunks=True, **self.COMPRESSION)
+            block_group.create_dataset(
+                "mask",
+                data=block.mask,
+                compression="gzip",
+                compression_opts=2
+            )
+            block_group.create_dataset("fill_value", data=block.fill_value)
+
+            block_group.attrs['blockSlice'] = slicingToString(slicing)
+            block_group.attrs['sourceBlock'] = sourceBlock
+        else:
+            subgroup.create_dataset(blockName, data=block, chunks=True, **self.COMPRESSION)
+            subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+            subgroup[blockName].attrs['sourceBlock'] = sourceBlock
+
+    def deserialize(self, group):
+        """If deferLoading is set, only remember where the data is
+        stored.  It is read when loadDeferred() is called (or when the
+        slot is serialized again).  This makes opening a project
+        independent of the amount of stored data, for clients that
+        may not need it at all (e.g. headless batch prediction with a
+        stored classifier).
+
+        Deferred loading is meant for read-only use: data written to
+        the slot before loadDeferred() may be overwritten by the
+        stored blocks.
+        """
+        if self.deferLoading and self.name in group:
+            logger.debug("Deferring deserialization of BlockSlot: {}".format( self.name ))
+            self._deferredGroup = group[self.name]
+            self.dirty = False
+        else:
+            super(SerialBlockSlot, self).deserialize(group)
+
+    @property
+    def hasDeferredData(self):
+        return self._deferredGroup is not None
+
+    def loadDeferred(self):
+        """Read the data whose loading was deferred by deserialize(), if any."""
+        if self._deferredGroup is None:
+            return
+        mygroup, self._deferredGroup = self._deferredGroup, None
+
+        # Loading doesn't make us dirty: the slot now matches the stored data.
+        ignoreDirty = self.ignoreDirty
+        self.ignoreDirty = True
+        try:
+            self._deserialize(mygroup, self.inslot)
+        finally:
+            self.ignoreDirty = ignoreDirty
 
     @timeLogged(logger, logging.DEBUG)
     def _deserialize(self, mygroup, slot):
@@ -501,6 +663,9 @@ class SerialBlockSlot(SerialSlot):
 
 class SerialHdf5BlockSlot(SerialBlockSlot):
 
+    # The blocks are written by the slot itself (see _serialize)
+    supportsIncrementalSave = False
+
     def _serialize(self, group, name, slot):
         mygroup = group.create_group(name)
         num = len(self.blockslot)
@@ -843,6 +1008,22 @@ class AppletSerializer(object):
 
         return False
 
+    def deferBlockLoading(self, defer=True):
+        """Defer reading the data of all block slots when the project
+        is loaded, until loadDeferredData() is called.  See
+        SerialBlockSlot.deserialize().
+
+        """
+        for ss in self.serialSlots:
+            if isinstance(ss, SerialBlockSlot):
+                ss.deferLoading = defer
+
+    def loadDeferredData(self):
+        """Read the block slot data that was not loaded with the project."""
+        for ss in self.serialSlots:
+            if isinstance(ss, SerialBlockSlot):
+                ss.loadDeferred()
+
     @property
     def ignoreDirty(self):
         return self._ignoreDirty
@@ -32,8 +32,11 @@ from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
 from lazyflow.request import Request, RequestPool
 from lazyflow.utility import traceLogged
 from lazyflow.operators import OpPixelOperator
+from lazyflow.roi import sliceToRoi
 
 from ilastik.applets.counting.countingsvr import SVR
+from ilastik.applets.counting.sparseTrainingSet import blockTrainingSet, kernelRadius, sampleBackground, \
+                                                      BACKGROUND_LABEL, BACKGROUND_SEED
 
 
 
@@ -65,6 +68,14 @@ def checkOption(reqlist):
 
 
 class OpTrainCounter(Operator):
+    """
+    Train the counting regressors on the dot and background annotations.
+
+    Background annotations get the target density 0, also within the
+    kernel support of a dot.  If there are more than
+    SVR.MAX_BACKGROUND_SAMPLES background pixels, a reproducible random
+    sample of them is used for training.
+    """
     name = "TrainCounter"
     description = "Train a random forest on multiple images"
     category = "Learning"
@@ -141,26 +152,33 @@ class OpTrainCounter(Operator):
         featMatrix=[]
         labelsMatrix=[]
         tagList = []
+        numNearDots = 0
 
         
         #result[0] = self._svr
 
+        sigma = self.Sigma.value
+        radius = kernelRadius(sigma)
+
         for i,labels in enumerate(self.inputs["ForegroundLabels"]):
             if labels.meta.shape is not None:
-                opGaussian = OpGaussianSmoothing(parent = self, graph = self.graph)
-                opGaussian.Sigma.setValue(self.Sigma.value)
-                opGaussian.Input.connect(self.ForegroundLabels[i])
+                shape = labels.meta.shape
                 blocks = self.inputs["nonzeroLabelBlocks"][i][0].wait()
                 
                 reqlistlabels = []
                 reqlistbg = []
                 reqlistfeat = []
+                blockRois = []
                 progress += 10 / numImages
                 self.progressSignal(progress)
                 
                 for b in blocks[0]:
-                    request = opGaussian.Output[b]
-                    #request = labels[b]
+                    # The dots are read with a halo, so that dots next to the block
+                    # contribute to its density.  The channel axis is the last one.
+                    start, stop = sliceToRoi(b, shape)
+                    haloStart = [max(x - radius, 0) for x in start[:-1]] + [start[-1]]
+                    haloStop = [min(x + radius, s) for x, s in zip(stop[:-1], shape[:-1])] + [stop[-1]]
+                    request = labels(haloStart, haloStop)
                     featurekey = list(b)
                     featurekey[-1] = slice(None, None, None)
                     request2 = self.Images[i][featurekey]
@@ -168,6 +186,7 @@ class OpTrainCounter(Operator):
                     reqlistlabels.append(request)
                     reqlistfeat.append(request2)
                     reqlistbg.append(request3)
+                    blockRois.append((np.subtract(start, haloStart)[:-1], np.subtract(stop, haloStart)[:-1]))
 
                 traceLogger.debug("Requests prepared")
 
@@ -195,29 +214,23 @@ class OpTrainCounter(Operator):
                 traceLogger.debug("Requests fired")
                 
 
-                #Fixme: Maybe later request only part of the region?
-
-                #image=self.inputs["Images"][i][:].wait()
                 for ir, req in enumerate(reqlistlabels):
                     
-                    labblock = req.wait()
+                    dots = req.wait()[..., 0]
                     
                     image = reqlistfeat[ir].wait()
-                    labbgblock = reqlistbg[ir].wait()
-                    labblock = labblock.reshape((image.shape[:-1]))
+                    labbgblock = reqlistbg[ir].wait()[..., 0]
                     image = image.reshape((-1, image.shape[-1]))
-                    labbgindices = np.where(labbgblock == 2)            
-                    labbgindices = np.ravel_multi_index(labbgindices, labbgblock.shape)
-                    
-                    newDot, mapping, tags = \
-                    self._svr.prepareDataRefactored(labblock, labbgindices)
-                    #self._svr.prepareData(labblock, smooth = True)
 
-                    labels   = newDot[mapping]
+                    # Only the support of the dots is smoothed
+                    density, mapping, tags, nearDots = \
+                    blockTrainingSet(dots, labbgblock == BACKGROUND_LABEL, sigma, blockRois[ir])
+                    numNearDots += nearDots
+
                     features = image[mapping]
 
                     featMatrix.append(features)
-                    labelsMatrix.append(labels)
+                    labelsMatrix.append(density)
                     tagList.append(tags)
                 
                 progress = progress_outer[0]
@@ -252,6 +265,21 @@ class OpTrainCounter(Operator):
             assert(not np.isnan(np.sum(fullFeatMatrix)))
 
             fullTags = [np.sum(posTags), np.sum(negTags)]
+
+            if numNearDots > 0:
+                logger.info("{} background pixels are close to a dot, their target density is 0"
+                            .format(numNearDots))
+
+            # Only a sample of the background pixels is used for training
+            background = sampleBackground(np.arange(numPosTags, numTags), SVR.MAX_BACKGROUND_SAMPLES,
+                                          np.random.RandomState(BACKGROUND_SEED))
+            if len(background) < fullTags[1]:
+                keep = np.concatenate((np.arange(numPosTags), background))
+                fullFeatMatrix = fullFeatMatrix[keep]
+                fullLabelsMatrix = fullLabelsMatrix[keep]
+                logger.info("Training with a random sample of {} of the {} background pixels"
+                            .format(len(background), fullTags[1]))
+                fullTags = [numPosTags, len(background)]
             #pool = RequestPool()
 
             maxima = np.max(fullFeatMatrix, axis=0)
@@ -28,6 +28,9 @@ except:
 
 import h5py, cPickle
 import sys
+import scipy.sparse
+
+from ilastik.applets.counting.sparseTrainingSet import sparseTrainingSet
 
 import logging
 logger = logging.getLogger(__name__)
@@ -63,8 +66,8 @@ class RegressorC(object):
         c_char_p= ctypes.POINTER(ctypes.c_char)
         c_int_p= ctypes.POINTER(ctypes.c_int64)
         c_double_p= ctypes.POINTER(ctypes.c_double)
-        X = X.astype(np.float64)
-        Yl = Yl.astype(np.float64)
+        X = np.ascontiguousarray(X, dtype = np.float64)
+        Yl = np.ascontiguousarray(Yl, dtype = np.float64)
         X_p = X.ctypes.data_as(c_double_p)
         Yl_p = Yl.ctypes.data_as(c_double_p)
         numRows = X.shape[0]
@@ -81,14 +84,14 @@ class RegressorC(object):
         dens_p = None
         if boxConstraints and type(boxConstraints) == dict:
             numConstraints = len(boxConstraints["boxValues"])
-            boxValues = boxConstraints["boxValues"].astype(np.float64)
+            boxValues = np.ascontiguousarray(boxConstraints["boxValues"], dtype = np.float64)
             boxValues_p = boxValues.ctypes.data_as(c_double_p)
-            boxIndices = boxConstraints["boxIndices"].astype(np.int64)
+            boxIndices = np.ascontiguousarray(boxConstraints["boxIndices"], dtype = np.int64)
             boxIndices_p = boxIndices.ctypes.data_as(c_int_p)
-            boxFeatures = boxConstraints["boxFeatures"].astype(np.float64)
+            boxFeatures = np.ascontiguousarray(boxConstraints["boxFeatures"], dtype = np.float64)
             boxFeatures_p = boxFeatures.ctypes.data_as(c_double_p)
             #filter out boxes of size 0
-            boxSizes = [boxIndices[i+1] - boxIndices[i] for i in range(len(boxValues))]
+            boxSizes = np.diff(boxIndices[:len(boxValues) + 1])
             assert(np.count_nonzero(boxSizes) == len(boxValues))
             assert(len(boxFeatures.shape) == 2)
             assert(boxIndices[-1] == boxFeatures.shape[0])
@@ -111,8 +114,8 @@ class RegressorC(object):
         c_char_p= ctypes.POINTER(ctypes.c_char)
         c_int_p= ctypes.POINTER(ctypes.c_int64)
         c_double_p= ctypes.POINTER(ctypes.c_double)
-        X = X.astype(np.float64)
-        Yl = Yl.astype(np.float64)
+        X = np.ascontiguousarray(X, dtype = np.float64)
+        Yl = np.ascontiguousarray(Yl, dtype = np.float64)
         X_p = X.ctypes.data_as(c_double_p)
         Yl_p = Yl.ctypes.data_as(c_double_p)
         numRows = X.shape[0]
@@ -129,14 +132,14 @@ class RegressorC(object):
         dens_p = None
         if boxConstraints and type(boxConstraints) == dict:
             numConstraints = len(boxConstraints["boxValues"])
-            boxValues = boxConstraints["boxValues"].astype(np.float64)
+            boxValues = np.ascontiguousarray(boxConstraints["boxValues"], dtype = np.float64)
             boxValues_p = boxValues.ctypes.data_as(c_double_p)
-            boxIndices = boxConstraints["boxIndices"].astype(np.int64)
+            boxIndices = np.ascontiguousarray(boxConstraints["boxIndices"], dtype = np.int64)
             boxIndices_p = boxIndices.ctypes.data_as(c_int_p)
-            boxFeatures = boxConstraints["boxFeatures"].astype(np.float64)
+            boxFeatures = np.ascontiguousarray(boxConstraints["boxFeatures"], dtype = np.float64)
             boxFeatures_p = boxFeatures.ctypes.data_as(c_double_p)
             #filter out boxes of size 0
-            boxSizes = [boxIndices[i+1] - boxIndices[i] for i in range(len(boxValues))]
+            boxSizes = np.diff(boxIndices[:len(boxValues) + 1])
             assert(np.count_nonzero(boxSizes) == len(boxValues))
             assert(len(boxFeatures.shape) == 2)
             assert(boxIndices[-1] == boxFeatures.shape[0])
@@ -197,7 +200,11 @@ class RegressorGurobi(object):
         
         
         self.Nf = X.shape[1]
-        X_hat=self.get_Xhat(X)
+        # Compact sparse copy of the samples: the constraints only use the stored entries
+        if scipy.sparse.issparse(X):
+            X_hat = scipy.sparse.hstack([X, np.ones((X.shape[0],1))]).tocsr()
+        else:
+            X_hat = scipy.sparse.csr_matrix(self.get_Xhat(X))
         import gurobipy as gu
         
         model=gu.Model()
@@ -212,6 +219,12 @@ class RegressorGurobi(object):
         
          
         model.update()
+
+        def rowExpression(i, sign):
+            # sign * <X_hat[i], w>
+            start, stop = X_hat.indptr[i], X_hat.indptr[i + 1]
+            return gu.LinExpr([sign * float(v) for v in X_hat.data[start:stop]],
+                              [w_vars[j] for j in X_hat.indices[start:stop]])
         logger.info( "done " )
         
         #print "setting penalty objective %s ..."%self.penalty,
@@ -240,17 +253,17 @@ class RegressorGurobi(object):
             logger.debug( "huh, ???" )
             for i in range(sum(tags)):
                 #logme("%.2f"%(i/float(X_hat.shape[0])*100.0))
-                constr=gu.quicksum([float(X_hat[i,j])*w_vars[j] for j in range(self.Nf+1)]) - u_vars1[i]<=float(Yl[i]) + self._epsilon
+                constr=rowExpression(i, 1.0) - u_vars1[i]<=float(Yl[i]) + self._epsilon
                 model.addConstr(constr )
             for i in range(tags[0]):
-                constr=gu.quicksum([-(float(X_hat[i,j])*w_vars[j])  for j in range(self.Nf+1)]) - u_vars2[i]<=-float(Yl[i]) + self._epsilon
+                constr=rowExpression(i, -1.0) - u_vars2[i]<=-float(Yl[i]) + self._epsilon
                 model.addConstr(constr)        
         else:
             for i in range(X.shape[0]):
-		    constr=gu.quicksum([float(X_hat[i,j])*w_vars[j] for j in range(self.Nf+1)]) - u_vars1[i]<=float(Yl[i]) + self._epsilon
-		    model.addConstr(constr )
-		    constr=gu.quicksum([-(float(X_hat[i,j])*w_vars[j])  for j in range(self.Nf+1)]) - u_vars2[i]<=-float(Yl[i]) + self._epsilon
-		    model.addConstr(constr)        
+                constr=rowExpression(i, 1.0) - u_vars1[i]<=float(Yl[i]) + self._epsilon
+                model.addConstr(constr )
+                constr=rowExpression(i, -1.0) - u_vars2[i]<=-float(Yl[i]) + self._epsilon
+                model.addConstr(constr)        
 
         model.update()
         #model.setParam('OutputFlag', False) 
@@ -349,6 +362,8 @@ class RegressorGurobi(object):
 
 class SVR(object):
 
+    #: At most this many of the background pixels are used for training
+    MAX_BACKGROUND_SAMPLES = 100000
 
     options = [
         {"method" : "BoxedRegressionGurobi", "gui":["default", "svr"],
@@ -405,82 +420,24 @@ class SVR(object):
         f.close()
         return obj
 
-    def smoothLabels(self, dot):
-        
-        backupindices = np.where(dot == 2)
-        dot[backupindices] = 0
-        sigma = self._Sigma
-        
-        
-        oldShape = dot.shape
-        if sigma > 0:
-            try:
-                dot = vigra.filters.gaussianSmoothing(dot.astype(np.float32).squeeze(), sigma) #TODO: use it later, but this
-            except Exception,e:
-                logger.error( "HHHHHHHH {} {}".format(dot.shape,dot.dtype) )
-                logger.error(str(e))
-                raise Exception
-            
-        
-        
-        dot = dot.reshape(oldShape)
-        dot[backupindices] = 0
-        
-        return dot,backupindices
-
-    def prepareDataRefactored(self, dot, nindices):
-
-        dot = dot.reshape(-1)
-        pindices = np.where(dot > 0.0001)[0]
-        #pindices = pindices[:250]
-        lindices = None
-        #if self.DENSITYBOUND:
-        #    lindices = np.concatenate((nindices, pindices))
-        #else:
-        lindices = nindices
-
-        #lindices = np.concatenate((pindices, nindices))
-        numVariables = len(pindices) + len(lindices) 
-
-        mapping = np.concatenate((pindices, lindices))
-
-        tags = [len(pindices), len(lindices)]
-        #print dot
-
-        return dot, mapping, tags
-
-
     def prepareData(self, dot, smooth = True):
+        """
+        Training set of the label image dot (1: dots, 2: background).
 
-        dot, backupindices = self.smoothLabels(dot)
-
-        #is terrible for debugging
-        nindices = np.ravel_multi_index(backupindices, dot.shape) #TODO: CHANGE BACK
-        dot = dot.reshape(-1)
-        pindices = np.where(dot > 0.0001)[0]
-        #pindices = pindices[:250]
-        lindices = None
-        #if self.DENSITYBOUND:
-        #    lindices = np.concatenate((nindices, pindices))
-        #else:
-        lindices = nindices
-
-        #lindices = np.concatenate((pindices, nindices))
-        numVariables = len(pindices) + len(lindices) 
-
-        mapping = np.concatenate((pindices, lindices))
-
-        tags = [len(pindices), len(lindices)]
-        #print dot
-
-        return dot, mapping, tags
+        Returns the target densities of the training pixels, their flat
+        indices (mapping) and tags = [#foreground, #background].
+        Only the support of the dots is smoothed, and at most
+        MAX_BACKGROUND_SAMPLES background pixels are used.
+        """
+        sigma = self._Sigma if smooth else 0
+        return sparseTrainingSet(dot, sigma, self.MAX_BACKGROUND_SAMPLES)
    
     def fit(self, img, dot, boxConstraints = [], smooth = True, numRegressors = 1):
 
-        newDot, mapping, tags = \
+        density, mapping, tags = \
         self.prepareData(dot, smooth)
         newImg = img.reshape((-1, img.shape[-1]))
-        self.fitPrepared(newImg[mapping,:], newDot[mapping], tags, boxConstraints, numRegressors)
+        self.fitPrepared(newImg[mapping,:], density, tags, boxConstraints, numRegressors)
 
 
     def splitBoxConstraints(self, numRegressors, boxConstraints):
@@ -720,7 +677,7 @@ if __name__ == "__main__":
 
     print testtags
     numRegressors = 1
-    success = Counter.fitPrepared(testimg[testmapping,:], testdot[testmapping], testtags,
+    success = Counter.fitPrepared(testimg[testmapping,:], testdot, testtags,
                                   boxConstraints = boxConstraints, numRegressors = numRegressors)
     print Counter._regressor[0].w
     #3uccess = Counter.fitPrepared(testimg[indices,:], testdot[indices], testtags[:len(indices)], epsilon = 0.000)
@@ -49,6 +49,13 @@ import threading
 from ilastik.applets.base.applet import DatasetConstraintError
 
 class OpVolumeOperator(Operator):
+    """
+    Reduces the whole Input with Function, blockwise: Function is applied to
+    each block, and then to the array of all block results.
+
+    The block results are kept, so after a (small) change of the Input only the
+    blocks that intersect the dirty roi are computed again.
+    """
     name = "OpVolumeOperator"
     description = "Do Operations involving the whole volume"
     inputSlots = [InputSlot("Input"), InputSlot("Function")]
@@ -56,6 +63,15 @@ class OpVolumeOperator(Operator):
     DefaultBlockSize = 128
     blockShape = InputSlot(value = DefaultBlockSize)
 
+    def __init__(self, *args, **kwargs):
+        super(OpVolumeOperator, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._blockValid = None
+        # Increased whenever all blocks are discarded (and never reset), so that
+        # results computed with an old Function or block layout are not stored
+        self._epoch = 0
+        self.cache = None
+
     def setupOutputs(self):
         testInput = numpy.ones((3,3))
         testFun = self.Function.value
@@ -64,49 +80,81 @@ class OpVolumeOperator(Operator):
         self.outputs["Output"].meta.dtype = testOutput.dtype
         self.outputs["Output"].meta.shape = (1,)
         self.outputs["Output"].setDirty((slice(0,1,None),))
-        self.cache = None
-        self._lock = threading.Lock()
 
+        shape = numpy.array(self.Input.meta.shape)
+        self._fullBlockShape = numpy.array([self.blockShape.value for i in shape])
+        self._numBlocks = numpy.ceil(shape/(1.0*self._fullBlockShape)).astype("int")
+        self._resetBlocks()
 
-    def execute(self, slot, subindex, roi, result):
+    def _resetBlocks(self):
         with self._lock:
-            if self.cache is None:
-                fullBlockShape = numpy.array([self.blockShape.value for i in self.Input.meta.shape])
-                fun = self.inputs["Function"].value
-                #data = self.inputs["Input"][:].wait()
-                #split up requests into blocks
-                shape = self.Input.meta.shape
-                numBlocks = numpy.ceil(shape/(1.0*fullBlockShape)).astype("int")
-                blockCache = numpy.ndarray(shape = numpy.prod(numBlocks), dtype=self.Output.meta.dtype)
-                pool = RequestPool()
-                #blocks holds the different roi keys for each of the blocks
-                blocks = itertools.product(*[range(i) for i in numBlocks])
-                blockKeys = []
-                for b in blocks:
-                    start = b * fullBlockShape
-                    stop = b * fullBlockShape + fullBlockShape
-                    stop = numpy.min(numpy.vstack((stop, shape)), axis=0)
-                    blockKey = roiToSlice(start, stop)
-                    blockKeys.append(blockKey)
-                
-                def predict_block(i):
-                    data = self.Input[blockKeys[i]].wait()
-                    blockCache[i] = fun(data)
-                    
-                for i,f in enumerate(blockCache):
-                    req = pool.request(partial(predict_block,i))
+            self._epoch += 1
+            nblocks = numpy.prod(self._numBlocks)
+            self._blockCache = numpy.ndarray(shape = nblocks, dtype=self.Output.meta.dtype)
+            self._blockValid = numpy.zeros(nblocks, dtype=bool)
+            # Increased whenever a block becomes dirty, so that results
+            # computed from outdated data are not stored
+            self._blockGeneration = numpy.zeros(nblocks, dtype=numpy.int64)
+            self.cache = None
+
+    def _blockKey(self, i):
+        start = numpy.array(numpy.unravel_index(i, self._numBlocks)) * self._fullBlockShape
+        stop = numpy.minimum(start + self._fullBlockShape, self.Input.meta.shape)
+        return roiToSlice(start, stop)
 
-                pool.wait()
-                pool.clean()
-
-                self.cache = [fun(blockCache)]
-            return self.cache
+    def execute(self, slot, subindex, roi, result):
+        while True:
+            with self._lock:
+                if self.cache is not None:
+                    result[0] = self.cache[0]
+                    return self.cache
+                todo = numpy.flatnonzero(~self._blockValid)
+                generations = self._blockGeneration[todo]
+                epoch = self._epoch
+                fun = self.Function.value
+
+            # Compute the missing blocks without holding the lock
+            values = numpy.ndarray(shape = len(todo), dtype=self.Output.meta.dtype)
+
+            def predict_block(j):
+                data = self.Input[self._blockKey(todo[j])].wait()
+                values[j] = fun(data)
+
+            pool = RequestPool()
+            for j in range(len(todo)):
+                pool.request(partial(predict_block, j))
+            pool.wait()
+            pool.clean()
+
+            with self._lock:
+                if epoch != self._epoch:
+                    # The blocks were reset in the meantime, start over
+                    continue
+                current = (self._blockGeneration[todo] == generations)
+                self._blockCache[todo[current]] = values[current]
+                self._blockValid[todo[current]] = True
+                if self._blockValid.all() and self.cache is None:
+                    self.cache = [fun(self._blockCache)]
 
     def propagateDirty(self, slot, subindex, roi):
-        key = roi.toSlice()
-        if slot == self.Input or slot == self.Function:
+        if self._blockValid is None:
+            # Not configured yet
             self.outputs["Output"].setDirty( slice(None) )
-        self.cache = None
+        elif slot == self.Input:
+            # Only the blocks intersecting the roi have to be recomputed
+            start = numpy.array(roi.start) // self._fullBlockShape
+            stop = (numpy.array(roi.stop) - 1) // self._fullBlockShape + 1
+            blockKey = roiToSlice(start, stop)
+            with self._lock:
+                self._blockValid.reshape(self._numBlocks)[blockKey] = False
+                self._blockGeneration.reshape(self._numBlocks)[blockKey] += 1
+                self.cache = None
+            self.outputs["Output"].setDirty( slice(None) )
+        elif slot == self.Function:
+            self._resetBlocks()
+            self.outputs["Output"].setDirty( slice(None) )
+        else:
+            self._resetBlocks()
 
 class OpUpperBound(Operator):
     name = "OpUpperBound"
@@ -0,0 +1,191 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Assembly of the density counting training set without dense images.
+
+The dot annotations of an image are usually a few hundred pixels, so
+instead of smoothing the whole dot image, each dot is spread with a
+truncated gaussian kernel over its support only.  The result is the same
+as vigra.filters.gaussianSmoothing() with its default window (3 sigma)
+and border treatment (reflect).
+
+Background annotations always get the target density 0, even within the
+kernel support of a dot.  Large background annotations can be subsampled,
+see sampleBackground().
+"""
+import numpy as np
+
+#: Label of the dots in the label image
+DOT_LABEL = 1
+#: Label of the background pixels in the label image
+BACKGROUND_LABEL = 2
+#: Smoothed densities up to this value are not used as foreground samples
+DENSITY_THRESHOLD = 0.0001
+#: Seed of the background sampling, so that training is reproducible
+BACKGROUND_SEED = 0
+
+def kernelRadius(sigma, windowRatio = 3.0):
+    """Radius of the truncated gaussian kernel, i.e. the halo a block needs for smoothing."""
+    if sigma <= 0:
+        return 0
+    return int(windowRatio * sigma + 0.5)
+
+def gaussianKernel1D(sigma, windowRatio = 3.0):
+    """Normalized 1D gaussian kernel, truncated at radius windowRatio * sigma."""
+    radius = kernelRadius(sigma, windowRatio)
+    x = np.arange(-radius, radius + 1, dtype = np.float64)
+    kernel = np.exp(-x**2 / (2.0 * sigma**2))
+    return kernel / kernel.sum()
+
+def reflectIndices(indices, size):
+    """
+    Map indices outside [0, size) back into the array by mirroring at the
+    first and last element (which is not repeated).
+    """
+    if size == 1:
+        return np.zeros_like(indices)
+    period = 2 * (size - 1)
+    indices = np.abs(indices) % period
+    return np.where(indices >= size, period - indices, indices)
+
+def _gatherWeights(positions, kernel, size):
+    """
+    Weights of the dots at positions (1D) in the pixels positions + offsets
+    after smoothing with kernel, with reflective border treatment.
+    Pixels outside the image get weight 0.
+    """
+    radius = len(kernel) // 2
+    offsets = np.arange(-radius, radius + 1)
+    pixels = positions[:, None] + offsets
+    # out[i] = sum_k kernel[k] * in[reflect(i + k)]: sum over the k that hit the dot
+    sources = reflectIndices(pixels[:, :, None] + offsets, size)
+    weights = np.dot(sources == positions[:, None, None], kernel)
+    inside = (pixels >= 0) & (pixels < size)
+    return np.where(inside, pixels, 0), np.where(inside, weights, 0.0)
+
+def smoothDots(positions, weights, shape, sigma):
+    """
+    Gaussian smoothing of an image that is zero except at the given positions.
+
+    positions: array of shape (ndots, ndim)
+    weights: the image values at the positions
+    shape: the image shape.  Axes of length 1 are not smoothed.
+
+    Returns the sorted flat indices of the pixels within the kernel support
+    of the dots and their smoothed values.
+    """
+    positions = np.asarray(positions, dtype = np.int64).reshape(-1, len(shape))
+    weights = np.asarray(weights, dtype = np.float64)
+    if sigma <= 0 or len(weights) == 0:
+        indices = np.ravel_multi_index(tuple(positions.T), shape)
+        order = np.argsort(indices)
+        return indices[order], weights[order]
+
+    coords = []
+    values = weights
+    for axis, size in enumerate(shape):
+        if size == 1:
+            kernel = np.ones(1)
+        else:
+            kernel = gaussianKernel1D(sigma)
+        pixels, axisWeights = _gatherWeights(positions[:, axis], kernel, size)
+
+        # Outer product over the kernel support of all axes so far
+        coords = [c[..., None] for c in coords]
+        coords.append(pixels.reshape((-1,) + (1,)*axis + (len(kernel),)))
+        values = values[..., None] * axisWeights.reshape((-1,) + (1,)*axis + (len(kernel),))
+
+    coords = [(c + np.zeros(values.shape, dtype = np.int64)).reshape(-1) for c in coords]
+    indices, inverse = np.unique(np.ravel_multi_index(coords, shape), return_inverse = True)
+    return indices, np.bincount(inverse, weights = values.reshape(-1), minlength = len(indices))
+
+def sampleBackground(indices, maxSamples, randomState = None):
+    """
+    Return at most maxSamples of the given indices, drawn at random (sorted).
+    By default, the draw is seeded with BACKGROUND_SEED.
+    """
+    if maxSamples is None or len(indices) <= maxSamples:
+        return indices
+    if randomState is None:
+        randomState = np.random.RandomState(BACKGROUND_SEED)
+    return np.sort(randomState.choice(indices, maxSamples, replace = False))
+
+def blockTrainingSet(dots, background, sigma, roi):
+    """
+    Build the training set of one block of a label image.
+
+    dots: the dot image (the dot weights, 0 elsewhere) of the block with a halo
+          of kernelRadius(sigma) pixels, as far as the image extends
+    background: boolean mask of the background annotations of the block itself
+    roi: (start, stop) of the block within dots
+
+    Returns (density, mapping, tags, numNearDots): density, mapping and tags
+    like sparseTrainingSet(), with mapping the flat indices into the block and
+    all background pixels of the block.  numNearDots is the number of
+    background pixels within the support of a dot, whose target is set to 0.
+    """
+    dots = np.asarray(dots)
+    start = np.asarray(roi[0])
+    blockShape = tuple(np.asarray(roi[1]) - start)
+    dotIndices = np.flatnonzero(dots)
+    positions = np.column_stack(np.unravel_index(dotIndices, dots.shape))
+    indices, density = smoothDots(positions, dots.reshape(-1)[dotIndices], dots.shape, sigma)
+
+    # Keep the pixels of the block, the halo only contributes dots
+    coords = np.column_stack(np.unravel_index(indices, dots.shape)) - start
+    inside = ((coords >= 0) & (coords < blockShape)).all(axis = 1)
+    indices = np.ravel_multi_index(tuple(coords[inside].T), blockShape)
+    density = density[inside]
+
+    # Background annotations are never foreground, even close to a dot
+    background = np.asarray(background, dtype = bool).reshape(-1)
+    isBackground = background[indices]
+    nearDots = (density > DENSITY_THRESHOLD) & isBackground
+    foreground = (density > DENSITY_THRESHOLD) & ~isBackground
+    foregroundIndices = indices[foreground]
+    backgroundIndices = np.flatnonzero(background)
+
+    mapping = np.concatenate((foregroundIndices, backgroundIndices))
+    density = np.concatenate((density[foreground], np.zeros(len(backgroundIndices))))
+    tags = [len(foregroundIndices), len(backgroundIndices)]
+    return density, mapping, tags, np.count_nonzero(nearDots)
+
+def sparseTrainingSet(labels, sigma, maxBackground = None):
+    """
+    Build the training set of the density counting regressor from a label
+    image with dots (DOT_LABEL) and background (BACKGROUND_LABEL) annotations.
+
+    Returns (density, mapping, tags):
+    mapping are the flat indices of the training pixels, foreground (smoothed
+    dot density above DENSITY_THRESHOLD) first, then background.
+    density are the target values of these pixels and tags = [#foreground, #background].
+    Background pixels have the target 0, also close to a dot, and at most
+    maxBackground of them are used.
+    """
+    labels = np.asarray(labels)
+    background = (labels == BACKGROUND_LABEL)
+    dots = np.where(background, 0, labels)
+    density, mapping, tags, _ = blockTrainingSet(dots, background, sigma, ((0,)*labels.ndim, labels.shape))
+
+    backgroundIndices = sampleBackground(mapping[tags[0]:], maxBackground)
+    mapping = np.concatenate((mapping[:tags[0]], backgroundIndices))
+    density = density[:len(mapping)]
+    return density, mapping, [tags[0], len(backgroundIndices)]
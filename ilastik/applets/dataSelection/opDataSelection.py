@@ -18,6 +18,7 @@
 # on the ilastik web site at:
 #		   http://ilastik.org/license.html
 ###############################################################################
+import os
 import uuid
 import numpy
 import vigra
@@ -177,40 +178,54 @@ class OpDataSelection(Operator):
             
             # Inject metadata if the dataset info specified any.
             # Also, inject if if dtype is uint8, which we can reasonably assume has drange (0,255)
-            if datasetInfo.normalizeDisplay is not None or \
-               datasetInfo.drange is not None or \
-               datasetInfo.axistags is not None or \
-               (providerSlot.meta.drange is None and providerSlot.meta.dtype == numpy.uint8):
-                metadata = {}
-                if datasetInfo.drange is not None:
-                    metadata['drange'] = datasetInfo.drange
-                elif providerSlot.meta.dtype == numpy.uint8:
-                    # SPECIAL case for uint8 data: Provide a default drange.
-                    # The user can always override this herself if she wants.
-                    metadata['drange'] = (0,255)
-                if datasetInfo.normalizeDisplay is not None:
-                    metadata['normalizeDisplay'] = datasetInfo.normalizeDisplay
-                if datasetInfo.axistags is not None:
-                    if len(datasetInfo.axistags) != len(providerSlot.meta.shape):
-                        raise Exception( "Your dataset's provided axistags ({}) do not have the "
-                                         "correct dimensionality for your dataset, which has {} dimensions."
-                                         .format( "".join(tag.key for tag in datasetInfo.axistags), len(providerSlot.meta.shape) ) )
-                    metadata['axistags'] = datasetInfo.axistags
+            # We always inject a 'dataset_source' identifier, which lets downstream caches
+            #  (see OpSharedFeatureCache) recognize the same data in several lanes or workflows.
+            #  The identifier includes everything the reader does to the stored data.
+            metadata = {}
+            axes = None
+            if datasetInfo.axistags is not None:
+                axes = "".join( tag.key for tag in datasetInfo.axistags )
+            if datasetInProject:
+                metadata['dataset_source'] = (self.ProjectFile.value.filename, internalPath, axes)
+            else:
+                subvolume_roi = None
                 if datasetInfo.subvolume_roi is not None:
-                    metadata['subvolume_roi'] = datasetInfo.subvolume_roi
-                    
-                    # FIXME: We are overwriting the axistags metadata to intentionally allow 
-                    #        the user to change our interpretation of which axis is which.
-                    #        That's okay, but technically there's a special corner case if 
-                    #        the user redefines the channel axis index.  
-                    #        Technically, it invalidates the meaning of meta.ram_usage_per_requested_pixel.
-                    #        For most use-cases, that won't really matter, which is why I'm not worrying about it right now.
+                    subvolume_roi = tuple( tuple(bound) for bound in datasetInfo.subvolume_roi )
+                metadata['dataset_source'] = ( os.path.normpath( os.path.join( self.WorkingDirectory.value, datasetInfo.filePath ) ),
+                                               subvolume_roi,
+                                               axes )
+            if datasetInfo.drange is not None:
+                metadata['drange'] = datasetInfo.drange
+            elif providerSlot.meta.dtype == numpy.uint8 and \
+                 ( providerSlot.meta.drange is None or
+                   datasetInfo.normalizeDisplay is not None or
+                   datasetInfo.axistags is not None ):
+                # SPECIAL case for uint8 data: Provide a default drange.
+                # The user can always override this herself if she wants.
+                metadata['drange'] = (0,255)
+            if datasetInfo.normalizeDisplay is not None:
+                metadata['normalizeDisplay'] = datasetInfo.normalizeDisplay
+            if datasetInfo.axistags is not None:
+                if len(datasetInfo.axistags) != len(providerSlot.meta.shape):
+                    raise Exception( "Your dataset's provided axistags ({}) do not have the "
+                                     "correct dimensionality for your dataset, which has {} dimensions."
+                                     .format( "".join(tag.key for tag in datasetInfo.axistags), len(providerSlot.meta.shape) ) )
+                metadata['axistags'] = datasetInfo.axistags
+            if datasetInfo.subvolume_roi is not None:
+                metadata['subvolume_roi'] = datasetInfo.subvolume_roi
                 
-                opMetadataInjector = OpMetadataInjector( parent=self )
-                opMetadataInjector.Input.connect( providerSlot )
-                opMetadataInjector.Metadata.setValue( metadata )
-                providerSlot = opMetadataInjector.Output
-                self._opReaders.append( opMetadataInjector )
+                # FIXME: We are overwriting the axistags metadata to intentionally allow 
+                #        the user to change our interpretation of which axis is which.
+                #        That's okay, but technically there's a special corner case if 
+                #        the user redefines the channel axis index.  
+                #        Technically, it invalidates the meaning of meta.ram_usage_per_requested_pixel.
+                #        For most use-cases, that won't really matter, which is why I'm not worrying about it right now.
+            
+            opMetadataInjector = OpMetadataInjector( parent=self )
+            opMetadataInjector.Input.connect( providerSlot )
+            opMetadataInjector.Metadata.setValue( metadata )
+            providerSlot = opMetadataInjector.Output
+            self._opReaders.append( opMetadataInjector )
 
             self._NonTransposedImage.connect(providerSlot)
             
@@ -0,0 +1,140 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import logging
+
+import numpy
+import h5py
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zarr
+    _has_zarr = True
+except ImportError:
+    _has_zarr = False
+
+class FeatureStore(object):
+    """
+    Read-only access to a list of precomputed feature volumes, one channel per source.
+
+    Each source is opened once and kept open until close() is called.
+    Supported sources:
+
+    - HDF5 files with a 3D dataset named 'data'.  Contiguous, uncompressed
+      datasets are memory-mapped directly; all others are read through h5py.
+    - Chunked N5 or zarr directories (requires the zarr package).  The
+      directory may be the array itself or a group containing a 'data' array.
+    """
+    DATASET_NAME = 'data'
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._files = []
+        self._sources = []
+        try:
+            for path in self.paths:
+                self._sources.append( self._open(path) )
+        except:
+            self.close()
+            raise
+
+        shapes = set( source.shape for source in self._sources )
+        if len(shapes) > 1:
+            self.close()
+            raise RuntimeError( "Feature files don't have the same shape: {}".format( zip(self.paths, shapes) ) )
+
+    def _open(self, path):
+        if os.path.isdir(path):
+            return self._openChunkedDirectory(path)
+
+        f = h5py.File(path, 'r')
+        self._files.append(f)
+        dataset = f[self.DATASET_NAME]
+        assert len(dataset.shape) == 3, "Feature dataset must be 3D: {}".format(path)
+
+        # Contiguous, uncompressed datasets can be memory-mapped, bypassing h5py entirely.
+        offset = dataset.id.get_offset()
+        if dataset.chunks is None and dataset.compression is None and offset is not None:
+            return numpy.memmap( path, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset )
+        return dataset
+
+    def _openChunkedDirectory(self, path):
+        if not _has_zarr:
+            raise RuntimeError( "Can't read {}: reading N5/zarr feature directories requires the zarr package.".format(path) )
+        if os.path.exists( os.path.join(path, 'attributes.json') ):
+            store = zarr.N5Store(path)
+        else:
+            store = zarr.DirectoryStore(path)
+        data = zarr.open(store, mode='r')
+        if isinstance(data, zarr.hierarchy.Group):
+            data = data[self.DATASET_NAME]
+        assert len(data.shape) == 3, "Feature dataset must be 3D: {}".format(path)
+        return data
+
+    @property
+    def shape(self):
+        """The 3D shape shared by all sources."""
+        return tuple(self._sources[0].shape)
+
+    @property
+    def dtypes(self):
+        return [ numpy.dtype(source.dtype) for source in self._sources ]
+
+    def __len__(self):
+        return len(self._sources)
+
+    def readChannel(self, index, key, out):
+        """
+        Copy source[index][key] into out, which must have the shape of the selection.
+        """
+        source = self._sources[index]
+        if isinstance(source, h5py.Dataset) and out.flags.c_contiguous:
+            source.read_direct(out, source_sel=key)
+        else:
+            out[...] = source[key]
+        return out
+
+    def read(self, key, channels, out):
+        """
+        Gather the spatial selection 'key' (3 slices) of the given
+        channel indices into the last axis of 'out'.
+        """
+        assert out.shape[-1] == len(channels)
+        buffer = None
+        for j, index in enumerate(channels):
+            target = out[..., j]
+            if isinstance(self._sources[index], h5py.Dataset) and not target.flags.c_contiguous:
+                # read_direct needs a contiguous destination: read into a
+                # buffer (shared by all channels) and copy from there.
+                if buffer is None:
+                    buffer = numpy.empty( target.shape, dtype=out.dtype )
+                self.readChannel( index, key, buffer )
+                target[...] = buffer
+            else:
+                self.readChannel( index, key, target )
+        return out
+
+    def close(self):
+        self._sources = []
+        for f in self._files:
+            f.close()
+        self._files = []
@@ -24,7 +24,6 @@ import logging
 
 #SciPy
 import numpy
-import h5py
 
 #lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -36,6 +35,8 @@ from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as
 from lazyflow.operators import OpReorderAxes, OperatorWrapper
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.featureSelection.featureStore import FeatureStore
+from ilastik.applets.featureSelection.opSharedFeatureCache import OpSharedFeatureCache
 
 logger = logging.getLogger(__name__)
 
@@ -94,6 +95,12 @@ class OpFeatureSelectionNoCache(Operator):
         self.opPixelFeatures.Input.connect(self.opReorderIn.Output)
         self.opReorderOut = OpReorderAxes(parent=self)
         self.opReorderOut.Input.connect(self.opPixelFeatures.Output)
+
+        # Features of the same dataset with the same settings are shared
+        #  with all other feature selection operators (e.g. training and batch lanes).
+        self._filter_implementation = filter_implementation
+        self.opSharedCache = OpSharedFeatureCache(parent=self)
+        self.opSharedCache.Input.connect(self.opReorderOut.Output)
         self.opReorderLayers = OperatorWrapper(OpReorderAxes, parent=self,
                                                broadcastingSlotNames=["AxisOrder"])
         self.opReorderLayers.Input.connect(self.opPixelFeatures.Features)
@@ -104,6 +111,9 @@ class OpFeatureSelectionNoCache(Operator):
 
         self.WINDOW_SIZE = self.opPixelFeatures.WINDOW_SIZE
 
+        # Precomputed features (see FeatureListFilename)
+        self._featureStore = None
+
     def setupOutputs(self):
         # drop non-channel singleton axes
         allAxes = 'txyzc'
@@ -127,26 +137,30 @@ class OpFeatureSelectionNoCache(Operator):
             self.FeatureLayers.disconnect()
             
             axistags = self.InputImage.meta.axistags
+
+            # Open all feature files once.  They stay open until the list changes or we are cleaned up.
+            self._closeFeatureStore()
+            self._featureStore = FeatureStore(self._files)
+            shape = self._featureStore.shape
+            dtypes = self._featureStore.dtypes
             
             self.FeatureLayers.resize(len(self._files))
             for i in range(len(self._files)):
-                f = h5py.File(self._files[i], 'r')
-                shape = f["data"].shape
-                assert len(shape) == 3
-                dtype = f["data"].dtype.type
-                f.close()
                 self.FeatureLayers[i].meta.shape    = shape+(1,)
-                self.FeatureLayers[i].meta.dtype    = dtype
+                self.FeatureLayers[i].meta.dtype    = dtypes[i].type
                 self.FeatureLayers[i].meta.axistags = axistags 
                 self.FeatureLayers[i].meta.description = os.path.basename(self._files[i]) 
             
             self.OutputImage.meta.shape    = (shape) + (len(self._files),)
-            self.OutputImage.meta.dtype    = dtype 
+            self.OutputImage.meta.dtype    = dtypes[-1].type
             self.OutputImage.meta.axistags = axistags 
             
             self.CachedOutputImage.meta.shape    = (shape) + (len(self._files),)
             self.CachedOutputImage.meta.axistags = axistags 
         else:
+            # No precomputed features (anymore)
+            self._closeFeatureStore()
+
             # Set the new selection matrix and check if it creates an error.
             selections = self.SelectionMatrix.value
             self.opPixelFeatures.Matrix.setValue( selections, check_changed=False )
@@ -157,10 +171,29 @@ class OpFeatureSelectionNoCache(Operator):
                       "The invalid scales are: {}".format( invalid_scales )                      
                 raise DatasetConstraintError( "Feature Selection", msg )
             
+            # Features can only be shared if we know where the input data came from.
+            dataset_source = self.InputImage.meta.dataset_source
+            if dataset_source is not None:
+                self.opSharedCache.CacheKey.setValue( self._sharedCacheKey( dataset_source, selections ) )
+            else:
+                self.opSharedCache.CacheKey.disconnect()
+
             # Connect our external outputs to our internal operators
-            self.OutputImage.connect( self.opReorderOut.Output )
+            self.OutputImage.connect( self.opSharedCache.Output )
             self.FeatureLayers.connect( self.opReorderLayers.Output )
 
+    def _sharedCacheKey(self, dataset_source, selections):
+        """
+        Everything that determines the content of our OutputImage.
+        """
+        return ( dataset_source,
+                 self._filter_implementation,
+                 tuple(self.InputImage.meta.shape),
+                 "".join(self.InputImage.meta.getAxisKeys()),
+                 tuple(self.Scales.value),
+                 tuple(self.FeatureIds.value),
+                 tuple( map(tuple, numpy.asarray(selections, dtype=bool)) ) )
+
     def propagateDirty(self, slot, subindex, roi):
         # Output slots are directly connected to internal operators
         pass
@@ -175,26 +208,23 @@ class OpFeatureSelectionNoCache(Operator):
             
         if slot == self.FeatureLayers:
             index = subindex[0]
-            f = h5py.File(self._files[index], 'r')
-            result[...,0] = f["data"][key[0:3]]
+            self._featureStore.readChannel(index, key[0:3], result[...,0])
             return result
         elif slot == self.OutputImage:
             assert result.ndim == 4
-            assert result.shape[-1] == len(self._files), "result.shape = %r" % result.shape 
-            assert rroi.start == 0, "rroi = %r" % (rroi,)
-            assert rroi.stop  == len(self._files), "rroi = %r" % (rroi,)
-            
-            j = 0
-            for i in range(key[3].start, key[3].stop):
-                f = h5py.File(self._files[i], 'r')
-                r = f["data"][key[0:3]]
-                assert r.dtype == numpy.float32
-                assert r.ndim == 3
-                f.close()
-                result[:,:,:,j] = r 
-                j += 1
+            assert result.shape[-1] == key[3].stop - key[3].start, "result.shape = %r" % result.shape 
+            self._featureStore.read(key[0:3], range(key[3].start, key[3].stop), result)
             return result  
 
+    def cleanUp(self):
+        self._closeFeatureStore()
+        super( OpFeatureSelectionNoCache, self ).cleanUp()
+
+    def _closeFeatureStore(self):
+        if self._featureStore is not None:
+            self._featureStore.close()
+        self._featureStore = None
+
 class OpFeatureSelection( OpFeatureSelectionNoCache ):
     """
     This is the top-level operator of the feature selection applet when used in a GUI.
@@ -210,8 +240,10 @@ class OpFeatureSelection( OpFeatureSelectionNoCache ):
         self.opPixelFeatureCache = OpSlicedBlockedArrayCache(parent=self)
         self.opPixelFeatureCache.name = "opPixelFeatureCache"
 
-        # Connect the cache to the feature output
-        self.opPixelFeatureCache.Input.connect(self.OutputImage)
+        # Connect the cache to the uncached features.
+        # Interactive viewing is served by opPixelFeatureCache alone, whose slices fit the tiles the GUI requests.
+        # The shared feature cache behind OutputImage is for batch processing and for lanes that share a dataset.
+        self.opPixelFeatureCache.Input.connect(self.opReorderOut.Output)
         self.opPixelFeatureCache.fixAtCurrent.setValue(False)
 
     def setupOutputs(self):
@@ -0,0 +1,185 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+import threading
+import logging
+from functools import partial
+
+import numpy
+import psutil
+
+import lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+
+logger = logging.getLogger(__name__)
+
+class SharedBlockCache(object):
+    """
+    A process-wide, content-addressed LRU cache of computed image blocks.
+
+    Entries are keyed by arbitrary hashable keys (e.g. (dataset, settings, block start)),
+    so any number of operators that compute the same thing can share the results.
+    If several requests ask for the same missing block at once, it is computed only once.
+    """
+    #: Fraction of lazyflow.AVAILABLE_RAM_MB (or of the system RAM) the cache may use.
+    RAM_FRACTION = 0.25
+
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict()
+        self._pending = {}
+        self._used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        available_mb = getattr(lazyflow, 'AVAILABLE_RAM_MB', 0)
+        if available_mb:
+            return int(self.RAM_FRACTION * available_mb * 1e6)
+        return int(self.RAM_FRACTION * psutil.virtual_memory().total)
+
+    @property
+    def used_bytes(self):
+        return self._used_bytes
+
+    def get(self, key, compute):
+        """
+        Return the cached block for key, computing it with compute() if necessary.
+        The returned array must not be modified.
+        """
+        owner = False
+        with self._lock:
+            if key in self._blocks:
+                self.hits += 1
+                block = self._blocks.pop(key)
+                self._blocks[key] = block # Most recently used goes last
+                return block
+            request = self._pending.get(key)
+            if request is None:
+                self.misses += 1
+                request = Request(compute)
+                self._pending[key] = request
+                owner = True
+
+        if not owner:
+            return request.wait()
+
+        try:
+            block = request.wait()
+        finally:
+            with self._lock:
+                del self._pending[key]
+        self._insert(key, block)
+        return block
+
+    def _insert(self, key, block):
+        if block.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._blocks:
+                return
+            self._blocks[key] = block
+            self._used_bytes += block.nbytes
+            while self._used_bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self._used_bytes -= evicted.nbytes
+
+    def invalidate(self, predicate):
+        """Drop all entries whose key satisfies predicate(key)."""
+        with self._lock:
+            for key in filter(predicate, self._blocks.keys()):
+                self._used_bytes -= self._blocks.pop(key).nbytes
+
+    def clear(self):
+        self.invalidate(lambda key: True)
+
+#: The cache shared by all OpSharedFeatureCache instances.
+sharedFeatureCache = SharedBlockCache()
+
+class OpSharedFeatureCache(Operator):
+    """
+    Serves its Input from the process-wide sharedFeatureCache.
+
+    The input is divided into fixed, aligned blocks (all channels, one time step),
+    so overlapping requests (e.g. neighboring tiles) reuse the same blocks.
+    Operators with the same CacheKey share their blocks, e.g. the training and
+    batch feature operators when they process the same dataset with the same
+    feature settings.  Without a CacheKey, requests are simply forwarded.
+    """
+    Input = InputSlot()
+    CacheKey = InputSlot(optional=True) # Must be hashable
+    Output = OutputSlot()
+
+    #: Block side length along each spatial axis
+    BLOCK_SIZE = { 'x' : 128, 'y' : 128, 'z' : 64 }
+
+    def __init__(self, *args, **kwargs):
+        super( OpSharedFeatureCache, self ).__init__( *args, **kwargs )
+        self._cache = sharedFeatureCache
+        self._blockshape = None
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+        taggedShape = self.Input.meta.getTaggedShape()
+        self._blockshape = tuple( min(size, self.BLOCK_SIZE.get(k, 1 if k == 't' else size))
+                                  for k, size in taggedShape.items() )
+
+    def execute(self, slot, subindex, roi, result):
+        if not self.CacheKey.ready():
+            self.Input(roi.start, roi.stop).writeInto(result).wait()
+            return result
+
+        key = self.CacheKey.value
+        shape = self.Input.meta.shape
+        request_roi = (roi.start, roi.stop)
+
+        def copy_block(block_start):
+            block_roi = getBlockBounds( shape, self._blockshape, block_start )
+            block = self._cache.get( (key, tuple(block_start)), partial(self._computeBlock, block_roi) )
+            intersection = getIntersection( block_roi, request_roi )
+            source = roiToSlice( *(numpy.subtract(intersection, block_roi[0])) )
+            dest = roiToSlice( *(numpy.subtract(intersection, roi.start)) )
+            result[dest] = block[source]
+
+        pool = RequestPool()
+        for block_start in getIntersectingBlocks( self._blockshape, request_roi ):
+            pool.add( Request( partial(copy_block, block_start) ) )
+        pool.wait()
+        return result
+
+    def _computeBlock(self, block_roi):
+        return self.Input(*block_roi).wait()
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot is self.Input and self.CacheKey.ready():
+            # Our blocks are no longer valid (for anyone with the same key).
+            key = self.CacheKey.value
+            self._cache.invalidate( lambda k: k[0] == key )
+        if slot is self.Input:
+            self.Output.setDirty(roi.start, roi.stop)
+        else:
+            self.Output.setDirty( slice(None) )
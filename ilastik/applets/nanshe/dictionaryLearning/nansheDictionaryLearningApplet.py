@@ -44,7 +44,7 @@ class NansheDictionaryLearningApplet( StandardApplet ):
     @property
     def broadcastingSlots(self):
         return ["Ord", "K", "Gamma1", "Gamma2", "NumThreads", "Batchsize", "NumIter", "Lambda1", "Lambda2", "PosAlpha",\
-                "PosD", "Clean", "Mode", "ModeD"]
+                "PosD", "Clean", "Mode", "ModeD", "WarmStart"]
     
     @property
     def singleLaneGuiClass(self):
@@ -41,6 +41,7 @@ class NansheDictionaryLearningSerializer(AppletSerializer):
                                                                    SerialSlot(operator.Clean, selfdepends=True),
                                                                    SerialSlot(operator.Mode, selfdepends=True),
                                                                    SerialSlot(operator.ModeD, selfdepends=True),
+                                                                   SerialSlot(operator.WarmStart, selfdepends=True),
                                                                    SerialBlockSlot(operator.Output,
                                                                                    operator.CacheInput,
                                                                                    operator.CleanBlocks, selfdepends=True)])
@@ -66,6 +66,7 @@ class OpNansheDictionaryLearning(Operator):
     Clean = InputSlot(value=True)
     Mode = InputSlot(value=2, stype="int")
     ModeD = InputSlot(value=0, stype="int")
+    WarmStart = InputSlot(value=False, stype="bool")
 
     CleanBlocks = OutputSlot()
     Output = OutputSlot()
@@ -92,6 +93,7 @@ class OpNansheDictionaryLearning(Operator):
         self.opDictionary.Clean.connect(self.Clean)
         self.opDictionary.Mode.connect(self.Mode)
         self.opDictionary.ModeD.connect(self.ModeD)
+        self.opDictionary.WarmStart.connect(self.WarmStart)
 
         self.opDictionary.CacheInput.connect(self.CacheInput)
         self.CleanBlocks.connect(self.opDictionary.CleanBlocks)
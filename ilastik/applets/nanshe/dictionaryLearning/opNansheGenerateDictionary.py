@@ -26,6 +26,7 @@ __date__ = "$Oct 17, 2014 13:07:51 EDT$"
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpArrayCache
+from lazyflow.request import RequestLock
 
 from ilastik.applets.base.applet import DatasetConstraintError
 
@@ -63,6 +64,9 @@ class OpNansheGenerateDictionary(Operator):
     Mode = InputSlot(value=2, stype="int")
     ModeD = InputSlot(value=0, stype="int")
 
+    # If only NumIter was increased, continue training the previous dictionary
+    WarmStart = InputSlot(value=False, stype="bool")
+
     Output = OutputSlot()
 
     def __init__(self, *args, **kwargs):
@@ -70,6 +74,14 @@ class OpNansheGenerateDictionary(Operator):
 
         self.Input.notifyReady( self._checkConstraints )
 
+        # The dictionary is trained once for the whole input and shared by all requests.
+        # It is keyed by the generation of the input (increased whenever it is dirty),
+        # the input shape and the spams parameters.
+        self._lock = RequestLock()
+        self._generation = 0
+        self._dictionary = None
+        self._dictionaryKey = None
+
     def _checkConstraints(self, *args):
         slot = self.Input
 
@@ -137,66 +149,82 @@ class OpNansheGenerateDictionary(Operator):
 
         output_key = nanshe.util.iters.reformat_slices(output_key)
 
-        input_key = list(output_key)
-
-        input_key[0] = slice(0, self.Input.meta.shape[0], 1)
-        input_key.append(slice(0, 1, 1))
-
-        input_key = tuple(input_key)
-
-
-        output_key = list(output_key)
-
-        for i in xrange(1, len(output_key)):
-            output_key[i] = slice(0, output_key[i].stop - output_key[i].start, output_key[i].step)
+        dictionary = self._getDictionary()
 
-        output_key = tuple(output_key)
-
-        raw = self.Input[input_key].wait()
+        if slot.name == 'Output':
+            result[...] = dictionary[output_key]
+
+    def _parameters(self):
+        return {
+                   "K" : self.K.value,
+                   "gamma1" : self.Gamma1.value,
+                   "gamma2" : self.Gamma2.value,
+                   "numThreads" : self.NumThreads.value,
+                   "batchsize" : self.Batchsize.value,
+                   "iter" : self.NumIter.value,
+                   "lambda1" : self.Lambda1.value,
+                   "lambda2" : self.Lambda2.value,
+                   "posAlpha" : self.PosAlpha.value,
+                   "posD" : self.PosD.value,
+                   "clean" : self.Clean.value,
+                   "mode" : self.Mode.value,
+                   "modeD" : self.ModeD.value
+               }
+
+    def _currentKey(self, parameters):
+        return (self._generation, tuple(self.Input.meta.shape), tuple(sorted(parameters.items())))
+
+    def _getDictionary(self):
+        parameters = self._parameters()
+        key = self._currentKey(parameters)
+
+        with self._lock:
+            if self._dictionaryKey != key:
+                self._dictionary = self._trainDictionary(parameters, key)
+                self._dictionaryKey = key
+            return self._dictionary
+
+    def _trainDictionary(self, parameters, key):
+        raw = self.Input[...].wait()
         raw = raw[..., 0]
 
-        K = self.K.value
-        gamma1 = self.Gamma1.value
-        gamma2 = self.Gamma2.value
-        numThreads = self.NumThreads.value
-        batchsize = self.Batchsize.value
-        numIter = self.NumIter.value
-        lambda1 = self.Lambda1.value
-        lambda2 = self.Lambda2.value
-        posAlpha = self.PosAlpha.value
-        posD = self.PosD.value
-        clean = self.Clean.value
-        mode = self.Mode.value
-        modeD = self.ModeD.value
-
-        processed = nanshe.imp.segment.generate_dictionary(raw,
-                                                           **{ "spams.trainDL" :
-                                                                   {
-                                                                       "K" : K,
-                                                                       "gamma1" : gamma1,
-                                                                       "gamma2" : gamma2,
-                                                                       "numThreads" : numThreads,
-                                                                       "batchsize" : batchsize,
-                                                                       "iter" : numIter,
-                                                                       "lambda1" : lambda1,
-                                                                       "lambda2" : lambda2,
-                                                                       "posAlpha" : posAlpha,
-                                                                       "posD" : posD,
-                                                                       "clean" : clean,
-                                                                       "mode" : mode,
-                                                                       "modeD" : modeD
-                                                                   }
-                                                               }
-        )
-
-        if slot.name == 'Output':
-            result[...] = processed[output_key]
+        parameters = dict(parameters)
+
+        # Resume from the previous dictionary if it was trained on the same data
+        # with the same parameters, except for fewer iterations.
+        previous_key = self._dictionaryKey
+        if self.WarmStart.value and (previous_key is not None) and (previous_key[:2] == key[:2]):
+            previous_parameters = dict(previous_key[2])
+            remaining = parameters["iter"] - previous_parameters["iter"]
+            previous_parameters["iter"] = parameters["iter"]
+            if (previous_parameters == parameters) and (remaining > 0):
+                parameters["iter"] = remaining
+                # spams expects one atom per column
+                parameters["D"] = numpy.asfortranarray(
+                    self._dictionary.reshape(len(self._dictionary), -1).T.astype(raw.dtype)
+                )
+
+        return nanshe.imp.segment.generate_dictionary(raw, **{ "spams.trainDL" : parameters })
+
+    def restoreDictionary(self, dictionary):
+        """
+        Use the given (e.g. deserialized) dictionary for the current input and parameters.
+        """
+        with self._lock:
+            self._dictionary = dictionary
+            self._dictionaryKey = self._currentKey(self._parameters())
 
     def setInSlot(self, slot, subindex, roi, value):
         pass
 
     def propagateDirty(self, slot, subindex, roi):
-        if (slot.name == "Input") or (slot.name == "K") or (slot.name == "Gamma1") or (slot.name == "Gamma2") or\
+        if slot.name == "Input":
+            self._generation += 1
+
+        if slot.name == "WarmStart":
+            # Doesn't change the current dictionary.
+            pass
+        elif (slot.name == "Input") or (slot.name == "K") or (slot.name == "Gamma1") or (slot.name == "Gamma2") or\
             (slot.name == "NumThreads") or (slot.name == "Batchsize") or (slot.name == "NumIter") or\
             (slot.name == "Lambda1") or (slot.name == "Lambda2") or (slot.name == "PosAlpha") or\
             (slot.name == "PosD") or (slot.name == "Clean") or (slot.name == "Mode") or (slot.name == "ModeD"):
@@ -230,6 +258,7 @@ class OpNansheGenerateDictionaryCached(Operator):
     Clean = InputSlot(value=True)
     Mode = InputSlot(value=2, stype="int")
     ModeD = InputSlot(value=0, stype="int")
+    WarmStart = InputSlot(value=False, stype="bool")
 
     CleanBlocks = OutputSlot()
     Output = OutputSlot()
@@ -252,6 +281,7 @@ class OpNansheGenerateDictionaryCached(Operator):
         self.opDictionary.Clean.connect(self.Clean)
         self.opDictionary.Mode.connect(self.Mode)
         self.opDictionary.ModeD.connect(self.ModeD)
+        self.opDictionary.WarmStart.connect(self.WarmStart)
 
 
         self.opCache = OpArrayCache(parent=self)
@@ -270,5 +300,9 @@ class OpNansheGenerateDictionaryCached(Operator):
 
         self.opCache.setInSlot(self.opCache.Input, subindex, key, value)
 
+        # A stored dictionary also serves as the starting point for warm starts
+        if tuple(value.shape) == tuple(self.Output.meta.shape):
+            self.opDictionary.restoreDictionary(numpy.array(value))
+
     def propagateDirty(self, slot, subindex, roi):
         pass
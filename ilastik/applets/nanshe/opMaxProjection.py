@@ -26,11 +26,15 @@ __date__ = "$Nov 06, 2014 12:38:08 EST$"
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators.opBlockedArrayCache import OpBlockedArrayCache
 
+import numpy
+
 import vigra
 
 import nanshe
 import nanshe.util.iters
 
+from ilastik.applets.nanshe.streamingReduction import streaming_reduce, CHUNK_BYTES
+
 
 class OpMaxProjection(Operator):
     """
@@ -47,6 +51,9 @@ class OpMaxProjection(Operator):
 
     Output = OutputSlot()
 
+    # Size of the input chunks reduced at once
+    ChunkBytes = CHUNK_BYTES
+
     def __init__(self, *args, **kwargs):
         super( OpMaxProjection, self ).__init__( *args, **kwargs )
 
@@ -76,9 +83,10 @@ class OpMaxProjection(Operator):
         key[axis] = nanshe.util.iters.reformat_slice(key[axis], self.Input.meta.shape[axis])
         key = tuple(key)
 
-        raw = self.Input[key].wait()
-
-        processed = raw.max(axis=self.Axis.value)
+        processed = streaming_reduce(self.Input, key, axis,
+                                     lambda chunk, axis: chunk.max(axis=axis),
+                                     lambda accumulated, reduced: numpy.maximum(accumulated, reduced, out=accumulated),
+                                     chunk_bytes=self.ChunkBytes)
 
         if slot.name == 'Output':
             result[...] = processed
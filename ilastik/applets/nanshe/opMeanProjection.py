@@ -26,11 +26,15 @@ __date__ = "$Nov 12, 2014 15:20:09 EST$"
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators.opBlockedArrayCache import OpBlockedArrayCache
 
+import numpy
+
 import vigra
 
 import nanshe
 import nanshe.util.iters
 
+from ilastik.applets.nanshe.streamingReduction import streaming_reduce, CHUNK_BYTES
+
 
 class OpMeanProjection(Operator):
     """
@@ -47,6 +51,9 @@ class OpMeanProjection(Operator):
 
     Output = OutputSlot()
 
+    # Size of the input chunks reduced at once
+    ChunkBytes = CHUNK_BYTES
+
     def __init__(self, *args, **kwargs):
         super( OpMeanProjection, self ).__init__( *args, **kwargs )
 
@@ -76,9 +83,11 @@ class OpMeanProjection(Operator):
         key[axis] = nanshe.util.iters.reformat_slice(key[axis], self.Input.meta.shape[axis])
         key = tuple(key)
 
-        raw = self.Input[key].wait()
-
-        processed = raw.mean(axis=self.Axis.value)
+        processed = streaming_reduce(self.Input, key, axis,
+                                     lambda chunk, axis: chunk.sum(axis=axis, dtype=numpy.float64),
+                                     lambda accumulated, reduced: numpy.add(accumulated, reduced, out=accumulated),
+                                     chunk_bytes=self.ChunkBytes)
+        processed /= (key[axis].stop - key[axis].start)
 
         if slot.name == 'Output':
             result[...] = processed
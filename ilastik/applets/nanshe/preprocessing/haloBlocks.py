@@ -0,0 +1,147 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Block shapes for the blocked caches of the preprocessing operators that need a halo.
+
+Each block of such a cache is computed from its input padded by the halo, and
+everything computed in the padding is thrown away. So over the whole movie,
+each voxel of a stage is computed redundancy_factor() times. Larger blocks
+compute less in the padding, but the first request for a tile (e.g. in the
+viewer) has to wait until its whole padded block is computed. So the padded
+blocks are kept as small as those of the default block shape (see
+default_block_shape()), and within that limit the block shape with the least
+redundancy is chosen.
+"""
+
+import math
+import operator
+
+import numpy
+
+
+#: Maximum number of voxels in one cache block (256MB of float32)
+MAX_BLOCK_VOXELS = 64 * 1024**2
+
+#: Maximum number of blocks along an axis with halo that halo_block_shape() considers
+MAX_BLOCKS_PER_AXIS = 64
+
+
+def halo_of(halo_slicing, center_slicing):
+    """
+        Halo (per axis) of a stage, given the halo_slicing its compute_halo
+        returns for center_slicing.
+    """
+
+    return(tuple(each_center.start - each_halo.start for each_halo, each_center in zip(halo_slicing, center_slicing)))
+
+
+def default_block_shape(shape, halo, block_shape):
+    """
+        The given block shape, enlarged to at least the two-sided halo and
+        clipped to the data. (This is the block shape the caches used before.)
+    """
+
+    return(tuple(min(max(2*each_halo + 1, each_block_len), each_len)
+                 for each_len, each_halo, each_block_len in zip(shape, halo, block_shape)))
+
+
+def padded_voxels(shape, block_shape, halo):
+    """
+        Number of voxels in a block padded by the halo, i.e. what needs to be
+        computed for the first request of a block.
+    """
+
+    return(numpy.prod([min(each_block_len + 2*each_halo, each_len)
+                       for each_len, each_block_len, each_halo in zip(shape, block_shape, halo)], dtype=float))
+
+
+def _axis_redundancy(length, block_len, halo):
+    computed = 0
+    for each_start in xrange(0, length, block_len):
+        each_stop = min(each_start + block_len, length)
+        computed += min(each_stop + halo, length) - max(each_start - halo, 0)
+
+    return(float(computed) / length)
+
+
+def halo_block_shape(shape, halo, block_shape, max_block_voxels=MAX_BLOCK_VOXELS, max_padded_voxels=None):
+    """
+        Chooses the block shape with the least redundancy factor whose padded
+        blocks are not larger than max_padded_voxels (by default, those of
+        default_block_shape()).
+
+        Along each axis with halo, the data is split into 1 to MAX_BLOCKS_PER_AXIS
+        blocks of equal length. The other axes keep the given block extent.
+
+        Args:
+            shape(tuple of ints):                   shape of the data.
+            halo(tuple of ints):                    halo along each axis.
+            block_shape(tuple of ints):             default block extent along each axis.
+            max_block_voxels(int):                  maximum number of voxels in a block.
+            max_padded_voxels(int):                 maximum number of voxels in a padded block.
+
+        Returns:
+            tuple of ints: the block shape.
+    """
+
+    if max_padded_voxels is None:
+        max_padded_voxels = padded_voxels(shape, default_block_shape(shape, halo, block_shape), halo)
+
+    # Candidate extents along each axis, with their redundancy and padded extent
+    candidates = []
+    for each_len, each_halo, each_block_len in zip(shape, halo, block_shape):
+        if each_halo > 0:
+            extents = sorted(set(int(math.ceil(float(each_len) / k))
+                                 for k in xrange(1, min(each_len, MAX_BLOCKS_PER_AXIS) + 1)))
+        else:
+            extents = [min(each_block_len, each_len)]
+
+        candidates.append((numpy.array(extents, dtype=float),
+                           numpy.array([_axis_redundancy(each_len, each_extent, each_halo) for each_extent in extents]),
+                           numpy.array([min(each_extent + 2*each_halo, each_len) for each_extent in extents], dtype=float)))
+
+    # Evaluate all combinations at once
+    voxels = reduce(numpy.multiply.outer, [each[0] for each in candidates])
+    redundancy = reduce(numpy.multiply.outer, [each[1] for each in candidates])
+    padded = reduce(numpy.multiply.outer, [each[2] for each in candidates])
+
+    allowed = (voxels <= max_block_voxels) & (padded <= max_padded_voxels)
+    # There is always a fallback: the smallest blocks
+    allowed.flat[0] = True
+    redundancy = numpy.where(allowed, redundancy, numpy.inf)
+
+    # Least redundancy, then smallest padded blocks
+    best = numpy.lexsort((padded.ravel(), redundancy.ravel()))[0]
+    best = numpy.unravel_index(best, redundancy.shape)
+
+    return(tuple(int(each[0][i]) for each, i in zip(candidates, best)))
+
+
+def redundancy_factor(shape, block_shape, halo):
+    """
+        Number of voxels computed when all blocks (padded by the halo) are computed,
+        relative to the number of voxels in the data.
+    """
+
+    return(reduce(operator.mul,
+                  [_axis_redundancy(each_len, each_block_len, each_halo)
+                   for each_len, each_block_len, each_halo in zip(shape, block_shape, halo)],
+                  1.0))
@@ -235,7 +235,7 @@ class OpNansheExtractF0Cached(Operator):
         self.opCache_dF_F.Input.connect( self.opExtractF0.dF_F)
 
         self.F0.connect( self.opExtractF0.F0 )
-        self.dF_F.connect( self.opExtractF0.dF_F )
+        self.dF_F.connect( self.opCache_dF_F.Output )
 
     def setupOutputs(self):
         #TODO: This is a really ugly hack. It would be nice not to follow this surreptitious route.
@@ -31,6 +31,7 @@ from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators.opBlockedArrayCache import OpBlockedArrayCache
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.nanshe.preprocessing.haloBlocks import halo_of, halo_block_shape
 
 import numpy
 
@@ -251,20 +252,21 @@ class OpNansheWaveletTransformCached(Operator):
                                                             self.Scale.value)[0]
 
 
-        block_shape = nanshe.util.iters.len_slices(halo_slicing)
+        halo = halo_of(halo_slicing, halo_center_slicing)
 
-
-        block_shape = list(block_shape)
-
-        for i, each_axistag in enumerate(self.opWaveletTransform.Output.meta.axistags):
+        # Without halo, use the same block extent as the other preprocessing caches.
+        default_block_shape = []
+        for each_axistag, each_len in itertools.izip(self.opWaveletTransform.Output.meta.axistags,
+                                                     self.opWaveletTransform.Output.meta.shape):
             if each_axistag.isSpatial():
-                block_shape[i] = max(block_shape[i], 256)
+                each_len = 256
             elif each_axistag.isTemporal():
-                block_shape[i] = max(block_shape[i], 50)
+                each_len = 50
 
-            block_shape[i] = min(block_shape[i], self.opWaveletTransform.Output.meta.shape[i])
+            default_block_shape.append(each_len)
 
-        block_shape = tuple(block_shape)
+        # Blocks that compute as little as possible in the halo, but are not slower to show than the default ones
+        block_shape = halo_block_shape(self.opWaveletTransform.Output.meta.shape, halo, default_block_shape)
 
         self.opCache.innerBlockShape.setValue(block_shape)
         self.opCache.outerBlockShape.setValue(block_shape)
@@ -0,0 +1,89 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import threading
+from functools import partial
+
+import numpy
+
+from lazyflow.request import Request, RequestPool
+
+
+#: Maximum size of the input chunk requested for one partial reduction
+CHUNK_BYTES = 32 * 1024**2
+#: Maximum number of chunks requested at the same time
+MAX_PARALLEL_CHUNKS = 4
+
+
+def streaming_reduce(slot, key, axis, reduce_chunk, combine,
+                     chunk_bytes=CHUNK_BYTES, max_parallel=MAX_PARALLEL_CHUNKS):
+    """
+        Reduces slot[key] along axis without requesting the whole axis at once.
+
+        The axis is walked in chunks of at most chunk_bytes (but at least one
+        element along the axis). Each chunk is reduced with
+        reduce_chunk(chunk, axis) and the partial results are merged with
+        combine(accumulated, partial), which may work in place. At most
+        max_parallel chunks are in flight, so peak memory does not depend on
+        the length of the axis.
+
+        Args:
+            slot(InputSlot):         slot to read from.
+            key(tuple of slices):    region to reduce (step 1 along axis).
+            axis(int):               axis to reduce.
+            reduce_chunk(callable):  reduces a chunk along the axis.
+            combine(callable):       merges two partial results.
+
+        Returns:
+            the reduction of the whole region.
+    """
+
+    key = list(key)
+    axis_slice = key[axis]
+    assert axis_slice.step in (None, 1), "Only contiguous reductions are supported."
+
+    shape = [each_slice.stop - each_slice.start for each_slice in key]
+    shape[axis] = 1
+    slice_bytes = numpy.prod(shape) * numpy.dtype(slot.meta.dtype).itemsize
+    chunk_length = max(1, int(chunk_bytes // max(1, slice_bytes)))
+
+    lock = threading.Lock()
+    accumulated = []
+
+    def reduce_chunk_at(chunk_start):
+        chunk_key = list(key)
+        chunk_key[axis] = slice(chunk_start, min(chunk_start + chunk_length, axis_slice.stop))
+
+        reduced = reduce_chunk(slot[tuple(chunk_key)].wait(), axis)
+
+        with lock:
+            if accumulated:
+                accumulated[0] = combine(accumulated[0], reduced)
+            else:
+                accumulated.append(reduced)
+
+    chunk_starts = range(axis_slice.start, axis_slice.stop, chunk_length)
+    for i in xrange(0, len(chunk_starts), max_parallel):
+        pool = RequestPool()
+        for chunk_start in chunk_starts[i:i + max_parallel]:
+            pool.add(Request(partial(reduce_chunk_at, chunk_start)))
+        pool.wait()
+
+    return accumulated[0]
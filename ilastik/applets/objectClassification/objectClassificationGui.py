@@ -823,17 +823,23 @@ class ObjectClassificationGui(LabelingGui, ExportingGui):
         messages = {
             'full': "These labels were lost completely:",
             'partial': "These labels were lost partially:",
-            'conflict': "These new labels conflicted:"
+            'conflict': "These new labels conflicted:",
+            'unknown': "The objects of these labels were never computed, so they were lost:"
         }
         default_message = "These labels could not be transferred:"
+        # 'unknown' labels are given as (time step, object id)
+        headers = {
+            'unknown': (["T", "Object"], "{:<8}")
+        }
 
         _sep = "\t"
         cases = []
         for k, val in labels_lost.iteritems():
             if len(val) > 0:
                 msg = messages.get(k, default_message)
-                axis = _sep.join(["X", "Y", "Z"])
-                coords = "\n".join([_sep.join(["{:<8.1f}".format(i) for i in item])
+                header, fmt = headers.get(k, (["X", "Y", "Z"], "{:<8.1f}"))
+                axis = _sep.join(header)
+                coords = "\n".join([_sep.join([fmt.format(i) for i in item])
                                     for item in val])
                 cases.append("\n".join([msg, axis, coords]))
         box.setDetailedText("\n\n".join(cases))
@@ -19,11 +19,10 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 import numpy
-import numpy.lib.recfunctions as rfn
 import vigra
 import time
 import warnings
-import itertools
+import threading
 from collections import defaultdict
 from functools import partial
 
@@ -89,7 +88,7 @@ class OpObjectClassification(Operator, ExportingOperator,MultiLaneOperatorABC):
     LabelInputs = InputSlot(stype=Opaque, rtype=List, optional=True, level=1)
     
     FreezePredictions = InputSlot(stype='bool', value=False)
-    EnableLabelTransfer = InputSlot(stype='bool', value=False)
+    EnableLabelTransfer = InputSlot(stype='bool', value=True)
 
     # for reading from disk
     InputProbabilities = InputSlot(level=1, stype=Opaque, rtype=List, optional=True)
@@ -376,6 +375,21 @@ class OpObjectClassification(Operator, ExportingOperator,MultiLaneOperatorABC):
             self._ambiguousLabels[subindex[0]] = self.LabelInputs[subindex[0]].value
             self._needLabelTransfer = True
 
+            # Bounding boxes that are still being computed may already see the new segmentation.
+            bboxes = self._labelBBoxes[subindex[0]]
+            for timeCoord, entry in bboxes.items():
+                if isinstance(entry, Request) and not entry.finished:
+                    entry.cancel()
+                    del bboxes[timeCoord]
+        elif slot==self.LabelInputs and not self._needLabelTransfer:
+            # Labels that were set from outside (e.g. loaded from the project file):
+            #  remember the objects they belong to, too.
+            imageIndex = subindex[0]
+            if imageIndex < len(self._labelBBoxes) and self.LabelInputs[imageIndex].ready():
+                for timeCoord, labels in self.LabelInputs[imageIndex].value.items():
+                    if numpy.any(labels) and timeCoord not in self._labelBBoxes[imageIndex]:
+                        self._requestLabelBBoxes(imageIndex, timeCoord)
+
 
     def assignObjectLabel(self, imageIndex, coordinate, assignedLabel):
         """
@@ -405,54 +419,102 @@ class OpObjectClassification(Operator, ExportingOperator,MultiLaneOperatorABC):
         labelslot.setValue(labelsdict)
         labelslot.setDirty([(timeCoord, objIndex)])
 
-        #Fill the cache of label bounding boxes, if it was empty
-        # FIXME: TRANSFER LABELS:
-        #        Apparently this code was required for triggerTransferLabels(),
-        #        But it has the unfortunate effect of synchronously computing the object features for the current image
-        #        as soon as the user has clicked her first label.  It causes quite a noticeable lag!
-#         if len(self._labelBBoxes[imageIndex].keys())==0:
-#             #it's the first label for this image
-#             feats = self.ObjectFeatures[imageIndex]([timeCoord]).wait()
-# 
-#             #the bboxes should be the same for all channels
-#             mins = feats[timeCoord][default_features_key]["Coord<Minimum>"]
-#             maxs = feats[timeCoord][default_features_key]["Coord<Maximum>"]
-#             bboxes = dict()
-#             bboxes["Coord<Minimum>"] = mins
-#             bboxes["Coord<Maximum>"] = maxs
-#             self._labelBBoxes[imageIndex][timeCoord]=bboxes
+        # Remember the bounding boxes of the labeled objects, so the labels
+        #  can be transferred if the segmentation changes (see triggerTransferLabels()).
+        if timeCoord not in self._labelBBoxes[imageIndex]:
+            self._requestLabelBBoxes(imageIndex, timeCoord)
+
+    def _requestLabelBBoxes(self, imageIndex, timeCoord):
+        """
+        Start computing the object bounding boxes of the given time step in the
+        background, so that labeling doesn't lag.  Until they are needed (see
+        _waitLabelBBoxes()), self._labelBBoxes holds the request.
+        """
+        if not self.EnableLabelTransfer.value or imageIndex >= len(self.ObjectFeatures) \
+           or not self.ObjectFeatures[imageIndex].ready():
+            return
+        req = self.ObjectFeatures[imageIndex]([timeCoord])
+        self._labelBBoxes[imageIndex][timeCoord] = req
+        req.submit()
+
+    def _waitLabelBBoxes(self, imageIndex, timeCoord):
+        """
+        Return the stored object bounding boxes of the given time step, waiting
+        for them if they are still being computed.  Returns None if they are
+        not known.
+        """
+        entry = self._labelBBoxes[imageIndex].get(timeCoord)
+        if isinstance(entry, Request):
+            try:
+                feats = entry.wait()
+            except Exception as ex:
+                logger.warn( "Could not compute the objects of the labels in time step {}: {}".format( timeCoord, ex ) )
+                entry = None
+            else:
+                entry = { "Coord<Minimum>" : feats[timeCoord][default_features_key]["Coord<Minimum>"],
+                          "Coord<Maximum>" : feats[timeCoord][default_features_key]["Coord<Maximum>"] }
+            self._labelBBoxes[imageIndex][timeCoord] = entry
+        return entry
 
     def triggerTransferLabels(self, imageIndex):
-        # FIXME: This function no longer works, partly thanks to the code commented out above.  See "FIXME: TRANSFER LABELS"
+        """
+        Transfer the labels to the objects of a changed segmentation.
+
+        Returns None if there was nothing to transfer, otherwise
+        (labels, old_labels_lost, new_labels_lost).  Labels whose objects
+        were never computed can't be transferred; they are listed as
+        (time step, object id) in old_labels_lost["unknown"].
+        """
         if not self._needLabelTransfer:
             return None
         if not self.SegmentationImages[imageIndex].ready():
             return None
-        if len(self._labelBBoxes[imageIndex].keys())==0:
-            #we either don't have any labels or we just read the project from file
-            #nothing to transfer
+        if not self.EnableLabelTransfer.value:
+            # Keep the labels as they are
             self._needLabelTransfer = False
             return None
-        if not self.EnableLabelTransfer:
-            self._resetLabelInputs(imageIndex)
+        old_labels = self._ambiguousLabels[imageIndex]
+        if old_labels is None or not any( numpy.any(l) for l in old_labels.values() ):
+            #nothing to transfer
             self._needLabelTransfer = False
             return None
 
+        logger.info("Transferring labels to the new segmentation. This might take a while...")
         labels = dict()
+        old_labels_lost = { "full" : [], "partial" : [], "unknown" : [] }
+        new_labels_lost = { "conflict" : [] }
         for timeCoord in range(self.SegmentationImages[imageIndex].meta.shape[0]):
+            if not numpy.any(old_labels.get(timeCoord, 0)):
+                # No labels in this time step
+                labels[timeCoord] = numpy.zeros((2,))
+                self._labelBBoxes[imageIndex].pop(timeCoord, None)
+                continue
+
+            old_bboxes = self._waitLabelBBoxes(imageIndex, timeCoord)
+            if old_bboxes is None:
+                # We don't know where the labeled objects were
+                for objIndex in numpy.flatnonzero(old_labels[timeCoord]):
+                    old_labels_lost["unknown"].append( (timeCoord, int(objIndex)) )
+                labels[timeCoord] = numpy.zeros((2,))
+                self._labelBBoxes[imageIndex].pop(timeCoord, None)
+                continue
+
             #we have to get new object features to get bounding boxes
-            logger.info("Transferring labels to the new segmentation. This might take a while...")
             new_feats = self.ObjectFeatures[imageIndex]([timeCoord]).wait()
             coords = dict()
             coords["Coord<Minimum>"] = new_feats[timeCoord][default_features_key]["Coord<Minimum>"]
             coords["Coord<Maximum>"] = new_feats[timeCoord][default_features_key]["Coord<Maximum>"]
             #FIXME: pass axistags
-            new_labels, old_labels_lost, new_labels_lost = self.transferLabels(
+            new_labels, old_lost, new_lost = self.transferLabels(
                 self._ambiguousLabels[imageIndex][timeCoord],
-                self._labelBBoxes[imageIndex][timeCoord],
+                old_bboxes,
                 coords
             )
             labels[timeCoord] = new_labels
+            for key in old_lost:
+                old_labels_lost[key] += old_lost[key]
+            for key in new_lost:
+                new_labels_lost[key] += new_lost[key]
 
             self._labelBBoxes[imageIndex][timeCoord]=coords
             self._ambiguousLabels[imageIndex][timeCoord]=numpy.zeros((2,)) #initialize ambig. labels as normal labels
@@ -460,17 +522,103 @@ class OpObjectClassification(Operator, ExportingOperator,MultiLaneOperatorABC):
         self.LabelInputs[imageIndex].setValue(labels)
         self._needLabelTransfer = False
 
-        return new_labels, old_labels_lost, new_labels_lost
+        return labels, old_labels_lost, new_labels_lost
+
+    @staticmethod
+    def overlappingBBoxes(mins_a, maxs_a, mins_b, maxs_b):
+        """
+        Find all pairs of overlapping bounding boxes between two sets of boxes.
+
+        Boxes overlap if they overlap along every axis with a positive length.
+        The candidate pairs are found with a regular grid whose cells are at
+        least as large as the largest box in set b: each box of set b is filed
+        under the cell of its minimum corner, so only the boxes filed under the
+        cells from (min_a - cell size) to max_a can overlap box a.
+        The cells are also at least as large as the median box of set a, and
+        boxes of set a that would still span more cells than there are boxes
+        in set b are compared with every box of set b directly.
+
+        :returns: (index_a, index_b, overlap), where overlap is the product
+                  over all axes of (r_a + r_b - |c_a - c_b|), with the box
+                  radii r and centers c.
+        """
+        mins_a = numpy.asarray(mins_a, dtype=numpy.float64)
+        maxs_a = numpy.asarray(maxs_a, dtype=numpy.float64)
+        mins_b = numpy.asarray(mins_b, dtype=numpy.float64)
+        maxs_b = numpy.asarray(maxs_b, dtype=numpy.float64)
+        empty = ( numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,)) )
+        if len(mins_a) == 0 or len(mins_b) == 0:
+            return empty
+
+        def expand(starts, counts):
+            # For each i, the indices starts[i], ..., starts[i]+counts[i]-1,
+            #  together with the corresponding i.
+            total = counts.sum()
+            owner = numpy.repeat(numpy.arange(len(counts)), counts)
+            offsets = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            return owner, numpy.repeat(starts, counts) + numpy.arange(total) - offsets
+
+        # File the boxes of set b under their grid cells
+        origin = mins_b.min(axis=0)
+        cell_size = numpy.maximum( (maxs_b - mins_b).max(axis=0), numpy.median(maxs_a - mins_a, axis=0) )
+        cell_size = numpy.maximum( cell_size, 1 )
+        grid_shape = numpy.floor( (mins_b.max(axis=0) - origin) / cell_size ).astype(numpy.int64) + 1
+        cells_b = numpy.ravel_multi_index( numpy.floor( (mins_b - origin) / cell_size ).astype(numpy.int64).T, grid_shape )
+        order = numpy.argsort(cells_b, kind='mergesort')
+        sorted_cells_b = cells_b[order]
+
+        # The range of cells to search for each box of set a
+        first_cell = numpy.floor( (mins_a - cell_size - origin) / cell_size ).astype(numpy.int64)
+        last_cell = numpy.floor( (maxs_a - origin) / cell_size ).astype(numpy.int64)
+        first_cell = numpy.maximum(first_cell, 0)
+        last_cell = numpy.minimum(last_cell, grid_shape - 1)
+        extent = numpy.maximum(last_cell - first_cell + 1, 0)
+        ncells = numpy.prod(extent, axis=1)
+
+        # Boxes that span more cells than there are boxes in set b are
+        #  cheaper (and safer for memory) to compare with all of set b.
+        large = ncells > len(mins_b)
+        ncells[large] = 0
+
+        # Enumerate the cells of each range: cell k of box i is found by mixed-radix decoding
+        index_a, k = expand( numpy.zeros(len(mins_a), dtype=numpy.int64), ncells )
+        coords = numpy.empty( (len(index_a), mins_a.shape[1]), dtype=numpy.int64 )
+        for axis in reversed(range(mins_a.shape[1])):
+            coords[:, axis] = first_cell[index_a, axis] + k % extent[index_a, axis]
+            k //= extent[index_a, axis]
+        cells = numpy.ravel_multi_index( coords.T, grid_shape )
+
+        # All boxes of set b in those cells are candidates
+        starts = numpy.searchsorted(sorted_cells_b, cells, side='left')
+        stops = numpy.searchsorted(sorted_cells_b, cells, side='right')
+        owner, positions = expand(starts, stops - starts)
+        index_a = [ index_a[owner] ]
+        index_b = [ order[positions] ]
+
+        for i in numpy.flatnonzero(large):
+            hits = numpy.flatnonzero( ((mins_b < maxs_a[i]) & (maxs_b > mins_a[i])).all(axis=1) )
+            index_a.append( numpy.repeat(i, len(hits)) )
+            index_b.append( hits )
+        index_a = numpy.concatenate(index_a)
+        index_b = numpy.concatenate(index_b)
+        if len(index_a) == 0:
+            return empty
+
+        rad_a = 0.5*(maxs_a - mins_a)
+        rad_b = 0.5*(maxs_b - mins_b)
+        over = rad_a[index_a] + rad_b[index_b] \
+               - numpy.abs( (mins_a + rad_a)[index_a] - (mins_b + rad_b)[index_b] )
+        valid = (over > 0).all(axis=1)
+        return index_a[valid], index_b[valid], numpy.prod(over[valid], axis=1)
 
     @staticmethod
     def transferLabels(old_labels, old_bboxes, new_bboxes, axistags = None):
         #transfer labels from old segmentation to new segmentation
 
-        mins_old = old_bboxes["Coord<Minimum>"]
-        maxs_old = old_bboxes["Coord<Maximum>"]
-        mins_new = new_bboxes["Coord<Minimum>"]
-        maxs_new = new_bboxes["Coord<Maximum>"]
-        nobj_old = mins_old.shape[0]
+        mins_old = numpy.asarray(old_bboxes["Coord<Minimum>"])
+        maxs_old = numpy.asarray(old_bboxes["Coord<Maximum>"])
+        mins_new = numpy.asarray(new_bboxes["Coord<Minimum>"])
+        maxs_new = numpy.asarray(new_bboxes["Coord<Maximum>"])
         nobj_new = mins_new.shape[0]
         if axistags is None:
             axistags = "xyz"
@@ -478,83 +626,59 @@ class OpObjectClassification(Operator, ExportingOperator,MultiLaneOperatorABC):
         data2D = False
         if mins_old.shape[1]==2:
             data2D = True
-        class bbox():
-            def __init__(self, minmaxs, axistags):
-                self.xmin = minmaxs[0][axistags.index('x')]
-                self.ymin = minmaxs[0][axistags.index('y')]
-                if not data2D:
-                    self.zmin = minmaxs[0][axistags.index('z')]
-                else:
-                    self.zmin = 0
-                self.xmax = minmaxs[1][axistags.index('x')]
-                self.ymax = minmaxs[1][axistags.index('y')]
-                if not data2D:
-                    self.zmax = minmaxs[1][axistags.index('z')]
-                else:
-                    self.zmax = 0
-                self.rad_x = 0.5*(self.xmax - self.xmin)
-                self.cent_x = self.xmin+self.rad_x
-                self.rad_y = 0.5*(self.ymax-self.ymin)
-                self.cent_y = self.ymin+self.rad_y
-                self.rad_z = 0.5*(self.zmax-self.zmin)
-                self.cent_z = self.zmin+self.rad_z
-
-            @staticmethod
-            def overlap(bbox_tuple):
-                this = bbox_tuple[0]
-                that = bbox_tuple[1]
-                over_x = this.rad_x+that.rad_x - (abs(this.cent_x-that.cent_x))
-                over_y = this.rad_y+that.rad_y - (abs(this.cent_y-that.cent_y))
-                over_z = this.rad_z+that.rad_z - (abs(this.cent_z-that.cent_z))
-                if not data2D:
-                    if over_x>0 and over_y>0 and over_z>0:
-                        return over_x*over_y*over_z
-                else:
-                    if over_x>0 and over_y>0:
-                        return over_x*over_y
-                return 0
+        axes = [ axistags.index(a) for a in ('xy' if data2D else 'xyz') ]
+
+        def centers(mins, maxs):
+            # Reported as (x, y, z), with z=0 for 2D data
+            cent = numpy.zeros((len(mins), 3))
+            cent[:, :len(axes)] = mins[:, axes] + 0.5*(maxs[:, axes] - mins[:, axes])
+            return cent
 
         nonzeros = numpy.nonzero(old_labels)[0]
-        bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
-        bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
+        mins_old = mins_old[nonzeros][:, axes]
+        maxs_old = maxs_old[nonzeros][:, axes]
 
         #remove background
         #FIXME: assuming background is 0 again
-        bboxes_new = bboxes_new[1:]
-
-        double_for_loop = itertools.product(bboxes_old, bboxes_new)
-        overlaps = map(bbox.overlap, double_for_loop)
+        index_old, index_new, overlaps = OpObjectClassification.overlappingBBoxes(
+            mins_old, maxs_old, mins_new[1:][:, axes], maxs_new[1:][:, axes] )
 
-        overlaps = numpy.asarray(overlaps)
-        overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
         new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
         old_labels_lost = dict()
         old_labels_lost["full"]=[]
         old_labels_lost["partial"]=[]
         new_labels_lost = dict()
         new_labels_lost["conflict"]=[]
-        for iobj in range(overlaps.shape[0]):
-            #take the object with maximum overlap
-            overlapsum = numpy.sum(overlaps[iobj, :])
-            if overlapsum==0:
-                old_labels_lost["full"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-                continue
-            newindex = numpy.argmax(overlaps[iobj, :])
-            if overlapsum-overlaps[iobj,newindex]>0:
+
+        #take the new object with maximum overlap (the first one, in case of ties)
+        order = numpy.lexsort( (index_new, -overlaps, index_old) )
+        index_old, index_new, overlaps = index_old[order], index_new[order], overlaps[order]
+        first = numpy.ones(len(index_old), dtype=bool)
+        first[1:] = index_old[1:] != index_old[:-1]
+        best_old = index_old[first]
+        best_new = index_new[first]
+
+        overlapsum = numpy.bincount(index_old, weights=overlaps, minlength=len(nonzeros))
+        best_overlap = numpy.zeros(len(nonzeros))
+        best_overlap[best_old] = overlaps[first]
+
+        cent_old = centers(mins_old, maxs_old)
+        for iobj in range(len(nonzeros)):
+            if overlapsum[iobj]==0:
+                old_labels_lost["full"].append(tuple(cent_old[iobj]))
+            elif overlapsum[iobj]-best_overlap[iobj]>0:
                 #this object overlaps with more than one new object
-                old_labels_lost["partial"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
+                old_labels_lost["partial"].append(tuple(cent_old[iobj]))
 
-            overlaps[iobj, :] = 0
-            overlaps[iobj, newindex] = 1 #doesn't matter what number>0
+        # New objects that are the best match of exactly one labeled object get its label
+        nmatches = numpy.bincount(best_new, minlength=nobj_new-1) if nobj_new > 1 else numpy.zeros((0,), dtype=int)
+        unique = nmatches[best_new] == 1
+        new_labels[best_new[unique]+1] = old_labels[nonzeros[best_old[unique]]] #+1 because of the background
 
-        for iobj in range(overlaps.shape[1]):
-            labels = numpy.where(overlaps[:, iobj]>0)[0]
-            if labels.shape[0]==1:
-                new_labels[iobj+1]=old_labels[nonzeros[labels[0]]] #iobj+1 because of the background
-            elif labels.shape[0]>1:
-                new_labels_lost["conflict"].append((bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z))
+        cent_new = centers(mins_new[1:], maxs_new[1:])
+        for iobj in numpy.flatnonzero(nmatches > 1):
+            new_labels_lost["conflict"].append(tuple(cent_new[iobj]))
 
-        new_labels = new_labels
         new_labels[0]=0 #FIXME: hardcoded background value again
         return new_labels, old_labels_lost, new_labels_lost
 
@@ -1004,6 +1128,14 @@ class OpObjectPredict(Operator):
 
     #SegmentationThreshold = 0.5
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.prob_cache = dict()
+        self.bad_objects = dict()
+        self._pending = dict()
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
@@ -1030,9 +1162,20 @@ class OpObjectPredict(Operator):
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
 
-        self.lock = RequestLock()
-        self.prob_cache = dict()
-        self.bad_objects = dict()
+        self._resetCache()
+
+    def _resetCache(self, prob_cache=None):
+        # prob_cache[t] and bad_objects[t] hold the results of finished time steps,
+        # _pending[t] the request of a time step that is being predicted.
+        # Probabilities restored from the project (InputProbabilities) come without
+        # bad objects; those are found from the features when they are first needed.
+        # The generation identifies the current classifier/features, so that
+        # predictions that finish after they were invalidated are not cached.
+        with self._lock:
+            self.prob_cache = prob_cache if prob_cache is not None else dict()
+            self.bad_objects = dict()
+            self._pending = dict()
+            self._generation += 1
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -1047,159 +1190,210 @@ class OpObjectPredict(Operator):
             times = range(self.Predictions.meta.shape[0])
 
         if slot is self.CachedProbabilities:
-            return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            with self._lock:
+                return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
 
         classifier = self.Classifier.value
         if classifier is None:
             # this happens if there was no data to train with
             return dict((t, numpy.array([])) for t in times)
 
-        feats = {}
-        prob_predictions = {}
-
         selected = self.SelectedFeatures([]).wait()
 
-        def get_num_objects(extracted_features):
-            n = 0
-            for group, feature_dict in extracted_features.items():
-                for feature_name, feature_matrix in feature_dict.items():
-                    n = max(n, len(feature_matrix))
-            return n
-
-        # FIXME: self.prob_cache is shared, so we need to block.
-        # However, this makes prediction single-threaded.
-        with self.lock:
-            for t in times:
+        # Each time step is predicted only once: requests for a time step that is
+        # already being predicted wait for the same request.
+        # Different time steps are predicted in parallel.
+        results = {}
+        requests = {}
+        restored = {}
+        for t in times:
+            with self._lock:
                 if t in self.prob_cache:
+                    if t in self.bad_objects:
+                        results[t] = (self.prob_cache[t], self.bad_objects[t])
+                    else:
+                        restored[t] = (self.prob_cache[t], self._generation)
                     continue
+                if t not in self._pending:
+                    logger.debug("Predicting object probabilities for time step: {}".format( t ))
+                    self._pending[t] = Request( partial(self._predictTimestep, t, classifier, selected, self._generation) )
+                requests[t] = self._pending[t]
+            requests[t].submit()
+
+        for t, (probs, generation) in restored.iteritems():
+            results[t] = (probs, self._findBadObjects(t, selected, generation))
+
+        for t, req in requests.iteritems():
+            results[t] = req.wait()
+
+        # results is a dict of (probabilities, bad objects), indexed by time.
+        # The probabilities are indexed as follows: probs[object_index, class_index]
+        if slot == self.Probabilities:
+            return { t : results[t][0] for t in times }
+        elif slot == self.Predictions:
+            # FIXME: Support SegmentationThreshold again...
+            labels = dict()
+            for t in times:
+                labels[t] = 1 + numpy.argmax(results[t][0], axis=1)
+                labels[t][0] = 0 # Background gets the zero label
+            
+            return labels
 
-                # Initialize with a single value for the 'background object '
-                prob_predictions[t] = numpy.zeros( (1, len(self.ProbabilityChannels)), dtype=numpy.float32 )
-                tmpfeats = self.Features([t]).wait()
-                num_objects = get_num_objects(tmpfeats[t])
+        elif slot == self.ProbabilityChannels:
+            try:
+                prob_single_channel = {t: results[t][0][:, subindex[0]]
+                                       for t in times}
+            except:
+                # no probabilities available for this class; return zeros
+                prob_single_channel = {t: numpy.zeros((results[t][0].shape[0], 1))
+                                       for t in times}
+            return prob_single_channel
 
-                # Apparently self.Features always returns a background object, 
-                #  so we expect at least 1 object in the list, even if there's nothing to predict.
-                assert num_objects > 0
-                if num_objects == 1:
-                    continue
-                    
-                ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
-                rows, cols = replace_missing(ftmatrix)
-                self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-                self.bad_objects[t][rows] = 1
-                feats[t] = ftmatrix
-
-            # Are there any objects to predict?
-            if len(feats) > 0:
-                def predict_forest(_t):
-                    # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
-                    #        and we have to average the PROBABILITIES from all forests.
-                    #       Averaging the label predictions from each forest is NOT equivalent.
-                    #       For details please see wikipedia:
-                    #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
-                    #       (^-^)
-                    prob_predictions[_t] = classifier.predict_probabilities(feats[_t].astype(numpy.float32))
-    
-                # predict the data with all the forests in parallel
-                pool = RequestPool()
-                for t in times:
-                    if t in self.prob_cache:
-                        continue
-                    logger.debug("Predicting object probabilities for time step: {}".format( t ))
-                    req = Request( partial(predict_forest, t) )
-                    pool.add(req)
-    
-                pool.wait()
-                pool.clean()
+        elif slot == self.BadObjects:
+            return { t : results[t][1] for t in times }
 
-            for t in times:
-                if t not in self.prob_cache:
-                    # prob_predictions is a dict-of-arrays, indexed as follows:
-                    # prob_predictions[t][object_index, class_index]
-                    self.prob_cache[t] = prob_predictions[t]
-                    self.prob_cache[t][0] = 0 # Background probability is always zero
-
-
-            if slot == self.Probabilities:
-                return { t : self.prob_cache[t] for t in times }
-            elif slot == self.Predictions:
-                # FIXME: Support SegmentationThreshold again...
-                labels = dict()
-                for t in times:
-                    prob_sum = numpy.sum(self.prob_cache[t], axis=1)
-                    labels[t] = 1 + numpy.argmax(self.prob_cache[t], axis=1)
-                    labels[t][0] = 0 # Background gets the zero label
-                
-                return labels
+        else:
+            assert False, "Unknown input slot"
+
+    def _predictTimestep(self, t, classifier, selected, generation):
+        """
+        Predict the probabilities of all objects in time step t and cache them,
+        unless the cache was reset in the meantime.
+        Returns a tuple (probabilities, bad_objects).
+        """
+        try:
+            # Initialize with a single value for the 'background object '
+            probs = numpy.zeros( (1, len(self.ProbabilityChannels)), dtype=numpy.float32 )
+            ftmatrix, bad_objects = self._featureMatrix(t, selected)
+
+            if ftmatrix is not None:
+                # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
+                #        and we have to average the PROBABILITIES from all forests.
+                #       Averaging the label predictions from each forest is NOT equivalent.
+                #       For details please see wikipedia:
+                #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
+                #       (^-^)
+                probs = classifier.predict_probabilities(ftmatrix.astype(numpy.float32))
+            probs[0] = 0 # Background probability is always zero
+
+            with self._lock:
+                if generation == self._generation:
+                    self.prob_cache[t] = probs
+                    self.bad_objects[t] = bad_objects
+            return (probs, bad_objects)
+        finally:
+            with self._lock:
+                if generation == self._generation:
+                    del self._pending[t]
+
+    def _findBadObjects(self, t, selected, generation):
+        """
+        Find the bad objects of time step t (for probabilities restored from
+        the project file) and cache them, unless the cache was reset in the meantime.
+        """
+        _, bad_objects = self._featureMatrix(t, selected)
+        with self._lock:
+            if generation == self._generation:
+                self.bad_objects[t] = bad_objects
+        return bad_objects
 
-            elif slot == self.ProbabilityChannels:
-                try:
-                    prob_single_channel = {t: self.prob_cache[t][:, subindex[0]]
-                                           for t in times}
-                except:
-                    # no probabilities available for this class; return zeros
-                    prob_single_channel = {t: numpy.zeros((self.prob_cache[t].shape[0], 1))
-                                           for t in times}
-                return prob_single_channel
+    def _featureMatrix(self, t, selected):
+        """
+        Returns a tuple (feature matrix, bad_objects) for time step t.
+        The feature matrix is None if there are no objects to predict.
+        Missing values in the matrix are replaced, and bad_objects marks those rows.
+        """
+        tmpfeats = self.Features([t]).wait()
 
-            elif slot == self.BadObjects:
-                return { t : self.bad_objects[t] for t in times }
+        # Apparently self.Features always returns a background object, 
+        #  so we expect at least 1 object in the list, even if there's nothing to predict.
+        num_objects = 0
+        for group, feature_dict in tmpfeats[t].items():
+            for feature_name, feature_matrix in feature_dict.items():
+                num_objects = max(num_objects, len(feature_matrix))
+        assert num_objects > 0
 
-            else:
-                assert False, "Unknown input slot"
+        if num_objects == 1:
+            return None, numpy.zeros((1,))
+
+        ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
+        rows, cols = replace_missing(ftmatrix)
+        bad_objects = numpy.zeros((ftmatrix.shape[0],))
+        bad_objects[rows] = 1
+        return ftmatrix, bad_objects
 
     def propagateDirty(self, slot, subindex, roi):
-        self.prob_cache = {}
+        prob_cache = None
         if slot is self.InputProbabilities:
-            self.prob_cache = self.InputProbabilities([]).wait()
+            prob_cache = self.InputProbabilities([]).wait()
+        self._resetCache(prob_cache)
         self.Predictions.setDirty(())
         self.Probabilities.setDirty(())
         self.ProbabilityChannels.setDirty(())
 
-    def createExportTable(self, roi):
+    def exportTableLayout(self):
+        """
+        Layout of the export table: the feature columns (see
+        OpObjectExtraction.exportTableLayout()), then the prediction and one
+        probability column per class.  It is the same for all time steps,
+        including those without objects or predictions, so that tables of
+        single time steps can be appended to each other.
+        Returns (dtype, columns, prediction field, first probability field, number of classes).
+        """
+        # All time steps have the same features (at least for the background object)
+        features = self.Features([0]).wait()[0]
+        dtype_names, dtype_types, columns = OpObjectExtraction.exportTableLayout(features)
+        pred_field = len(dtype_names)
+        dtype_names.append('Prediction')
+        dtype_types.append(numpy.dtype(numpy.uint8))
+        nclasses = len(self.ProbabilityChannels)
+        prob_field = len(dtype_names)
+        for ich in range(nclasses):
+            dtype_names.append('Probability of class %d'%ich)
+            dtype_types.append(numpy.dtype(numpy.float32))
+        dtype = numpy.dtype({'names': dtype_names, 'formats': dtype_types})
+        return dtype, columns, pred_field, prob_field, nclasses
+
+    def createExportTable(self, roi, layout=None):
+        """
+        Export table of the time steps in roi (all if empty), with the given
+        layout (see exportTableLayout()).  Objects without predictions get
+        zeros in the prediction and probability columns.
+        """
         if not self.Predictions.ready() or not self.Features.ready():
             return None
-        
+        if layout is None:
+            layout = self.exportTableLayout()
+        dtype, columns, pred_field, prob_field, nclasses = layout
+
         features = self.Features(roi).wait()
-        feature_table = OpObjectExtraction.createExportTable(features)
         predictions = self.Predictions(roi).wait()
         probs = self.Probabilities(roi).wait()
-        nobjs = []
-        for t, preds in predictions.iteritems():
-            nobjs.append(preds.shape[0])
-        nobjs_total = sum(nobjs)
-        if nobjs_total==0:
-            logger.info("Prediction not run yet, won't be exported")
-            return feature_table
-        else:
-            assert nobjs_total==feature_table.shape[0]
-            
-            def fill_column(slot_value, column, name, channel=None):
-                start = 0
-                finish = start
-                for t, values in slot_value.iteritems():
-                    #FIXME: remove the first object, it's always background
-                    finish = start + nobjs[t]
-                    if channel is None:
-                        column[name][start:finish] = values[:]
-                    else:
-                        column[name][start:finish] = values[:, channel]
-                    start = finish
-                    
-            pred_column = numpy.zeros(nobjs_total, {'names': ['Prediction'], 'formats': [numpy.dtype(numpy.uint8)]})
-            fill_column(predictions, pred_column, "Prediction")
-            joint_table = rfn.merge_arrays((feature_table, pred_column), flatten = True, usemask = False)
-            nchannels = probs[0].shape[-1]
-            columns = [feature_table, pred_column]
-            for ich in range(nchannels):
-                prob_column = numpy.zeros(nobjs_total, {'names': ['Probability of class %d'%ich], \
-                                                      'formats': [numpy.dtype(numpy.float32)]})
-                fill_column(probs, prob_column, 'Probability of class %d'%ich, ich)
-                columns.append(prob_column)
-                
-            joint_table = rfn.merge_arrays(columns, flatten = True, usemask = False)
-            return joint_table
+
+        # Preallocate the joint table (features, prediction, probabilities)
+        # instead of merging separately allocated columns.
+        times = sorted(features.keys())
+        nobjs = [features[t].values()[0].values()[0].shape[0] for t in times]
+        joint_table = numpy.zeros(sum(nobjs), dtype=dtype)
+        OpObjectExtraction.fillExportTable(joint_table, features, columns)
+
+        pred_block = OpObjectExtraction.exportTableColumnBlock(joint_table, pred_field, 1)
+        prob_block = OpObjectExtraction.exportTableColumnBlock(joint_table, prob_field, nclasses)
+        start = 0
+        for t, nobjs_t in zip(times, nobjs):
+            finish = start + nobjs_t
+            if len(predictions.get(t, ())) == 0:
+                logger.info("Prediction not run yet for time step {}, exporting it without".format(t))
+            else:
+                # The feature rows must line up with the prediction rows
+                assert predictions[t].shape[0] == nobjs_t, \
+                    "Features of {} objects, but predictions of {} at time step {}".format(nobjs_t, predictions[t].shape[0], t)
+                #FIXME: remove the first object, it's always background
+                pred_block[start:finish, 0] = numpy.asarray(predictions[t]).reshape(-1)
+                # Classes without any labels may be missing from the probabilities
+                prob_block[start:finish, :probs[t].shape[-1]] = probs[t]
+            start = finish
+        return joint_table
 
 
 
@@ -1219,9 +1413,58 @@ class OpRelabelSegmentation(Operator):
     loggingName = __name__ + ".OpRelabelSegmentation"
     logger = logging.getLogger(loggingName)
 
+    def __init__(self, *args, **kwargs):
+        super(OpRelabelSegmentation, self).__init__(*args, **kwargs)
+        # Lookup tables (object id -> output value) per time step
+        self._luts = {}
+        self._lutLock = threading.Lock()
+        # Incremented whenever tables are discarded, so that tables computed
+        # from an outdated object map are not stored.
+        self._lutGeneration = 0
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Image.meta)
         self.Output.meta.dtype = self.ObjectMap.meta.mapping_dtype
+        self._resetLuts()
+
+    def _resetLuts(self, times=None):
+        with self._lutLock:
+            self._lutGeneration += 1
+            if times is None:
+                self._luts = {}
+            else:
+                for t in times:
+                    self._luts.pop(t, None)
+
+    def _getLut(self, t):
+        """
+        Return the lookup table for time step t, or None if there are no objects.
+        The table is stored in the output dtype and has one extra (zero) entry
+        at the end, which is used for all object ids that aren't in the map.
+        """
+        with self._lutLock:
+            if t in self._luts:
+                return self._luts[t]
+            generation = self._lutGeneration
+
+        tmap = self.ObjectMap([t]).wait()[t]
+        # FIXME: necessary because predictions are returned
+        # enclosed in a list.
+        if isinstance(tmap, list):
+            tmap = tmap[0]
+        tmap = numpy.asarray(tmap).squeeze()
+        if tmap.ndim==0:
+            # no objects, nothing to paint
+            lut = None
+        else:
+            lut = numpy.zeros( (len(tmap)+1,), dtype=self.Output.meta.dtype )
+            lut[:len(tmap)] = tmap
+
+        with self._lutLock:
+            # Don't keep the table if the map was reset in the meantime.
+            if generation == self._lutGeneration:
+                self._luts[t] = lut
+        return lut
 
     def execute(self, slot, subindex, roi, result):
         tStart = time.time()
@@ -1230,40 +1473,27 @@ class OpRelabelSegmentation(Operator):
         img = self.Image(roi.start, roi.stop).wait()
         tIMG = 1000.0*(time.time()-tIMG)
         
+        tMAP = 0.0
+        tWORK = 0.0
         for t in range(roi.start[0], roi.stop[0]):
             
-            tMAP = time.time()
-            map_ = self.ObjectMap([t]).wait()
-            tmap = map_[t]
-            # FIXME: necessary because predictions are returned
-            # enclosed in a list.
-            if isinstance(tmap, list):
-                tmap = tmap[0]
-            tmap = tmap.squeeze()
-            if tmap.ndim==0:
+            tMAP -= time.time()
+            lut = self._getLut(t)
+            tMAP += time.time()
+            if lut is None:
                 # no objects, nothing to paint
                 result[t-roi.start[0]][:] = 0
-                return result
-            
-            tMAP = 1000.0*(time.time()-tMAP)
-            #FIXME: This should be cached (and reset when the input becomes dirty)")
-            tMAX = time.time()
-            idx = img.max()
-            
-            if len(tmap) <= idx:
-                newTmap = numpy.zeros((idx + 1,)) # And maybe this should be cached, too?
-                newTmap[:len(tmap)] = tmap[:]
-                tmap = newTmap
-            tMAX = 1000.0*(time.time()-tMAX)
+                continue
             
             #do the work thing
-            tWORK = time.time()
-            result[t-roi.start[0]] = tmap[img[t-roi.start[0]]]
-            tWORK = 1000.0*(time.time()-tWORK)
+            # Object ids beyond the end of the map are clipped to the last (zero) entry.
+            tWORK -= time.time()
+            result[t-roi.start[0]] = lut.take(img[t-roi.start[0]], mode='clip')
+            tWORK += time.time()
             
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tStart = 1000.0*(time.time()-tStart)
-            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f, max: %f)" % (tStart, tIMG, tMAP, tWORK, tMAX))
+            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f)" % (tStart, tIMG, 1000.0*tMAP, 1000.0*tWORK))
         
         return result
 
@@ -1276,14 +1506,17 @@ class OpRelabelSegmentation(Operator):
             # setDirty with a (time, object) pair, while elsewhere we
             # call setDirty with ().
             if len(roi._l) == 0:
+                self._resetLuts()
                 self.Output.setDirty(slice(None))
             elif isinstance(roi._l[0], int):
+                self._resetLuts(roi._l)
                 for t in roi._l:
                     self.Output.setDirty(slice(t))
             else:
                 assert len(roi._l[0]) == 2
                 # for each dirty object, only set its bounding box dirty
                 ts = list(set(t for t, _ in roi._l))
+                self._resetLuts(ts)
                 feats = self.Features(ts).wait()
                 for t, obj in roi._l:
                     min_coords = feats[t][default_features_key]['Coord<Minimum>'][obj].astype(numpy.uint32)
@@ -1312,10 +1545,16 @@ class OpMultiRelabelSegmentation(Operator):
 
     def setupOutputs(self):
         nmaps = len(self.ObjectMaps)
-        for islot in self.ObjectMaps:
+        # Keep the existing inner operators (and their lookup tables),
+        #  only add or remove operators for added or removed maps.
+        while len(self._innerOperators) > nmaps:
+            op = self._innerOperators.pop()
+            self.Output[len(self._innerOperators)].disconnect()
+            op.cleanUp()
+        for i in range(len(self._innerOperators), nmaps):
             op = OpRelabelSegmentation(parent=self)
             op.Image.connect(self.Image)
-            op.ObjectMap.connect(islot)
+            op.ObjectMap.connect(self.ObjectMaps[i])
             op.Features.connect(self.Features)
             self._innerOperators.append(op)
         self.Output.resize(nmaps)
@@ -0,0 +1,205 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Region features that can be computed one spatial block at a time.
+
+Each block is reduced to a small set of per-label statistics (count, sum,
+second central moment, value and coordinate extrema, coordinate sums),
+which are merged into a RegionFeatureAccumulator.  Objects that span
+several blocks are handled by the merge, so the final features are
+identical to a whole-volume computation.
+"""
+import threading
+
+import numpy as np
+
+#: Features (as named by vigra) that can be merged across blocks.
+MERGEABLE_FEATURES = set(['Count', 'Sum', 'Mean', 'Variance', 'Minimum', 'Maximum',
+                          'Coord<Minimum>', 'Coord<Maximum>', 'Coord<Mean>', 'RegionCenter'])
+
+def blockwise_supported(feature_names, plugin_name="Standard Object Features"):
+    """Return True if every requested feature can be computed blockwise.
+
+    feature_names is the nested dictionary of the Features slot:
+    feature_names[plugin_name][feature_name][parameter_name]
+
+    """
+    for pname, feature_dict in feature_names.iteritems():
+        if pname != plugin_name and len(feature_dict) > 0:
+            return False
+        for name, params in feature_dict.iteritems():
+            if name not in MERGEABLE_FEATURES or 'margin' in params:
+                return False
+    return True
+
+
+class RegionFeatureAccumulator(object):
+    """Accumulates mergeable per-label statistics over spatial blocks.
+
+    Blocks may be added from several threads at once.  Label 0 is
+    treated as background and ignored, just like ``ignoreLabel=0`` in
+    vigra.
+
+    """
+    def __init__(self, nchannels, ndim):
+        """
+        nchannels: number of channels of the raw data
+        ndim: number of spatial dimensions reported in coordinate features (2 or 3)
+        """
+        self.nchannels = nchannels
+        self.ndim = ndim
+        self._lock = threading.Lock()
+
+        self.count = np.zeros((1,), dtype=np.float64)
+        self.sum = np.zeros((1, nchannels), dtype=np.float64)
+        self.m2 = np.zeros((1, nchannels), dtype=np.float64)
+        self.min = np.full((1, nchannels), np.inf)
+        self.max = np.full((1, nchannels), -np.inf)
+        self.coord_sum = np.zeros((1, 3), dtype=np.float64)
+        self.coord_min = np.full((1, 3), np.iinfo(np.int64).max, dtype=np.int64)
+        self.coord_max = np.full((1, 3), -1, dtype=np.int64)
+
+    @staticmethod
+    def block_statistics(raw, labels, offset):
+        """Compute the per-label statistics of a single block.
+
+        raw: array of shape (x, y, z, c)
+        labels: array of shape (x, y, z)
+        offset: global (x, y, z) coordinate of the block's first voxel
+
+        Returns a dict of arrays, one row per label id in 'ids', or None
+        if the block contains only background.
+
+        """
+        assert raw.shape[:3] == labels.shape
+        spatial_shape = labels.shape
+        labels = np.asarray(labels).ravel()
+        foreground = np.flatnonzero(labels)
+        if len(foreground) == 0:
+            return None
+
+        ids, inv = np.unique(labels[foreground], return_inverse=True)
+        nids = len(ids)
+        values = np.asarray(raw).reshape(-1, raw.shape[-1])[foreground].astype(np.float64)
+        coords = np.column_stack(np.unravel_index(foreground, spatial_shape)) + np.asarray(offset)
+
+        count = np.bincount(inv, minlength=nids).astype(np.float64)
+        sums = np.column_stack([np.bincount(inv, weights=values[:, c], minlength=nids)
+                                for c in range(values.shape[1])])
+        means = sums / count[:, None]
+        m2 = np.column_stack([np.bincount(inv, weights=(values[:, c] - means[inv, c])**2, minlength=nids)
+                              for c in range(values.shape[1])])
+        coord_sum = np.column_stack([np.bincount(inv, weights=coords[:, d], minlength=nids)
+                                     for d in range(3)])
+
+        # Extrema: sort the voxels by label and reduce each contiguous run
+        order = np.argsort(inv, kind='mergesort')
+        starts = np.concatenate(([0], np.cumsum(count[:-1]))).astype(np.intp)
+        sorted_values = values[order]
+        sorted_coords = coords[order]
+
+        return { 'ids' : ids,
+                 'count' : count,
+                 'sum' : sums,
+                 'm2' : m2,
+                 'min' : np.minimum.reduceat(sorted_values, starts, axis=0),
+                 'max' : np.maximum.reduceat(sorted_values, starts, axis=0),
+                 'coord_sum' : coord_sum,
+                 'coord_min' : np.minimum.reduceat(sorted_coords, starts, axis=0),
+                 'coord_max' : np.maximum.reduceat(sorted_coords, starts, axis=0) }
+
+    def add_block(self, raw, labels, offset):
+        """Compute the statistics of one block and merge them."""
+        self.merge(self.block_statistics(raw, labels, offset))
+
+    def merge(self, stats):
+        """Merge the output of block_statistics() into the accumulator."""
+        if stats is None:
+            return
+        ids = stats['ids']
+        with self._lock:
+            self._grow(ids[-1] + 1)
+
+            # Combine the second central moments (Chan et al.)
+            na = self.count[ids]
+            nb = stats['count']
+            n = na + nb
+            mean_a = self.sum[ids] / np.maximum(na, 1)[:, None]
+            mean_b = stats['sum'] / nb[:, None]
+            delta = mean_b - mean_a
+            self.m2[ids] += stats['m2'] + delta**2 * (na * nb / n)[:, None]
+
+            self.count[ids] = n
+            self.sum[ids] += stats['sum']
+            self.min[ids] = np.minimum(self.min[ids], stats['min'])
+            self.max[ids] = np.maximum(self.max[ids], stats['max'])
+            self.coord_sum[ids] += stats['coord_sum']
+            self.coord_min[ids] = np.minimum(self.coord_min[ids], stats['coord_min'])
+            self.coord_max[ids] = np.maximum(self.coord_max[ids], stats['coord_max'])
+
+    def _grow(self, nlabels):
+        old = len(self.count)
+        if nlabels <= old:
+            return
+        def grow(a, fill):
+            grown = np.empty((nlabels,) + a.shape[1:], dtype=a.dtype)
+            grown[:old] = a
+            grown[old:] = fill
+            return grown
+        self.count = grow(self.count, 0)
+        self.sum = grow(self.sum, 0)
+        self.m2 = grow(self.m2, 0)
+        self.min = grow(self.min, np.inf)
+        self.max = grow(self.max, -np.inf)
+        self.coord_sum = grow(self.coord_sum, 0)
+        self.coord_min = grow(self.coord_min, np.iinfo(np.int64).max)
+        self.coord_max = grow(self.coord_max, -1)
+
+    def result(self, feature_names, nlabels=None):
+        """Return a dict of feature arrays in the format of vigra's
+        extractRegionFeatures(): one row per label id, including the
+        (empty) background row 0.
+
+        nlabels: total number of label ids (max label + 1), if known.
+                 Labels that never appeared in any block get zeros.
+
+        """
+        if nlabels is not None:
+            self._grow(nlabels)
+        count = self.count
+        present = (count > 0)
+        denominator = np.where(present, count, 1)[:, None]
+
+        def masked(a):
+            return np.where(present[:, None], a, 0).astype(np.float64)
+
+        center = masked(self.coord_sum / denominator)[:, :self.ndim]
+        computed = { 'Count' : count.copy(),
+                     'Sum' : self.sum.copy(),
+                     'Mean' : masked(self.sum / denominator),
+                     'Variance' : masked(self.m2 / denominator),
+                     'Minimum' : masked(self.min),
+                     'Maximum' : masked(self.max),
+                     'Coord<Minimum>' : masked(self.coord_min)[:, :self.ndim],
+                     'Coord<Maximum>' : masked(self.coord_max)[:, :self.ndim],
+                     'Coord<Mean>' : center,
+                     'RegionCenter' : center.copy() }
+        return dict((name, computed[name]) for name in feature_names)
@@ -32,7 +32,7 @@ from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
 from lazyflow.request import Request, RequestPool
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List, SubRegion
-from lazyflow.roi import roiToSlice, sliceToRoi
+from lazyflow.roi import roiToSlice, sliceToRoi, getIntersectingBlocks, getBlockBounds
 from lazyflow.operators import OpLabelVolume, OpCompressedCache, OpArrayCache
 
 import logging
@@ -45,6 +45,7 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction.blockwiseRegionFeatures import RegionFeatureAccumulator, blockwise_supported
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -119,6 +120,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -139,6 +141,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.RawVolume.connect(self.RawImage)
         self._opRegionFeatures.LabelVolume.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.BlockShape.connect(self.BlockShape)
 
         # Hook up the cache.
         self._opCache = OpArrayCache(parent=self)
@@ -234,42 +237,32 @@ class OpObjectCenterImage(Operator):
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.BinaryImage.meta)
 
-    @staticmethod
-    def __contained_in_subregion(roi, coords):
-        b = True
-        for i in range(len(coords)):
-            b = b and (roi.start[i] <= coords[i] and coords[i] < roi.stop[i])
-        return b
-
-    @staticmethod
-    def __make_key(roi, coords):
-        key = [int(coords[i] - roi.start[i]) for i in range(len(roi.start))]
-        return tuple(key)
-
     def execute(self, slot, subindex, roi, result):
         assert slot == self.Output, "Unknown output slot"
-        
+
         result[:] = 0
         ndim = 3
         taggedShape = self.BinaryImage.meta.getTaggedShape()
         if 'z' not in taggedShape or taggedShape['z']==1:
             ndim = 2
+
+        #FIXME: this assumes txyzc axis order
+        start = np.asarray(roi.start)
+        stop = np.asarray(roi.stop)
+        obj_features = self.RegionCenters(range(roi.start[0], roi.stop[0])).wait()
         for t in range(roi.start[0], roi.stop[0]):
-            obj_features = self.RegionCenters([t]).wait()
-            #FIXME: this assumes that channel is the last axis
-            for ch in range(roi.start[-1], roi.stop[-1]):
-                centers = obj_features[t][default_features_key]['RegionCenter']
-                if centers.size:
-                    centers = centers[1:, :]
-                for center in centers:
-                    if ndim==3:
-                        x, y, z = center[0:3]
-                        c = (t, x, y, z, ch)
-                    elif ndim==2:
-                        x, y = center[0:2]
-                        c = (t, x, y, 0, ch)
-                    if self.__contained_in_subregion(roi, c):
-                        result[self.__make_key(roi, c)] = 1
+            centers = obj_features[t][default_features_key]['RegionCenter']
+            if centers.size == 0:
+                continue
+            # skip the background object
+            centers = centers[1:, :ndim]
+            coords = np.zeros((centers.shape[0], 3), dtype=centers.dtype)
+            coords[:, :ndim] = centers
+
+            inside = np.all((start[1:4] <= coords) & (coords < stop[1:4]), axis=1)
+            keys = (coords[inside] - start[1:4]).astype(np.int)
+            # all requested channels get the same centers
+            result[t - roi.start[0], keys[:, 0], keys[:, 1], keys[:, 2], :] = 1
 
         return result
 
@@ -312,6 +305,10 @@ class OpObjectExtraction(Operator):
     # for example {"Standard Object Features": {"Mean in neighborhood":{"margin": (5, 5, 2)}}}
     Features = InputSlot(rtype=List, stype=Opaque, value={})
 
+    # optional spatial block shape for computing region features in bounded memory,
+    # e.g. {'x': 1024, 'y': 1024, 'z': 256}.  See OpRegionFeatures.
+    RegionFeaturesBlockShape = InputSlot(optional=True)
+
     LabelImage = OutputSlot()
     ObjectCenterImage = OutputSlot()
 
@@ -363,6 +360,7 @@ class OpObjectExtraction(Operator):
         self._opRegFeats.RawImage.connect(self.RawImage)
         self._opRegFeats.LabelImage.connect(self._opLabelVolume.CachedOutput)
         self._opRegFeats.Features.connect(self.Features)
+        self._opRegFeats.BlockShape.connect(self.RegionFeaturesBlockShape)
         self.RegionFeaturesCleanBlocks.connect(self._opRegFeats.CleanBlocks)
 
         self._opRegFeats.CacheInput.connect(self.RegionFeaturesCacheInput)
@@ -426,74 +424,72 @@ class OpObjectExtraction(Operator):
         #  so all calls to __setitem__ are forwarded automatically
 
     @staticmethod
-    def createExportTable(features):
-        ''' This function takes the features as produced by the RegionFeatures slot
-            and transforms them into a flat table, which is later used for exporting
-            object-level data to csv and h5 files. The columns of the table are as follows:
-            (t, object index, feature 1, feature 2, ...). Row-wise object index increases
-            faster than time, so first all objects for time 0 are exported, then for time 1, etc  '''
-       
-        ntimes = len(features.keys())
-        nplugins = len(features[0].keys())
-        nchannels = 0
-        nobjects = []
-        dtype_names = []
-        dtype_types = []
-        for t, plugin_name in features.iteritems():
-            feat0 = plugin_name.values()[0]
-            feat0_name = feat0.keys()[0]
-            feat0_array = feat0.values()[0]
-            nobjects.append(feat0_array.shape[0])
-                
-                
-        for plugin_name, plugins in features[0].iteritems():
+    def exportTableLayout(frame_features):
+        ''' Determine the columns of the export table from the features of a single time step.
+            Returns (dtype_names, dtype_types, columns), where columns is a list of
+            (plugin name, feature name, index of the feature's first field, number of channels).
+            The fields of a multi-channel feature are adjacent, so they can be filled
+            as one block (see exportTableColumnBlock). '''
+        dtype_names = ["Object id", "Time"]
+        dtype_types = [np.dtype(np.uint32).str, np.dtype(np.uint32).str]
+        columns = []
+        for plugin_name, plugins in frame_features.iteritems():
             for feature_name, feature_array in plugins.iteritems():
                 feature_channels = feature_array.shape[-1]
-                nchannels += feature_channels
+                columns.append((plugin_name, feature_name, len(dtype_names), feature_channels))
                 if feature_channels==1:
                     dtype_names.append(plugin_name + ", "+feature_name)
-                    dtype_types.append(feature_array.dtype)
                 else:
                     for ich in range(feature_channels):
                         dtype_names.append(plugin_name + ", "+ feature_name+"_ch_%d"%ich)
-                        dtype_types.append(feature_array.dtype)
-                    
-        nchannels += 2 #true channels + time value + explicit object id
-        
-        dtype_names.insert(0, "Time")
-        dtype_names.insert(0, "Object id")
-        
+                dtype_types += [feature_array.dtype] * feature_channels
+
         # Some versions of numpy can't handle unicode names.
         # Convert to str.
         dtype_names = map(str, dtype_names)
-        
-        dtype_types.insert(0, np.dtype(np.uint32).str)
-        dtype_types.insert(0, np.dtype(np.uint32).str)
-        
-        nobjects_total = sum(nobjects)
-        
-        table = np.zeros(nobjects_total, dtype = {'names': dtype_names, 'formats': dtype_types})
-        
-        #table = np.zeros(4, dtype = {'names': ['Mean', 'Coord<Maximum>_ch_0'], \
-        #                           'formats': [np.dtype(np.uint32), np.dtype(np.uint8)]})
-        
-        
+        return dtype_names, dtype_types, columns
+
+    @staticmethod
+    def exportTableColumnBlock(table, first_field, nchannels):
+        ''' Return a writable (nrows, nchannels) view of 'nchannels' adjacent
+            fields of the same dtype in the record array 'table'. '''
+        field_dtype, offset = table.dtype.fields[table.dtype.names[first_field]][:2]
+        return np.ndarray(shape=(len(table), nchannels), dtype=field_dtype, buffer=table, offset=offset,
+                          strides=(table.dtype.itemsize, field_dtype.itemsize))
+
+    @staticmethod
+    def fillExportTable(table, features, columns):
+        ''' Copy the features of all time steps into the preallocated table,
+            one contiguous block per feature and time step. '''
         start = 0
-        finish = start
-        for itime in range(ntimes):
-            finish = start+nobjects[itime]
-            table["Object id"][start: finish] = np.arange(nobjects[itime])
-            table["Time"][start: finish] = itime
-            nfeat = 2
-            for plugin_name, plugins in features[itime].iteritems():
-                for feature_name, feature_array in plugins.iteritems():
-                    nchannels = feature_array.shape[-1]
-                    for ich in range(nchannels):
-                        table[dtype_names[nfeat]][start: finish] = feature_array[:, ich]
-                        nfeat += 1
+        for t in sorted(features.keys()):
+            frame = features[t]
+            nobjects = frame.values()[0].values()[0].shape[0]
+            finish = start + nobjects
+            table["Object id"][start: finish] = np.arange(nobjects)
+            table["Time"][start: finish] = t
+            for plugin_name, feature_name, first_field, nchannels in columns:
+                block = OpObjectExtraction.exportTableColumnBlock(table, first_field, nchannels)
+                block[start: finish] = frame[plugin_name][feature_name]
             start = finish
-        
         return table
+
+    @staticmethod
+    def createExportTable(features):
+        ''' This function takes the features as produced by the RegionFeatures slot
+            and transforms them into a flat table, which is later used for exporting
+            object-level data to csv and h5 files. The columns of the table are as follows:
+            (t, object index, feature 1, feature 2, ...). Row-wise object index increases
+            faster than time, so first all objects for time 0 are exported, then for time 1, etc
+
+            To keep memory bounded for long time series, call this for one time step
+            at a time (e.g. features = RegionFeatures([t]).wait()) and append the results. '''
+        times = sorted(features.keys())
+        dtype_names, dtype_types, columns = OpObjectExtraction.exportTableLayout(features[times[0]])
+        nobjects_total = sum(features[t].values()[0].values()[0].shape[0] for t in times)
+
+        table = np.zeros(nobjects_total, dtype = {'names': dtype_names, 'formats': dtype_types})
+        return OpObjectExtraction.fillExportTable(table, features, columns)
         
 
 class OpRegionFeatures(Operator):
@@ -512,6 +508,12 @@ class OpRegionFeatures(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * BlockShape (optional) : a dict of spatial block sizes, e.g.
+      {'x': 1024, 'y': 1024, 'z': 256}.  If given, and all requested
+      features can be merged across blocks (see blockwiseRegionFeatures),
+      each time slice is processed one block at a time, so memory use
+      is bounded by the block size instead of the volume size.
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -521,6 +523,7 @@ class OpRegionFeatures(Operator):
     RawVolume = InputSlot()
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
 
@@ -550,7 +553,18 @@ class OpRegionFeatures(Operator):
         t_ind = self.RawVolume.meta.axistags.index('t')
         assert t_ind < len(self.RawVolume.meta.shape)
 
+        blockwise = False
+        if self.BlockShape.ready():
+            blockwise = blockwise_supported(self.Features([]).wait())
+            if not blockwise:
+                logger.warn("Some of the selected features can't be computed blockwise. "
+                            "Computing features for the entire volume at once.")
+
         def compute_features_for_time_slice(res_t_ind, t):
+            if blockwise:
+                result[res_t_ind] = self._extract_blockwise(t)
+                return
+
             # Process entire spatial volume
             s = [slice(None) for i in range(len(self.RawVolume.meta.shape))]
             s[t_ind] = slice(t, t+1)
@@ -588,6 +602,74 @@ class OpRegionFeatures(Operator):
         pool.wait()
         return result
 
+    def _extract_blockwise(self, t):
+        """Compute the features of time slice t one spatial block at a time.
+
+        Only valid if blockwise_supported() returns True for the
+        selected features.
+
+        """
+        feature_names = deepcopy(self.Features([]).wait())
+        selected_features = feature_names.get("Standard Object Features", {}).keys()
+
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        blockShapeDict = self.BlockShape.value
+        block_shape = []
+        for k, size in taggedShape.items():
+            if k in 'xyz':
+                size = min(size, blockShapeDict.get(k, size))
+            elif k == 't':
+                size = 1
+            block_shape.append(size)
+
+        shape = taggedShape.values()
+        roi = ([0] * len(shape), list(shape))
+        t_ind = taggedShape.keys().index('t')
+        roi[0][t_ind] = t
+        roi[1][t_ind] = t + 1
+
+        ndim = 3 if taggedShape.get('z', 1) > 1 else 2
+        accumulator = RegionFeatureAccumulator(taggedShape.get('c', 1), ndim)
+
+        def process_block(block_start):
+            block_roi = getBlockBounds(shape, block_shape, block_start)
+            raw_req = self.RawVolume(*block_roi)
+            label_req = self.LabelVolume(*block_roi)
+            raw_req.submit()
+            label_req.submit()
+
+            rawBlock = vigra.taggedView(raw_req.wait(), axistags=self.RawVolume.meta.axistags)
+            labelBlock = vigra.taggedView(label_req.wait(), axistags=self.LabelVolume.meta.axistags)
+            rawBlock = rawBlock.withAxes('x', 'y', 'z', 'c')
+            labelBlock = labelBlock.withAxes('x', 'y', 'z', 'c')[..., 0]
+
+            tagged_start = collections.OrderedDict(zip(taggedShape.keys(), block_roi[0]))
+            offset = [tagged_start.get(k, 0) for k in 'xyz']
+            accumulator.add_block(rawBlock, labelBlock, offset)
+
+        block_starts = getIntersectingBlocks(block_shape, roi)
+        logger.debug("Computing features for time slice {} in {} blocks".format(t, len(block_starts)))
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add( Request( partial(process_block, block_start) ) )
+        pool.wait()
+
+        features = accumulator.result(set(selected_features) | set(default_features.keys()))
+
+        def strip_background(value):
+            if value.ndim == 1:
+                value = value.reshape(-1, 1)
+            return value[1:]
+        nobj = len(features['Count']) - 1
+
+        # (blockwise_supported() guarantees that other plugins have no selected features)
+        global_features = dict((plugin_name, {}) for plugin_name in feature_names)
+        if "Standard Object Features" in feature_names:
+            global_features["Standard Object Features"] = dict((k, strip_background(features[k]))
+                                                               for k in selected_features)
+        extrafeats = dict((k, strip_background(features[k])) for k in default_features)
+        return self._merge_features(global_features, {}, extrafeats, nobj)
+
     def compute_extent(self, i, image, mincoords, maxcoords, axes, margin):
         """Make a slicing to extract object i from the image."""
         #find the bounding box (margin is always 'xyz' order)
@@ -620,6 +702,55 @@ class OpRegionFeatures(Operator):
         key.insert(axes.c, slice(None))
         return image[tuple(key)]
 
+    #: Number of objects handled by a single request when computing local features.
+    LOCAL_FEATURES_BATCH_SIZE = 256
+
+    def _extract_local(self, image, labels, mincoords, maxcoords, axes, margin, local_plugins):
+        """Compute the local (i.e. bounding box + margin) features of every object.
+
+        Objects are split into batches of ``LOCAL_FEATURES_BATCH_SIZE``
+        which are processed in parallel by the lazyflow worker threads.
+        The bounding box crops of each object are computed once and
+        passed to all plugins.
+
+        Returns local_features[plugin_name][feature_name] = list of
+        per-object values, in object order.
+
+        """
+        nobj = mincoords.shape[0]
+        plugins = [(plugin_name, pluginManager.getPluginByName(plugin_name, "ObjectFeatures").plugin_object, feature_dict)
+                   for plugin_name, feature_dict in local_plugins]
+
+        # per_object_feats[i] = [(plugin_name, feats), ...] for object i
+        per_object_feats = [None] * nobj
+
+        def process_batch(start, stop):
+            #starting from 0, we stripped 0th background object in global computation
+            for i in range(start, stop):
+                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
+                rawbbox = self.compute_rawbbox(image, extent, axes)
+                #it's i+1 here, because the background has label 0
+                binary_bbox = np.asarray(labels[tuple(extent)] == i+1)
+                per_object_feats[i] = [(plugin_name, plugin.compute_local(rawbbox, binary_bbox, feature_dict, axes))
+                                       for plugin_name, plugin, feature_dict in plugins]
+
+        batch_starts = range(0, nobj, self.LOCAL_FEATURES_BATCH_SIZE)
+        if len(batch_starts) > 1:
+            pool = RequestPool()
+            for start in batch_starts:
+                stop = min(start + self.LOCAL_FEATURES_BATCH_SIZE, nobj)
+                pool.add( Request( partial(process_batch, start, stop) ) )
+            pool.wait()
+        else:
+            process_batch(0, nobj)
+
+        local_features = collections.defaultdict(lambda: collections.defaultdict(list))
+        for obj_feats in per_object_feats:
+            for plugin_name, feats in obj_feats:
+                for key, value in feats.iteritems():
+                    local_features[plugin_name][key].append(value)
+        return local_features
+
     def _extract(self, image, labels):
         if not (image.ndim == labels.ndim == 4):
             raise Exception("both images must be 4D. raw image shape: {}"
@@ -686,14 +817,6 @@ class OpRegionFeatures(Operator):
         maxcoords = extrafeats["Coord<Maximum>"]
         nobj = mincoords.shape[0]
         
-        # local features: loop over all objects
-        def dictextend(a, b):
-            for key in b:
-                a[key].append(b[key])
-            return a
-        
-
-        local_features = collections.defaultdict(lambda: collections.defaultdict(list))
         margin = max_margin(feature_names)
         has_local_features = {}
         for plugin_name, feature_dict in feature_names.iteritems():
@@ -702,24 +825,20 @@ class OpRegionFeatures(Operator):
                 if 'margin' in features:
                     has_local_features[plugin_name] = True
                     break
-            
-                            
+
+        local_features = collections.defaultdict(lambda: collections.defaultdict(list))
         if np.any(margin) > 0:
-            #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
-                for plugin_name, feature_dict in feature_names.iteritems():
-                    if not has_local_features[plugin_name]:
-                        continue
-                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+            local_plugins = [(plugin_name, feature_dict) for plugin_name, feature_dict in feature_names.iteritems()
+                             if has_local_features[plugin_name]]
+            local_features = self._extract_local(image, labels, mincoords, maxcoords,
+                                                 axes, margin, local_plugins)
 
         logger.debug("computing done, removing failures")
+        return self._merge_features(global_features, local_features, extrafeats, nobj)
+
+    def _merge_features(self, global_features, local_features, extrafeats, nobj):
+        """Combine global, local and default features into the output
+        dictionary, prepending the background row to every feature."""
         # remove local features that failed
         for pname, pfeats in local_features.iteritems():
             for key in pfeats.keys():
@@ -763,6 +882,9 @@ class OpRegionFeatures(Operator):
     def propagateDirty(self, slot, subindex, roi):
         if slot is self.Features:
             self.Output.setDirty(slice(None))
+        elif slot is self.BlockShape:
+            # The blocking doesn't change the result.
+            pass
         else:
             axes = self.RawVolume.meta.getTaggedShape().keys()
             dirtyStart = collections.OrderedDict(zip(axes, roi.start))
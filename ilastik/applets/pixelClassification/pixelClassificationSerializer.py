@@ -33,17 +33,18 @@ class PixelClassificationSerializer(AppletSerializer):
         self._serialClassifierSlot =  SerialClassifierSlot(operator.Classifier,
                                                            operator.classifier_cache,
                                                            name="ClassifierForests")
+        self._serialLabelSlot = SerialBlockSlot(operator.LabelImages,
+                                                operator.LabelInputs,
+                                                operator.NonzeroLabelBlocks,
+                                                name='LabelSets',
+                                                subname='labels{:03d}',
+                                                selfdepends=False,
+                                                shrink_to_bb=True)
         slots = [SerialListSlot(operator.LabelNames,
                                 transform=str),
                  SerialListSlot(operator.LabelColors, transform=lambda x: tuple(x.flat)),
                  SerialListSlot(operator.PmapColors, transform=lambda x: tuple(x.flat)),
-                 SerialBlockSlot(operator.LabelImages,
-                                 operator.LabelInputs,
-                                 operator.NonzeroLabelBlocks,
-                                 name='LabelSets',
-                                 subname='labels{:03d}',
-                                 selfdepends=False,
-                                 shrink_to_bb=True),
+                 self._serialLabelSlot,
                  SerialClassifierFactorySlot(operator.ClassifierFactory),
                  self._serialClassifierSlot ]
 
@@ -55,6 +56,8 @@ class PixelClassificationSerializer(AppletSerializer):
         Override from AppletSerializer.
         Implement any additional deserialization that wasn't already accomplished by our list of serializable slots.
         """
+        self._topGroup = topGroup
+
         # If this is an old project file that didn't save the label names to the project,
         #   create some default names.
         if not self.operator.LabelNames.ready() or len(self.operator.LabelNames.value) == 0:
@@ -113,6 +116,18 @@ class PixelClassificationSerializer(AppletSerializer):
                     # Delete the classifier from the operator
                     logger.info( "Resetting classifier... will be forced to retrain" )
                     self.operator.classifier_cache.resetValue()
+
+    def loadDeferredData(self):
+        """
+        Override from AppletSerializer.
+        Loading the labels marks the classifier dirty, so restore the stored one afterwards.
+        """
+        if not self._serialLabelSlot.hasDeferredData:
+            return
+        classifierWasLoaded = not self.operator.classifier_cache._dirty
+        super(PixelClassificationSerializer, self).loadDeferredData()
+        if classifierWasLoaded:
+            self._serialClassifierSlot.deserialize(self._topGroup)
         
 class Ilastik05ImportDeserializer(AppletSerializer):
     """
@@ -40,12 +40,13 @@ from lazyflow.operators import OpPixelOperator, OpLabelVolume,\
     OpMultiArrayStacker, OpMultiArraySlicer,\
     OpReorderAxes, OpFilterLabels
 from lazyflow.rtype import SubRegion
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
 from lazyflow.request import Request, RequestPool
 
 # local
 from thresholdingTools import OpAnisotropicGaussianSmoothing5d
 
-from thresholdingTools import OpSelectLabels
+from thresholdingTools import OpSelectLabels, OpHysteresisThreshold
 
 from opGraphcutSegment import haveGraphCut
 
@@ -353,10 +354,8 @@ class _OpThresholdOneLevel(Operator):
 ## internal operator for two level thresholding
 #
 # The input must have 5 dimensions.
-# Input is processed on a what-you-request-is-what-you-get basis: You have to
-# make sure that the ROI for slot 'Output' matches the input shape at least in
-# the spatial dimensions, or you will get inconsistent results. All requests to
-# slot 'CachedOutput' are guaranteed to be consistent though.
+# The thresholding is done blockwise (see OpHysteresisThreshold), so 'Output'
+# can be requested for any ROI and gives consistent labels.
 class _OpThresholdTwoLevels(Operator):
     name = "_OpThresholdTwoLevels"
 
@@ -381,15 +380,19 @@ class _OpThresholdTwoLevels(Operator):
 
     # Schematic:
     #
-    #           HighThreshold                         MinSize,MaxSize                       --(cache)--> opColorize -> FilteredSmallLabels
-    #                   \                                       \                     /
-    #           opHighThresholder --> opHighLabeler --> opHighLabelSizeFilter                           Output
-    #          /                   \          /                 \                                            \                         /
-    # InputImage        --(cache)--> SmallRegions                    opSelectLabels -->opFinalLabelSizeFilter--> opCache --> CachedOutput
-    #          \                                                              /                                           /       \
-    #           opLowThresholder ----> opLowLabeler --------------------------                                       InputHdf5     --> OutputHdf5
-    #                   /                \                                                                                        -> CleanBlocks
-    #           LowThreshold            --(cache)--> BigRegions
+    #                                 HighThreshold,LowThreshold,MinSize,MaxSize
+    #                                                   \                               Output
+    #          ---------------------------------> opHysteresis                    /
+    #         /                                                 \----------> opCache --> CachedOutput
+    #        /                                                                 /       \
+    # InputImage --> opHighThresholder --(cache)--> SmallRegions          InputHdf5     --> OutputHdf5
+    #        \                        \                                                 -> CleanBlocks
+    #         \                        --> opHighLabeler --> opHighLabelSizeFilter --(cache)--> opColorize -> FilteredSmallLabels
+    #          \
+    #           opLowThresholder --(cache)--> BigRegions
+    #
+    # The labeling for the debug output FilteredSmallLabels is a global operation,
+    # the other paths work blockwise.
 
     def __init__(self, *args, **kwargs):
         super(_OpThresholdTwoLevels, self).__init__(*args, **kwargs)
@@ -400,10 +403,6 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighThresholder = OpPixelOperator(parent=self)
         self._opHighThresholder.Input.connect(self.InputImage)
 
-        self._opLowLabeler = OpLabelVolume(parent=self)
-        self._opLowLabeler.Method.setValue(_labeling_impl)
-        self._opLowLabeler.Input.connect(self._opLowThresholder.Output)
-
         self._opHighLabeler = OpLabelVolume(parent=self)
         self._opHighLabeler.Method.setValue(_labeling_impl)
         self._opHighLabeler.Input.connect(self._opHighThresholder.Output)
@@ -412,30 +411,27 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighLabelSizeFilter.Input.connect(self._opHighLabeler.Output)
         self._opHighLabelSizeFilter.MinLabelSize.connect(self.MinSize)
         self._opHighLabelSizeFilter.MaxLabelSize.connect(self.MaxSize)
-        self._opHighLabelSizeFilter.BinaryOut.setValue(False)  # we do the binarization in opSelectLabels
+        self._opHighLabelSizeFilter.BinaryOut.setValue(False)  # keep the labels,
                                                                # this way, we get to display pretty colors
 
-        self._opSelectLabels = OpSelectLabels( parent=self )        
-        self._opSelectLabels.BigLabels.connect( self._opLowLabeler.Output )
-        self._opSelectLabels.SmallLabels.connect( self._opHighLabelSizeFilter.Output )
-
-        # remove the remaining very large objects -
-        # they might still be present in case a big object
+        # The actual two-level thresholding. This also removes the remaining
+        # very large objects - they might still be present in case a big object
         # was split into many small ones for the higher threshold
         # and they got reconnected again at lower threshold
-        self._opFinalLabelSizeFilter = OpFilterLabels( parent=self )
-        self._opFinalLabelSizeFilter.Input.connect(self._opSelectLabels.Output )
-        self._opFinalLabelSizeFilter.MinLabelSize.connect( self.MinSize )
-        self._opFinalLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
-        self._opFinalLabelSizeFilter.BinaryOut.setValue(False)
+        self._opHysteresis = OpHysteresisThreshold( parent=self )
+        self._opHysteresis.InputImage.connect( self.InputImage )
+        self._opHysteresis.MinSize.connect( self.MinSize )
+        self._opHysteresis.MaxSize.connect( self.MaxSize )
+        self._opHysteresis.HighThreshold.connect( self.HighThreshold )
+        self._opHysteresis.LowThreshold.connect( self.LowThreshold )
 
         self._opCache = OpCompressedCache( parent=self )
         self._opCache.name = "_OpThresholdTwoLevels._opCache"
         self._opCache.InputHdf5.connect( self.InputHdf5 )
-        self._opCache.Input.connect( self._opFinalLabelSizeFilter.Output )
+        self._opCache.Input.connect( self._opHysteresis.Output )
 
         # Connect our own outputs
-        self.Output.connect( self._opFinalLabelSizeFilter.Output )
+        self.Output.connect( self._opHysteresis.Output )
         self.CachedOutput.connect( self._opCache.Output )
 
         # Serialization outputs
@@ -484,17 +480,19 @@ class _OpThresholdTwoLevels(Operator):
         # Output is already connected internally -- don't reassign new metadata
         # self.Output.meta.assignFrom(self.InputImage.meta)
 
-        # Blockshape is the entire spatial volume (hysteresis thresholding is
-        # a global operation)
+        # Hysteresis thresholding is done blockwise, so the caches can use
+        # the same blocks
+        blockshape = (1,) + self._opHysteresis.BLOCK_SHAPE + (1,)
+        blockshape = tuple(numpy.minimum(blockshape, self.Output.meta.shape))
+        self._opCache.BlockShape.setValue(blockshape)
+        self._opBigRegionCache.BlockShape.setValue(blockshape)
+        self._opSmallRegionCache.BlockShape.setValue(blockshape)
+
+        # Blockshape is the entire spatial volume (labeling the small
+        # regions is a global operation)
         tagged_shape = self.Output.meta.getTaggedShape()
         tagged_shape['c'] = 1
         tagged_shape['t'] = 1
-        self._opCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opBigRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opSmallRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
         self._opFilteredSmallLabelsCache.BlockShape.setValue(
             tuple(tagged_shape.values()))
 
@@ -554,7 +552,7 @@ class _OpCacheWrapper(Operator):
         self._op2.Input.connect(cache.Output)
 
         # connect cache inputs
-        cache.InputHdf5.connect(self.InputHdf5)
+        # (InputHdf5 is not connected, blocks are passed on in setInSlot)
         cache.Input.connect(self._op1.Output)
 
         # set the cache block shape
@@ -578,12 +576,36 @@ class _OpCacheWrapper(Operator):
     def propagateDirty(self, slot, subindex, roi):
         pass
 
-    def setInSlot(self, slot, subindex, key, value):
+    def setInSlot(self, slot, subindex, roi, value):
         assert slot == self.InputHdf5,\
             "setInSlot not implemented for slot {}".format(slot.name)
         assert self._cache is not None,\
             "setInSlot called before input was configured"
-        self._cache.setInSlot(self._cache.InputHdf5, subindex, key, value)
+
+        # The cache only accepts data for exactly one of its blocks, but the
+        # project may have been saved with a different block shape (the block
+        # shape depends on the labeling implementation, see setupOutputs).
+        # Such data is split into our blocks.  Blocks it doesn't cover
+        # completely are dropped, they will be computed again.
+        shape = self._cache.Output.meta.shape
+        blockshape = self._cache.BlockShape.value
+        start = numpy.array(roi.start)
+        stop = numpy.array(roi.stop)
+        dropped = 0
+        for block_start in getIntersectingBlocks(blockshape, (start, stop)):
+            block_roi = getBlockBounds(shape, blockshape, block_start)
+            if (block_roi[0] < start).any() or (block_roi[1] > stop).any():
+                dropped += 1
+                continue
+            if (block_roi[0] == start).all() and (block_roi[1] == stop).all():
+                block = value
+            else:
+                block = value[roiToSlice(block_roi[0] - start, block_roi[1] - start)]
+            self._cache.setInSlot(self._cache.InputHdf5, subindex,
+                                  SubRegion(self._cache.InputHdf5, *block_roi), block)
+        if dropped:
+            logger.info("Dropped {} cached block(s) saved with a different block shape"
+                        " (roi {}), they will be recomputed".format(dropped, (list(start), list(stop))))
 
     def _disconnectInternals(self):
         self.CleanBlocks.disconnect()
@@ -591,7 +613,6 @@ class _OpCacheWrapper(Operator):
         self._op2.Input.disconnect()
 
         if self._cache is not None:
-            self._cache.InputHdf5.disconnect()
             self._cache.Input.disconnect()
             del self._cache
 
@@ -22,6 +22,7 @@
 # Built-in
 import gc
 import logging
+from functools import partial
 
 # Third-party
 import numpy
@@ -30,10 +31,14 @@ import psutil
 
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import enlargeRoiForHalo, TinyVector
+from lazyflow.roi import enlargeRoiForHalo, TinyVector,\
+    roiFromShape, getIntersectingBlocks, getBlockBounds, getIntersection,\
+    roiToSlice
+from lazyflow.request import Request, RequestPool, RequestLock
 
 # ilastik
 from lazyflow.utility.timer import Timer
+from ilastik.utility import mergeLabels
 
 logger = logging.getLogger(__name__)
 
@@ -376,9 +381,7 @@ class OpSelectLabels(Operator):
         all_label_values = numpy.zeros((bigLabels.max()+1,),
                                        dtype=numpy.uint32)
 
-        for i, l in enumerate(passed):
-            all_label_values[l] = i+1
-        all_label_values[0] = 0
+        all_label_values[passed] = numpy.arange(1, len(passed)+1, dtype=numpy.uint32)
 
         # tricky: map the old labels to the new ones, labels that didnt pass 
         # are mapped to zero
@@ -392,3 +395,220 @@ class OpSelectLabels(Operator):
             self.Output.setDirty(slice(None))
         else:
             assert False, "Unknown input slot: {}".format(slot.name)
+
+
+## Blockwise two-level (hysteresis) thresholding
+# The result contains the connected components of the low-threshold mask that
+# overlap a component of the high-threshold mask with a size in [MinSize, MaxSize],
+# and that have a size in [MinSize, MaxSize] themselves (see OpSelectLabels).
+#
+# Each block is labeled on its own.  Components that touch across a block face
+# are merged with a union-find over the label equivalences, and the selection
+# is done on the merged labels.  Per time slice, only a lookup table from block
+# labels to output labels is kept, so the input never has to be loaded at once
+# and the output can be requested block by block.
+#
+# The input must be 5d (txyzc) with a single channel.
+class OpHysteresisThreshold(Operator):
+    InputImage = InputSlot()
+    MinSize = InputSlot(stype='int', value=0)
+    MaxSize = InputSlot(stype='int', value=1000000)
+    HighThreshold = InputSlot(stype='float', value=0.5)
+    LowThreshold = InputSlot(stype='float', value=0.2)
+
+    Output = OutputSlot()
+
+    #: Spatial block shape of the blockwise labeling
+    BLOCK_SHAPE = (256, 256, 256)
+
+    def __init__(self, *args, **kwargs):
+        super(OpHysteresisThreshold, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._tables = {}
+        self._blockshape = None
+
+    def setupOutputs(self):
+        assert "".join(self.InputImage.meta.getAxisKeys()) == 'txyzc',\
+            "Input must be 5d (txyzc)"
+        assert self.InputImage.meta.shape[-1] == 1,\
+            "Input must have a single channel"
+        self.Output.meta.assignFrom(self.InputImage.meta)
+        self.Output.meta.dtype = numpy.uint32
+        self.Output.meta.drange = (0, 1)
+        self._blockshape = tuple(numpy.minimum(self.BLOCK_SHAPE, self.InputImage.meta.shape[1:4]))
+        self._tables = {}
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output
+        shape = numpy.array(self.InputImage.meta.shape[1:4])
+        request_roi = (numpy.array(roi.start[1:4]), numpy.array(roi.stop[1:4]))
+        for t in range(roi.start[0], roi.stop[0]):
+            lut, offsets = self._getTable(t)
+            result_view = result[t - roi.start[0], ..., 0]
+            pool = RequestPool()
+            for block_start in getIntersectingBlocks(self._blockshape, request_roi):
+                pool.add(Request(partial(self._relabelBlock, t, shape, tuple(block_start),
+                                         lut, offsets, request_roi, result_view)))
+            pool.wait()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.InputImage:
+            # Labels are global within a time slice
+            for t in range(roi.start[0], roi.stop[0]):
+                self._tables.pop(t, None)
+            stop = list(self.Output.meta.shape)
+            stop[0] = roi.stop[0]
+            self.Output.setDirty([roi.start[0], 0, 0, 0, 0], stop)
+        elif slot in (self.MinSize, self.MaxSize, self.HighThreshold, self.LowThreshold):
+            self._tables = {}
+            self.Output.setDirty(slice(None))
+        else:
+            assert False, "Unknown input slot: {}".format(slot.name)
+
+    def _getTable(self, t):
+        """
+        Return the lookup table from block labels to output labels for time slice t,
+        and the label offset of each block.
+        """
+        with self._lock:
+            if t not in self._tables:
+                self._tables[t] = self._computeTable(t)
+            return self._tables[t]
+
+    def _computeTable(self, t):
+        shape = numpy.array(self.InputImage.meta.shape[1:4])
+        block_starts = [tuple(block_start) for block_start in getIntersectingBlocks(self._blockshape, roiFromShape(shape))]
+
+        with Timer() as timer:
+            blocks = {}
+            pool = RequestPool()
+            for block_start in block_starts:
+                pool.add(Request(partial(self._analyzeBlock, t, shape, block_start, blocks)))
+            pool.wait()
+
+            # Give each block its own range of low and high labels (0 is background)
+            low_offsets = {}
+            high_offsets = {}
+            nlow = nhigh = 0
+            for block_start in block_starts:
+                low_offsets[block_start] = nlow
+                high_offsets[block_start] = nhigh
+                nlow += blocks[block_start][0]
+                nhigh += blocks[block_start][1]
+
+            # Merge components that touch across block faces
+            low_pairs = []
+            high_pairs = []
+            for block_start in block_starts:
+                faces = blocks[block_start][5]
+                for axis in range(3):
+                    neighbor = list(block_start)
+                    neighbor[axis] += self._blockshape[axis]
+                    neighbor = tuple(neighbor)
+                    if neighbor not in blocks:
+                        continue
+                    neighbor_faces = blocks[neighbor][5]
+                    for i, pairs, offsets in ((0, low_pairs, low_offsets), (1, high_pairs, high_offsets)):
+                        labels = faces[(axis, 'upper')][i]
+                        neighbor_labels = neighbor_faces[(axis, 'lower')][i]
+                        touching = (labels > 0) & (neighbor_labels > 0)
+                        pairs.append(numpy.column_stack((labels[touching] + offsets[block_start],
+                                                         neighbor_labels[touching] + offsets[neighbor])))
+            low_lut = mergeLabels(nlow, low_pairs)
+            high_lut = mergeLabels(nhigh, high_pairs)
+
+            # Sizes of the merged components, and the high components that overlap each low component
+            low_sizes = numpy.zeros((low_lut.max()+1,), dtype=numpy.int64)
+            high_sizes = numpy.zeros((high_lut.max()+1,), dtype=numpy.int64)
+            overlap_low = []
+            overlap_high = []
+            for block_start in block_starts:
+                _, _, block_low_sizes, block_high_sizes, overlap, _ = blocks[block_start]
+                numpy.add.at(low_sizes, low_lut[low_offsets[block_start] + numpy.arange(len(block_low_sizes))], block_low_sizes)
+                numpy.add.at(high_sizes, high_lut[high_offsets[block_start] + numpy.arange(len(block_high_sizes))], block_high_sizes)
+                overlap_low.append(low_lut[overlap[:, 1] + low_offsets[block_start]])
+                overlap_high.append(high_lut[overlap[:, 0] + high_offsets[block_start]])
+            overlap_low = numpy.concatenate(overlap_low)
+            overlap_high = numpy.concatenate(overlap_high)
+
+            minSize = self.MinSize.value
+            maxSize = self.MaxSize.value
+            passed_high = (high_sizes >= minSize) & (high_sizes <= maxSize)
+            passed_high[0] = False
+            keep = numpy.zeros(low_sizes.shape, dtype=bool)
+            keep[overlap_low[passed_high[overlap_high]]] = True
+            keep &= (low_sizes >= minSize) & (low_sizes <= maxSize)
+            keep[0] = False
+
+            final_labels = numpy.zeros(keep.shape, dtype=numpy.uint32)
+            final_labels[keep] = numpy.arange(1, keep.sum()+1, dtype=numpy.uint32)
+            lut = final_labels[low_lut]
+
+        logger.debug("Hysteresis thresholding of time slice {} ({} blocks, {} objects) took {} seconds".format(
+            t, len(block_starts), keep.sum(), timer.seconds()))
+        return lut, low_offsets
+
+    def _analyzeBlock(self, t, shape, block_start, blocks):
+        """
+        Label one block and store the number of low and high labels,
+        their sizes, the overlapping (high, low) label pairs and the labels
+        on the block faces in blocks[block_start].
+        """
+        block_roi = getBlockBounds(shape, self._blockshape, block_start)
+        low, high = self._labelBlock(t, block_roi)
+        nlow = int(low.max())
+        nhigh = int(high.max())
+
+        low_sizes = numpy.bincount(low.ravel(), minlength=nlow+1)
+        high_sizes = numpy.bincount(high.ravel(), minlength=nhigh+1)
+        low_sizes[0] = high_sizes[0] = 0
+
+        both = (low > 0) & (high > 0)
+        codes = numpy.unique(high[both].astype(numpy.int64) * (nlow+1) + low[both])
+        overlap = numpy.column_stack((codes // (nlow+1), codes % (nlow+1)))
+
+        faces = {}
+        for axis in range(3):
+            if block_roi[0][axis] > 0:
+                faces[(axis, 'lower')] = (numpy.take(low, 0, axis=axis), numpy.take(high, 0, axis=axis))
+            if block_roi[1][axis] < shape[axis]:
+                faces[(axis, 'upper')] = (numpy.take(low, -1, axis=axis), numpy.take(high, -1, axis=axis))
+        blocks[block_start] = (nlow, nhigh, low_sizes, high_sizes, overlap, faces)
+
+    def _relabelBlock(self, t, shape, block_start, lut, offsets, request_roi, result_view):
+        block_roi = getBlockBounds(shape, self._blockshape, block_start)
+        intersection = getIntersection(block_roi, request_roi)
+        source = roiToSlice(*numpy.subtract(intersection, block_roi[0]))
+        dest = roiToSlice(*numpy.subtract(intersection, request_roi[0]))
+
+        low = self._labelBlock(t, block_roi, withHigh=False)[0][source]
+        low = numpy.where(low, low + numpy.uint32(offsets[block_start]), 0)
+        result_view[dest] = lut.take(low)
+
+    def _labelBlock(self, t, block_roi, withHigh=True):
+        """
+        Return the connected components of the low and (if withHigh) high
+        threshold masks of one block.
+        """
+        start = [t] + list(block_roi[0]) + [0]
+        stop = [t+1] + list(block_roi[1]) + [1]
+        data = self.InputImage(start, stop).wait()[0, ..., 0]
+        low = self._label(data > self._threshold(self.LowThreshold.value))
+        high = None
+        if withHigh:
+            high = self._label(data > self._threshold(self.HighThreshold.value))
+        return low, high
+
+    def _threshold(self, value):
+        drange = self.InputImage.meta.drange
+        if drange is not None:
+            assert drange[0] == 0,\
+                "Don't know how to threshold data with this drange."
+            value *= drange[1]
+        return value
+
+    @staticmethod
+    def _label(mask):
+        labels = vigra.analysis.labelVolumeWithBackground(mask.astype(numpy.uint8))
+        return numpy.asarray(labels)
@@ -28,14 +28,15 @@ from ilastik.utility.exportingOperator import ExportingOperator
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 import pgmlink
-from ilastik.applets.tracking.base.trackingUtilities import relabel, \
-    get_dict_value
+from ilastik.applets.tracking.base.trackingUtilities import relabel_lut, apply_lut, \
+    filter_objects, get_dict_value
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.objectExtraction import config
 from ilastik.applets.base.applet import DatasetConstraintError
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.valueProviders import OpZeroDefault
 from lazyflow.roi import sliceToRoi
+from lazyflow.utility.timer import Timer
 
 
 logger = logging.getLogger(__name__)
@@ -69,6 +70,10 @@ class OpTrackingBase(Operator, ExportingOperator):
         self.label2color = []
         self.mergers = []
 
+        # label2color and mergers as lookup tables (see relabel_lut)
+        self.label2colorLuts = []
+        self.mergerLuts = []
+
         self.track_id = None
         self.extra_track_ids = None
         self.divisions = None
@@ -143,8 +148,8 @@ class OpTrackingBase(Operator, ExportingOperator):
             t_end = roi.stop[0]
             for t in range(t_start, t_end):
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][
-                    0]) and len(self.label2color) > t:
-                    result[t - t_start, ..., 0] = relabel(result[t - t_start, ..., 0], self.label2color[t])
+                    0]) and len(self.label2colorLuts) > t:
+                    result[t - t_start, ..., 0] = apply_lut(result[t - t_start, ..., 0], self.label2colorLuts[t])
                 else:
                     result[t - t_start, ...] = 0
             return result
@@ -331,6 +336,8 @@ class OpTrackingBase(Operator, ExportingOperator):
 
         self.label2color = label2color
         self.mergers = mergers
+        self.label2colorLuts = [relabel_lut(l2c_at) for l2c_at in label2color]
+        self.mergerLuts = [relabel_lut(mergers_at) for mergers_at in mergers]
 
         self.Output._value = None
         self.Output.setDirty(slice(None))
@@ -439,104 +446,94 @@ class OpTrackingBase(Operator, ExportingOperator):
                 ct = ct[1:, ...]
 
             logger.info("at timestep {}, {} traxels found".format(t, rc.shape[0]))
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:
-                    x, y, z = rc[idx]
-                else:
+            with Timer() as frameTimer:
+                n_dim = rc.shape[1] if rc.ndim == 2 else 0
+                if rc.shape[0] > 0 and n_dim not in (2, 3):
                     raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                            y < y_range[0] or y >= y_range[1] or
-                            z < z_range[0] or z >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
-                tr = pgmlink.Traxel()
-                tr.set_x_scale(x_scale)
-                tr.set_y_scale(y_scale)
-                tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
-                tr.Timestep = t
+                passed = filter_objects(rc, ct, x_range, y_range, z_range, size_range)
+                filtered_labels_at = (np.flatnonzero(~passed) + 1).tolist()
+                indices = np.flatnonzero(passed)
+                count = len(indices)
 
                 # pgmlink expects always 3 coordinates, z=0 for 2d data
-                tr.add_feature_array("com", 3)
-                for i, v in enumerate([x, y, z]):
-                    tr.set_feature_value('com', i, float(v))
-
+                coms = np.zeros((rc.shape[0], 3))
+                coms[:, :n_dim] = rc
+                coms = coms[indices].tolist()
+                sizes = np.asarray(ct, dtype=np.float64).ravel()[indices].tolist()
                 if with_opt_correction:
-                    tr.add_feature_array("com_corrected", 3)
-                    for i, v in enumerate(rc_corr[idx]):
-                        tr.set_feature_value("com_corrected", i, float(v))
-                    if len(rc_corr[idx]) == 2:
-                        tr.set_feature_value("com_corrected", 2, 0.)
-
-                if with_div:
-                    tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx + 1][1]))
-
-                if with_classifier_prior:
-                    tr.add_feature_array("detProb", len(detProbs[t][idx + 1]))
-                    for i, v in enumerate(detProbs[t][idx + 1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        tr.set_feature_value("detProb", i, float(v))
-
-
-                # FIXME: check whether it is 2d or 3d data!
-                if with_local_centers:
-                    tr.add_feature_array("localCentersX", len(localCenters[t][idx + 1]))
-                    tr.add_feature_array("localCentersY", len(localCenters[t][idx + 1]))
-                    tr.add_feature_array("localCentersZ", len(localCenters[t][idx + 1]))
-                    for i, v in enumerate(localCenters[t][idx + 1]):
-                        tr.set_feature_value("localCentersX", i, float(v[0]))
-                        tr.set_feature_value("localCentersY", i, float(v[1]))
-                        tr.set_feature_value("localCentersZ", i, float(v[2]))
-
-                tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
+                    coms_corrected = np.zeros((rc.shape[0], 3))
+                    coms_corrected[:, :rc_corr.shape[-1]] = rc_corr
+                    coms_corrected = coms_corrected[indices].tolist()
                 if median_object_size is not None:
-                    obj_sizes.append(float(size))
-
-                ts.add(tr)
-
-                # add coordinate lists
-
-                if with_coordinate_list and coordinate_map is not None:  # store coordinates in arma::mat
-                    # generate roi: assume the following order: txyzc
-                    n_dim = len(rc[idx])
-                    roi = [0] * 5
-                    roi[0] = slice(int(t), int(t + 1))
-                    roi[1] = slice(int(lower[idx][0]), int(upper[idx][0] + 1))
-                    roi[2] = slice(int(lower[idx][1]), int(upper[idx][1] + 1))
-                    if n_dim == 3:
-                        roi[3] = slice(int(lower[idx][2]), int(upper[idx][2] + 1))
-                    else:
-                        assert n_dim == 2
-                    image_excerpt = self.LabelImage[roi].wait()
-                    if n_dim == 2:
-                        image_excerpt = image_excerpt[0, ..., 0, 0]
-                    elif n_dim == 3:
-                        image_excerpt = image_excerpt[0, ..., 0]
-                    else:
-                        raise Exception, "n_dim = %s instead of 2 or 3"
-
-                    pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower[idx].astype(np.int64), tr)
+                    obj_sizes.extend(sizes)
+
+                for j, idx in enumerate(indices.tolist()):
+                    tr = pgmlink.Traxel()
+                    tr.set_x_scale(x_scale)
+                    tr.set_y_scale(y_scale)
+                    tr.set_z_scale(z_scale)
+                    tr.Id = idx + 1
+                    tr.Timestep = t
+
+                    tr.add_feature_array("com", 3)
+                    for i, v in enumerate(coms[j]):
+                        tr.set_feature_value('com', i, v)
+
+                    if with_opt_correction:
+                        tr.add_feature_array("com_corrected", 3)
+                        for i, v in enumerate(coms_corrected[j]):
+                            tr.set_feature_value("com_corrected", i, v)
+
+                    if with_div:
+                        tr.add_feature_array("divProb", 1)
+                        # idx+1 because rc and ct start from 1, divProbs starts from 0
+                        tr.set_feature_value("divProb", 0, float(divProbs[t][idx + 1][1]))
+
+                    if with_classifier_prior:
+                        tr.add_feature_array("detProb", len(detProbs[t][idx + 1]))
+                        for i, v in enumerate(detProbs[t][idx + 1]):
+                            tr.set_feature_value("detProb", i, float(v))
+
+                    # FIXME: check whether it is 2d or 3d data!
+                    if with_local_centers:
+                        tr.add_feature_array("localCentersX", len(localCenters[t][idx + 1]))
+                        tr.add_feature_array("localCentersY", len(localCenters[t][idx + 1]))
+                        tr.add_feature_array("localCentersZ", len(localCenters[t][idx + 1]))
+                        for i, v in enumerate(localCenters[t][idx + 1]):
+                            tr.set_feature_value("localCentersX", i, float(v[0]))
+                            tr.set_feature_value("localCentersY", i, float(v[1]))
+                            tr.set_feature_value("localCentersZ", i, float(v[2]))
+
+                    tr.add_feature_array("count", 1)
+                    tr.set_feature_value("count", 0, sizes[j])
+
+                    ts.add(tr)
+
+                    # add coordinate lists
+
+                    if with_coordinate_list and coordinate_map is not None:  # store coordinates in arma::mat
+                        # generate roi: assume the following order: txyzc
+                        roi = [0] * 5
+                        roi[0] = slice(int(t), int(t + 1))
+                        roi[1] = slice(int(lower[idx][0]), int(upper[idx][0] + 1))
+                        roi[2] = slice(int(lower[idx][1]), int(upper[idx][1] + 1))
+                        if n_dim == 3:
+                            roi[3] = slice(int(lower[idx][2]), int(upper[idx][2] + 1))
+                        else:
+                            assert n_dim == 2
+                        image_excerpt = self.LabelImage[roi].wait()
+                        if n_dim == 2:
+                            image_excerpt = image_excerpt[0, ..., 0, 0]
+                        elif n_dim == 3:
+                            image_excerpt = image_excerpt[0, ..., 0]
+                        else:
+                            raise Exception, "n_dim = %s instead of 2 or 3"
+
+                        pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower[idx].astype(np.int64), tr)
 
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
-            logger.info("at timestep {}, {} traxels passed filter".format(t, count))
+            logger.info("at timestep {}, {} traxels passed filter ({:.2f} seconds)".format(t, count, frameTimer.seconds()))
             max_traxel_id_at.append(int(rc.shape[0]))
             if count == 0:
                 empty_frame = True
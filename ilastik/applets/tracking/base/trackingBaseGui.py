@@ -33,7 +33,7 @@ import numpy as np
 import vigra
 import h5py
 from ilastik.applets.labeling.labelingGui import LabelingGui
-from ilastik.applets.tracking.base.trackingUtilities import relabel,write_events
+from ilastik.applets.tracking.base.trackingUtilities import apply_lut,write_events
 from volumina.layer import GrayscaleLayer
 from volumina.utility import encode_from_qstring
 from ilastik.applets.layerViewer.layerViewerGui import LayerViewerGui
@@ -372,6 +372,7 @@ class TrackingBaseGui( LayerViewerGui ):
         logger.info( 'Saving results as tiffs...' )
 
         label2color = self.mainOperator.label2color
+        label2colorLuts = self.mainOperator.label2colorLuts
         lshape = list(self.mainOperator.LabelImage.meta.shape)
 
         def _handle_progress(x):
@@ -386,7 +387,7 @@ class TrackingBaseGui( LayerViewerGui ):
 
                 roi = SubRegion(self.mainOperator.LabelImage, start=[t,] + 4*[0,], stop=[t+1,] + list(lshape[1:]))
                 labelImage = self.mainOperator.LabelImage.get(roi).wait()
-                relabeled = relabel(labelImage[0,...,0],label2color_at)
+                relabeled = apply_lut(labelImage[0,...,0],label2colorLuts[t])
                 for i in range(relabeled.shape[2]):
                     out_im = relabeled[:,:,i]
                     out_fn = str(directory) + '/vis_t' + str(t).zfill(4) + '_z' + str(i).zfill(4) + '.tif'
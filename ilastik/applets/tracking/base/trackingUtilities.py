@@ -26,32 +26,55 @@ import pgmlink
 import logging
 logger = logging.getLogger(__name__)
 
+def relabel_lut(replace, default=1):
+    """
+    Convert the label mapping 'replace' (dict) into a lookup table for apply_lut().
+
+    The table maps background (0) to 0, every key of 'replace' to its value
+    and every other label to 'default'.  The last entry holds the default, so
+    that labels beyond the largest key can be mapped with take(mode='clip').
+    """
+    keys = np.fromiter(replace.iterkeys(), dtype=np.int64, count=len(replace))
+    values = np.fromiter(replace.itervalues(), dtype=np.int64, count=len(replace))
+    size = keys.max() + 2 if len(keys) else 2
+    lut = np.empty(size, dtype=np.uint32)
+    lut[:] = default
+    lut[keys] = values
+    lut[0] = 0
+    return lut
+
+def apply_lut(volume, lut):
+    """Map each label of 'volume' through a lookup table built by relabel_lut()."""
+    return lut.take(volume, mode='clip').astype(volume.dtype, copy=False)
+
 def relabel(volume, replace):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[1:] = 1
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            try:
-                r = replace[label]
-                mp[label] = r
-            except:                
-                pass
-#    mp[replace.keys()] = replace.values()
-    return mp[volume]
-    
-    
+    return apply_lut(volume, relabel_lut(replace))
+
 def relabelMergers(volume, merger):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)    
-    mp[:] = 0
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            if label in merger:
-                mp[label] = merger[label]
-            else:
-                mp[label] = 1
-    return mp[volume]
+    return apply_lut(volume, relabel_lut(merger))
+
+def filter_objects(centers, sizes, x_range, y_range, z_range, size_range):
+    """
+    Return a boolean mask of the objects that lie within all the given [min, max) ranges.
+
+    centers: array of shape (n, 2) or (n, 3) (the RegionCenter feature without background);
+             2D objects are treated as z=0
+    sizes: array with n entries (the Count feature without background)
+    """
+    if len(centers) == 0:
+        return np.zeros((0,), dtype=bool)
+    centers = np.asarray(centers, dtype=np.float64)
+    sizes = np.asarray(sizes, dtype=np.float64).ravel()
+    x, y = centers[:, 0], centers[:, 1]
+    if centers.shape[1] > 2:
+        z = centers[:, 2]
+    else:
+        z = np.zeros(len(centers))
+    rejected = ((x < x_range[0]) | (x >= x_range[1]) |
+                (y < y_range[0]) | (y >= y_range[1]) |
+                (z < z_range[0]) | (z >= z_range[1]) |
+                (sizes < size_range[0]) | (sizes >= size_range[1]))
+    return ~rejected
 
 def get_dict_value(dic, key, default=[]):
     if key not in dic:
@@ -106,8 +129,110 @@ def get_events_at(eventsVector, t):
     return events_at
 
 
+def merge_window_events(events, window_events, offset, first_key, last_key):
+    """
+    Copy the per-frame entries of a tracking window into those of the whole time range.
+
+    Both dicts are keyed by the frame index (as string) relative to the start of their
+    own time range, like the output of get_events().  The window starts 'offset' frames
+    after the whole time range; only its frames that map to first_key..last_key (inclusive)
+    are copied.  Multi-frame moves are shifted to refer to the whole time range.
+    """
+    for key, value in window_events.iteritems():
+        global_key = int(key) + offset
+        if global_key < first_key or global_key > last_key:
+            continue
+        if isinstance(value, dict) and 'multiMove' in value:
+            multi_move = value['multiMove'].copy()
+            multi_move[multi_move[:, 2] >= 0, 2] += offset
+            value = dict(value, multiMove=multi_move)
+        events[str(global_key)] = value
+    return events
+
+def active_objects(events_at):
+    """Ids of the objects that are part of a track in the frame described by events_at."""
+    active = set()
+    for e in get_dict_value(events_at, "app", []):
+        active.add(int(e[0]))
+    for e in get_dict_value(events_at, "mov", []):
+        active.add(int(e[1]))
+    for e in get_dict_value(events_at, "div", []):
+        active.update((int(e[1]), int(e[2])))
+    return active
+
+def _transitions(events_at):
+    # the object ids of the events that decide which objects are tracked, without the energies
+    return dict((key, sorted(tuple(int(i) for i in e[:-1]) for e in get_dict_value(events_at, key, [])))
+                for key in ("app", "mov", "div"))
+
+def find_window_seam(events, window_events, offset, candidates):
+    """
+    Return the first of the candidate frames (keys of 'events') in which the tracking
+    window agrees with 'events' on the appearances, moves and divisions, or None.
+
+    Taking the events up to such a frame from 'events' and after it from the window
+    continues every track across the seam.  The window starts 'offset' frames after
+    'events'; the candidates must lie in the window, but not in its first frame.
+    """
+    for key in candidates:
+        if _transitions(events.get(str(key), {})) == _transitions(window_events.get(str(key - offset), {})):
+            return key
+    return None
+
+def stitch_window_seam(events, seam):
+    """
+    Make the events after frame 'seam' consistent with those up to it, after they have
+    been merged from different tracking windows (see merge_window_events()).
+
+    Moves and divisions out of objects that are not tracked in frame 'seam' would start
+    new tracks in the past; they are turned into appearances instead.  The same applies
+    to multi-frame moves out of frames up to 'seam'.  Returns the number of changed events.
+    """
+    key = str(seam + 1)
+    if key not in events:
+        return 0
+    events_at = dict(events[key])
+    active = {}
+    def is_active(t, obj):
+        if t not in active:
+            active[t] = active_objects(events.get(str(t), {}))
+        return obj in active[t]
+
+    app = list(get_dict_value(events_at, "app", []))
+    changed = 0
+    for name in ("mov", "div"):
+        kept = []
+        for e in get_dict_value(events_at, name, []):
+            if is_active(seam, int(e[0])):
+                kept.append(e)
+            else:
+                app.extend((child, e[-1]) for child in e[1:-1])
+                changed += 1
+        events_at[name] = np.asarray(kept)
+
+    multi_kept = []
+    for e in get_dict_value(events_at, "multiMove", []):
+        if 0 <= int(e[2]) <= seam and not is_active(int(e[2]), int(e[0])):
+            app.append((e[1], e[-1]))
+            changed += 1
+        else:
+            multi_kept.append(e)
+    events_at["multiMove"] = np.asarray(multi_kept)
+    events_at["app"] = np.asarray(app)
+
+    if changed:
+        for name in ("app", "mov", "div", "multiMove"):
+            if len(events_at[name]) == 0:
+                del events_at[name]
+        events[key] = events_at
+    return changed
+
+def events_filename(directory, t):
+    """The file write_events() writes the events of frame t to."""
+    return directory + "/" + str(t).zfill(5)  + ".h5"
+
 def write_events(events_at, directory, t, labelImage, mergers=None):
-        fn =  directory + "/" + str(t).zfill(5)  + ".h5"
+        fn = events_filename(directory, t)
         
         logger.info( "-- Writing results to " + path.basename(fn) ) 
         if len(events_at) == 0:
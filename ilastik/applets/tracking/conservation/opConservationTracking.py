@@ -1,10 +1,13 @@
+import os
+
 from lazyflow.graph import InputSlot, OutputSlot
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 import pgmlink
 from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
-from ilastik.applets.tracking.base.trackingUtilities import relabelMergers
-from ilastik.applets.tracking.base.trackingUtilities import get_events
+from ilastik.applets.tracking.base.trackingUtilities import apply_lut
+from ilastik.applets.tracking.base.trackingUtilities import get_events, merge_window_events, write_events, events_filename
+from ilastik.applets.tracking.base.trackingUtilities import find_window_seam, stitch_window_seam
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.roi import sliceToRoi
 
@@ -49,8 +52,8 @@ class OpConservationTracking(OpTrackingBase):
             
             trange = range(roi.start[0], roi.stop[0])
             for t in trange:
-                if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0] and len(self.mergers) > t and len(self.mergers[t])):
-                    result[t-roi.start[0],...,0] = relabelMergers(result[t-roi.start[0],...,0], self.mergers[t])
+                if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0] and len(self.mergerLuts) > t and len(self.mergers[t])):
+                    result[t-roi.start[0],...,0] = apply_lut(result[t-roi.start[0],...,0], self.mergerLuts[t])
                 else:
                     result[t-roi.start[0],...][:] = 0
             
@@ -85,8 +88,26 @@ class OpConservationTracking(OpTrackingBase):
             borderAwareWidth = 0.0,
             withArmaCoordinates = True,
             appearance_cost = 500,
-            disappearance_cost = 500
+            disappearance_cost = 500,
+            windowLength=None,
+            windowOverlap=10,
+            export_directory=None
             ):
+        """
+        Track the objects in time_range.
+
+        If windowLength is given, the time range is solved in overlapping windows of
+        windowLength frames instead of as a whole, which bounds the size of the graph
+        and the memory used by the solver.  Consecutive windows share windowOverlap frames;
+        the events are cut over in an overlapping frame where both windows agree on the
+        tracks (as close to the middle of the overlap as possible), so track ids continue
+        across window boundaries.  If there is no such frame, objects that are not tracked
+        on both sides of the cut start new tracks.
+
+        If export_directory is given, the events of each frame are written there
+        (see write_events()) as soon as they are final.  The directory must exist and
+        must not contain event files of the time range yet; this is checked up front.
+        """
         
         if not self.Parameters.ready():
             raise Exception("Parameter slot is not ready")
@@ -108,6 +129,8 @@ class OpConservationTracking(OpTrackingBase):
         parameters['withArmaCoordinates'] = withArmaCoordinates
         parameters['appearanceCost'] = appearance_cost
         parameters['disappearanceCost'] = disappearance_cost
+        parameters['windowLength'] = windowLength
+        parameters['windowOverlap'] = windowOverlap
                 
         if cplex_timeout:
             parameters['cplex_timeout'] = cplex_timeout
@@ -127,90 +150,167 @@ class OpConservationTracking(OpTrackingBase):
                     'Check whether you have (i) the correct number of label names specified in Object Count Classification, and (ii) provided at least' \
                     'one training example for each class.'            
         
-        median_obj_size = [0]
+        if export_directory is not None:
+            if not os.path.isdir(export_directory):
+                raise Exception, 'The export directory {} does not exist.'.format(export_directory)
+            existing = [t for t in time_range if os.path.exists(events_filename(export_directory, t))]
+            if existing:
+                raise Exception, 'File {} exists already. Please choose a different folder or delete the file(s).'.format(
+                    events_filename(export_directory, existing[0]))
 
-        coordinate_map = pgmlink.TimestepIdCoordinateMap()
-        if withArmaCoordinates:
-            coordinate_map.initialize()
-        ts, empty_frame = self._generate_traxelstore(time_range, x_range, y_range, z_range, 
-                                                                      size_range, x_scale, y_scale, z_scale, 
-                                                                      median_object_size=median_obj_size, 
-                                                                      with_div=withDivisions,
-                                                                      with_opt_correction=withOpticalCorrection,
-                                                                      with_coordinate_list=withMergerResolution , # no vigra coordinate list, that is done by arma
-                                                                      with_classifier_prior=withClassifierPrior,
-                                                                      coordinate_map=coordinate_map)
-        
-        if empty_frame:
-            raise Exception, 'cannot track frames with 0 objects, abort.'
-              
-        
-        if avgSize[0] > 0:
-            median_obj_size = avgSize
-        
-        logger.info( 'median_obj_size = {}'.format( median_obj_size ) )
+        if windowLength is not None and windowLength < len(time_range):
+            if windowOverlap < 1 or windowOverlap >= windowLength:
+                raise Exception, 'The window overlap must be at least 1 and smaller than the window length.'
+            windows = self._trackingWindows(len(time_range), windowLength, windowOverlap)
+        else:
+            windows = [(0, len(time_range), len(time_range) - 1)]
 
-        ep_gap = 0.05
-        transition_parameter = 5
-        
-        fov = pgmlink.FieldOfView(time_range[0] * 1.0,
-                                      x_range[0] * x_scale,
-                                      y_range[0] * y_scale,
-                                      z_range[0] * z_scale,
-                                      time_range[-1] * 1.0,
-                                      (x_range[1]-1) * x_scale,
-                                      (y_range[1]-1) * y_scale,
-                                      (z_range[1]-1) * z_scale,)
-        
-        logger.info( 'fov = {},{},{},{},{},{},{},{}'.format( time_range[0] * 1.0,
-                                      x_range[0] * x_scale,
-                                      y_range[0] * y_scale,
-                                      z_range[0] * z_scale,
-                                      time_range[-1] * 1.0,
-                                      (x_range[1]-1) * x_scale,
-                                      (y_range[1]-1) * y_scale,
-                                      (z_range[1]-1) * z_scale, ) )
-        
         if ndim == 2:
             assert z_range[0] * z_scale == 0 and (z_range[1]-1) * z_scale == 0, "fov of z must be (0,0) if ndim==2"
 
-        tracker = pgmlink.ConsTracking(maxObj,
-                                         float(maxDist),
-                                         float(divThreshold),
-                                         "none",  # detection_rf_filename
-                                         sizeDependent,   # size_dependent_detection_prob
-                                         0,       # forbidden_cost
-                                         float(ep_gap), # ep_gap
-                                         float(median_obj_size[0]), # median_object_size
-                                         withTracklets,
-                                         divWeight,
-                                         transWeight,
-                                         withDivisions,
-                                         disappearance_cost, # disappearance cost
-                                         appearance_cost, # appearance cost
-                                         withMergerResolution,
-                                         ndim,
-                                         transition_parameter,
-                                         borderAwareWidth,
-                                         fov,
-                                         True, #with_constraints
-                                         cplex_timeout,
-                                         "none" # dump traxelstore
-                                         )
+        median_obj_size = [0]
+        if avgSize[0] > 0:
+            median_obj_size = avgSize
 
-        
-        try:
-            eventsVector = tracker(ts, coordinate_map.get())
-        except Exception as e:
-            raise Exception, 'Tracking terminated unsuccessfully: ' + str(e)
-        
-        if len(eventsVector) == 0:
-            raise Exception, 'Tracking terminated unsuccessfully: Events vector has zero length.'
-        
-        events = get_events(eventsVector)
+        def solve(window_range):
+            coordinate_map = pgmlink.TimestepIdCoordinateMap()
+            if withArmaCoordinates:
+                coordinate_map.initialize()
+            window_median_obj_size = [0]
+            ts, empty_frame = self._generate_traxelstore(window_range, x_range, y_range, z_range,
+                                                                          size_range, x_scale, y_scale, z_scale,
+                                                                          median_object_size=window_median_obj_size,
+                                                                          with_div=withDivisions,
+                                                                          with_opt_correction=withOpticalCorrection,
+                                                                          with_coordinate_list=withMergerResolution , # no vigra coordinate list, that is done by arma
+                                                                          with_classifier_prior=withClassifierPrior,
+                                                                          coordinate_map=coordinate_map)
+
+            if empty_frame:
+                raise Exception, 'cannot track frames with 0 objects, abort.'
+
+            # All windows use the median object size of the first one
+            if median_obj_size[0] <= 0:
+                median_obj_size[0] = window_median_obj_size[0]
+
+            logger.info( 'median_obj_size = {}'.format( median_obj_size ) )
+
+            ep_gap = 0.05
+            transition_parameter = 5
+
+            fov = pgmlink.FieldOfView(window_range[0] * 1.0,
+                                          x_range[0] * x_scale,
+                                          y_range[0] * y_scale,
+                                          z_range[0] * z_scale,
+                                          window_range[-1] * 1.0,
+                                          (x_range[1]-1) * x_scale,
+                                          (y_range[1]-1) * y_scale,
+                                          (z_range[1]-1) * z_scale,)
+
+            logger.info( 'fov = {},{},{},{},{},{},{},{}'.format( window_range[0] * 1.0,
+                                          x_range[0] * x_scale,
+                                          y_range[0] * y_scale,
+                                          z_range[0] * z_scale,
+                                          window_range[-1] * 1.0,
+                                          (x_range[1]-1) * x_scale,
+                                          (y_range[1]-1) * y_scale,
+                                          (z_range[1]-1) * z_scale, ) )
+
+            tracker = pgmlink.ConsTracking(maxObj,
+                                             float(maxDist),
+                                             float(divThreshold),
+                                             "none",  # detection_rf_filename
+                                             sizeDependent,   # size_dependent_detection_prob
+                                             0,       # forbidden_cost
+                                             float(ep_gap), # ep_gap
+                                             float(median_obj_size[0]), # median_object_size
+                                             withTracklets,
+                                             divWeight,
+                                             transWeight,
+                                             withDivisions,
+                                             disappearance_cost, # disappearance cost
+                                             appearance_cost, # appearance cost
+                                             withMergerResolution,
+                                             ndim,
+                                             transition_parameter,
+                                             borderAwareWidth,
+                                             fov,
+                                             True, #with_constraints
+                                             cplex_timeout,
+                                             "none" # dump traxelstore
+                                             )
+
+            try:
+                eventsVector = tracker(ts, coordinate_map.get())
+            except Exception as e:
+                raise Exception, 'Tracking terminated unsuccessfully: ' + str(e)
+
+            if len(eventsVector) == 0:
+                raise Exception, 'Tracking terminated unsuccessfully: Events vector has zero length.'
+
+            return get_events(eventsVector)
+
+        events = {}
+        filtered_labels = {}
+        first_key = 0
+        for i, (start, stop, _) in enumerate(windows):
+            logger.info( 'tracking frames {} to {}'.format( time_range[start], time_range[stop - 1] ) )
+            window_events = solve(time_range[start:stop])
+
+            if i == 0:
+                seam = -1
+            else:
+                # Cut over to this window in an overlap frame where both solutions agree,
+                # preferring the middle of the overlap, so that all tracks continue.
+                prev_stop, preferred = windows[i - 1][1], windows[i - 1][2]
+                candidates = sorted(range(start + 1, prev_stop), key=lambda k: (abs(k - preferred), k))
+                seam = find_window_seam(events, window_events, start, candidates)
+                if seam is None:
+                    seam = preferred
+                    logger.warn( 'tracking windows disagree in all overlapping frames, some tracks may end at frame {}'.format( time_range[seam] ) )
+            merge_window_events(events, window_events, start, seam + 1, stop - 1)
+            merge_window_events(filtered_labels, self.FilteredLabels.value, start, seam + 1, stop - 1)
+            if i > 0:
+                changed = stitch_window_seam(events, seam)
+                if changed:
+                    logger.info( '{} events after frame {} turned into appearances'.format( changed, time_range[seam] ) )
+
+                if export_directory is not None:
+                    for key in range(first_key, seam + 1):
+                        self._exportEvents(events[str(key)], export_directory, time_range[0] + key)
+                first_key = seam + 1
+
+        if export_directory is not None:
+            for key in range(first_key, len(time_range)):
+                self._exportEvents(events[str(key)], export_directory, time_range[0] + key)
+
+        parameters['time_range'] = [min(time_range), max(time_range)]
+        self.FilteredLabels.setValue(filtered_labels, check_changed=False)
         self.Parameters.setValue(parameters, check_changed=False)
         self.EventsVector.setValue(events, check_changed=False)
-        
+
+    @staticmethod
+    def _trackingWindows(nframes, windowLength, windowOverlap):
+        """
+        Split nframes frames into overlapping windows.
+
+        Returns a list of (start, stop, last_key): the window covers frames [start, stop),
+        and by default the events up to (and including) last_key are taken from it.
+        The next window's events take over in the middle of the overlap.
+        """
+        windows = []
+        start = 0
+        while start + windowLength < nframes:
+            next_start = start + windowLength - windowOverlap
+            windows.append( (start, start + windowLength, next_start + windowOverlap // 2) )
+            start = next_start
+        windows.append( (start, nframes, nframes - 1) )
+        return windows
+
+    def _exportEvents(self, events_at, directory, t):
+        shape = self.LabelImage.meta.shape
+        labelImage = self.LabelImage([t, 0, 0, 0, 0], [t + 1] + list(shape[1:])).wait()
+        write_events(events_at, directory, t, labelImage[0, ..., 0])
 
     def propagateDirty(self, inputSlot, subindex, roi):
         super(OpConservationTracking, self).propagateDirty(inputSlot, subindex, roi)
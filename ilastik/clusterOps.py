@@ -20,10 +20,12 @@
 ###############################################################################
 import os
 import copy
+import time
 import subprocess
 import collections
 import hashlib
 import functools
+import multiprocessing
 
 import numpy
 
@@ -126,6 +128,93 @@ class OpTaskWorker(Operator):
             op = op.parent
         return op
 
+class LocalTaskPool(object):
+    """
+    Runs a set of cluster task commands as subprocesses on the local machine.
+    At most ``max_workers`` tasks run at once.  A task is considered finished
+    when its process exits with status 0 AND ``isTaskComplete(roi)`` returns True.
+    Failed tasks are relaunched up to ``max_retries`` times.
+    """
+    def __init__(self, workingDirectory, max_workers, max_retries=0, poll_interval=1.0):
+        assert max_workers > 0
+        self._workingDirectory = workingDirectory
+        self._max_workers = max_workers
+        self._max_retries = max_retries
+        self._poll_interval = poll_interval
+        self.progressSignal = OrderedSignal()
+        
+        #: roi -> list of runtimes (in seconds) of every attempt
+        self.taskTimes = collections.OrderedDict()
+        self.failedRois = []
+
+    def run(self, taskInfos, isTaskComplete):
+        """
+        Execute all tasks in taskInfos (a dict of roi -> TaskInfo) and block until
+        they are all finished or have exhausted their retries.
+        Returns True if every task completed successfully.
+        """
+        pending = collections.deque( taskInfos.items() )
+        attempts = collections.defaultdict(int)
+        running = {} # roi -> (taskInfo, process, startTime)
+        totalTasks = len(pending)
+        finishedTasks = 0
+        self.failedRois = []
+        self.progressSignal(0)
+
+        try:
+            while pending or running:
+                # Launch as many tasks as we're allowed
+                while pending and len(running) < self._max_workers:
+                    roi, taskInfo = pending.popleft()
+                    attempts[roi] += 1
+                    logger.info( "Launching local task {} (attempt {}): {}".format( taskInfo.taskName, attempts[roi], taskInfo.command ) )
+                    process = subprocess.Popen( taskInfo.command, shell=True, cwd=self._workingDirectory )
+                    running[roi] = (taskInfo, process, time.time())
+
+                time.sleep( self._poll_interval )
+
+                # Collect finished tasks
+                for roi, (taskInfo, process, startTime) in list(running.items()):
+                    returnCode = process.poll()
+                    if returnCode is None:
+                        continue
+                    del running[roi]
+                    self.taskTimes.setdefault(roi, []).append( time.time() - startTime )
+
+                    if returnCode == 0 and isTaskComplete(roi):
+                        logger.info( "Task {} finished in {:.1f} seconds".format( taskInfo.taskName, self.taskTimes[roi][-1] ) )
+                        finishedTasks += 1
+                        self.progressSignal( 100.0 * finishedTasks / totalTasks )
+                    elif attempts[roi] <= self._max_retries:
+                        logger.warn( "Task {} failed (return code {}).  Retrying.".format( taskInfo.taskName, returnCode ) )
+                        pending.append( (roi, taskInfo) )
+                    else:
+                        logger.error( "Task {} failed (return code {}) after {} attempts.  Giving up."
+                                      "".format( taskInfo.taskName, returnCode, attempts[roi] ) )
+                        self.failedRois.append( roi )
+                        finishedTasks += 1
+                        self.progressSignal( 100.0 * finishedTasks / totalTasks )
+        finally:
+            # If we're exiting early (e.g. KeyboardInterrupt), don't leave orphaned tasks running.
+            for taskInfo, process, _ in running.values():
+                if process.poll() is None:
+                    logger.warn( "Terminating task {}".format( taskInfo.taskName ) )
+                    process.terminate()
+
+        self._logTimingSummary()
+        self.progressSignal(100)
+        return len(self.failedRois) == 0
+
+    def _logTimingSummary(self):
+        if not self.taskTimes:
+            return
+        times = numpy.array( [ t[-1] for t in self.taskTimes.values() ] )
+        totalAttempts = sum( len(t) for t in self.taskTimes.values() )
+        logger.info( "Ran {} blocks ({} attempts, {} failed) with {} workers.  "
+                     "Block time: min={:.1f}s, mean={:.1f}s, max={:.1f}s, total={:.1f}s"
+                     "".format( len(self.taskTimes), totalAttempts, len(self.failedRois), self._max_workers,
+                                times.min(), times.mean(), times.max(), times.sum() ) )
+
 class OpClusterize(Operator):
     Input = InputSlot()
     OutputDatasetDescription = InputSlot()
@@ -138,6 +227,10 @@ class OpClusterize(Operator):
         taskName = None
         command = None
         subregion = None
+
+    def __init__(self, *args, **kwargs):
+        super( OpClusterize, self ).__init__( *args, **kwargs )
+        self.progressSignal = OrderedSignal()
         
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
@@ -158,10 +251,13 @@ class OpClusterize(Operator):
         try:
             # Figure out which work doesn't need to be recomputed (if any)
             unneeded_rois = []
+            locked_rois = []
             for roi in taskInfos.keys():
-                if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE \
-                or blockwiseFileset.isBlockLocked(roi[0]): # We don't attempt to process currently locked blocks.
+                if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE:
+                    unneeded_rois.append( roi )
+                elif blockwiseFileset.isBlockLocked(roi[0]): # We don't attempt to process currently locked blocks.
                     unneeded_rois.append( roi )
+                    locked_rois.append( roi )
     
             # Remove any tasks that we don't need to compute (they were finished in a previous run)
             for roi in unneeded_rois:
@@ -169,6 +265,11 @@ class OpClusterize(Operator):
                 del taskInfos[roi]
 
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
+            if self._config.task_executor == "local_pool":
+                # Run the tasks ourselves and wait for them to finish.
+                result[0] = self._executeLocalPool( blockwiseFileset, taskInfos, absWorkDir, locked_rois )
+                return result
+
             if self._config.task_launch_server == "localhost":
                 def localCommand( cmd ):
                     cwd = os.getcwd()
@@ -197,6 +298,60 @@ class OpClusterize(Operator):
         finally:
             blockwiseFileset.close()
 
+    def _executeLocalPool(self, blockwiseFileset, taskInfos, absWorkDir, lockedRois=()):
+        """
+        Run all tasks on a bounded pool of local processes and monitor them until
+        every block of the output fileset is available.
+        Blocks in lockedRois are being computed by another process; we wait until
+        their locks are released (at most task_timeout_secs, if configured).
+        Returns True only if every block of the fileset is available in the end.
+        """
+        max_workers = self._config.local_pool_max_workers
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        max_retries = self._config.task_max_retries or 0
+        poll_interval = self._config.task_poll_interval_secs or 1.0
+
+        def isTaskComplete( roi ):
+            return blockwiseFileset.getBlockStatus( roi[0] ) == BlockwiseFileset.BLOCK_AVAILABLE
+
+        logger.info( "Running {} tasks on a local pool of {} workers".format( len(taskInfos), max_workers ) )
+        pool = LocalTaskPool( absWorkDir, max_workers, max_retries, poll_interval )
+        pool.progressSignal.subscribe( self.progressSignal )
+        with Timer() as poolTimer:
+            success = pool.run( taskInfos, isTaskComplete )
+        logger.info( "Local pool finished in {:.1f} seconds".format( poolTimer.seconds() ) )
+
+        self._waitForLockedBlocks( blockwiseFileset, lockedRois, poll_interval, self._config.task_timeout_secs )
+
+        allRois = blockwiseFileset.getAllBlockRois()
+        incomplete = [ roi for roi in allRois if not isTaskComplete( roi ) ]
+        if incomplete:
+            logger.error( "{} of {} blocks are not available: {}".format( len(incomplete), len(allRois), incomplete ) )
+        return success and not incomplete
+
+    @staticmethod
+    def _waitForLockedBlocks(blockwiseFileset, lockedRois, poll_interval, timeout=None):
+        """
+        Block until none of the given blocks is locked by another process any more,
+        or until timeout seconds have passed.
+        """
+        def isLocked( roi ):
+            return blockwiseFileset.getBlockStatus( roi[0] ) != BlockwiseFileset.BLOCK_AVAILABLE \
+                   and blockwiseFileset.isBlockLocked( roi[0] )
+
+        waiting = [ roi for roi in lockedRois if isLocked( roi ) ]
+        if not waiting:
+            return
+        logger.info( "Waiting for {} blocks that are locked by another process".format( len(waiting) ) )
+        startTime = time.time()
+        while waiting:
+            if timeout is not None and time.time() - startTime > timeout:
+                logger.error( "Gave up waiting for locked blocks: {}".format( waiting ) )
+                return
+            time.sleep( poll_interval )
+            waiting = [ roi for roi in waiting if isLocked( roi ) ]
+
     def _prepareTaskInfos(self, roiList):
         # Divide up the workload into large pieces
         logger.info( "Dividing into {} node jobs.".format( len(roiList) ) )
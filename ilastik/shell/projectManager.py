@@ -21,6 +21,7 @@
 import os
 import gc
 import copy
+import shutil
 import platform
 import h5py
 import logging
@@ -227,11 +228,7 @@ class ProjectManager(object):
                     aplt.progressSignal.emit(0)
         try:
             # Applet serializable items are given the whole file (root group) for now
-            for aplt in self._applets:
-                for item in aplt.dataSerializers:
-                    assert item.base_initialized, "AppletSerializer subclasses must call AppletSerializer.__init__ upon construction."
-                    if force_all_save or item.isDirty() or item.shouldSerialize(self.currentProjectFile):
-                        item.serializeToHdf5(self.currentProjectFile, self.currentProjectPath)
+            self._serializeApplets(self.currentProjectFile, self.currentProjectPath, force_all_save)
             
             #save the current workflow as standard workflow
             if "workflowName" in self.currentProjectFile:
@@ -257,29 +254,20 @@ class ProjectManager(object):
         Copy the project file as it is, then serialize any dirty state into the copy.
         Original serializers and project file should not be touched.
         """
-        with h5py.File(snapshotPath, 'w') as snapshotFile:
-            # Minor GUI nicety: Pre-activate the progress signals for dirty applets so
-            #  the progress manager treats these tasks as a group instead of several sequential jobs.
-            for aplt in self._applets:
-                for ser in aplt.dataSerializers:
-                    if ser.isDirty():
-                        aplt.progressSignal.emit(0)
+        # Minor GUI nicety: Pre-activate the progress signals for dirty applets so
+        #  the progress manager treats these tasks as a group instead of several sequential jobs.
+        for aplt in self._applets:
+            for ser in aplt.dataSerializers:
+                if ser.isDirty():
+                    aplt.progressSignal.emit(0)
 
-            # Start by copying the current project state into the file
-            # This should be faster than serializing everything from scratch
-            for key in self.currentProjectFile.keys():
-                snapshotFile.copy(self.currentProjectFile[key], key)
+        # Start by copying the current project state into the file.
+        self._copyProjectFile(snapshotPath)
 
+        with h5py.File(snapshotPath, 'r+') as snapshotFile:
             try:
-                # Applet serializable items are given the whole file (root group) for now
-                for aplt in self._applets:
-                    for item in aplt.dataSerializers:
-                        assert item.base_initialized, "AppletSerializer subclasses must call AppletSerializer.__init__ upon construction."
-
-                        if item.isDirty() or item.shouldSerialize(self.currentProjectFile):
-                            # Use a COPY of the serializer, so the original serializer doesn't forget it's dirty state
-                            itemCopy = copy.copy(item)
-                            itemCopy.serializeToHdf5(snapshotFile, snapshotPath)
+                # Use COPIES of the serializers, so the originals don't forget their dirty state
+                self._serializeApplets(snapshotFile, snapshotPath, copySerializers=True)
             except Exception, err:
                 log_exception( logger, "Project Save Snapshot Action failed due to the exception printed above." )
                 raise ProjectManager.SaveError(str(err))
@@ -316,6 +304,7 @@ class ProjectManager(object):
             return
 
         oldPath = self.currentProjectPath
+        self.currentProjectFile.flush()
         try:
             os.rename( oldPath, newPath )
         except OSError, err:
@@ -331,9 +320,7 @@ class ProjectManager(object):
         self.currentProjectPath = newPath
         
         # Copy the contents of the current project file to a newly-created file (with the old name)
-        with h5py.File(oldPath, 'a') as oldFile:
-            for key in self.currentProjectFile.keys():
-                oldFile.copy(self.currentProjectFile[key], key)
+        self._copyFile(newPath, oldPath)
         
         for aplt in self._applets:
             for item in aplt.dataSerializers:
@@ -353,6 +340,65 @@ class ProjectManager(object):
         else:
             return []
 
+    def _serializeApplets(self, hdf5File, projectFilePath, force_all_save=False, copySerializers=False):
+        """
+        Serialize all dirty applet serializers into the given (open) project file.
+
+        Serializers are saved one after another, in workflow order.  They are
+        not thread-safe: many of them read operator state that the GUI may
+        change while saving, and h5py doesn't allow concurrent writes anyway.
+
+        :param copySerializers: If True, serialize shallow copies of the
+                                serializers and restore the dirty state of
+                                their serial slots afterwards, so the current
+                                project file can still be saved correctly
+                                (see saveProjectSnapshot())
+        """
+        count = 0
+        slotStates = []
+        try:
+            with Timer() as timer:
+                for aplt in self._applets:
+                    for item in aplt.dataSerializers:
+                        assert item.base_initialized, "AppletSerializer subclasses must call AppletSerializer.__init__ upon construction."
+                        if force_all_save or item.isDirty() or item.shouldSerialize(hdf5File):
+                            if copySerializers:
+                                item = copy.copy(item)
+                                slotStates += [ (ss, dict(ss.__dict__)) for ss in item.serialSlots ]
+                            item.serializeToHdf5(hdf5File, projectFilePath)
+                            count += 1
+        finally:
+            for ss, state in slotStates:
+                ss.__dict__.update(state)
+        if count:
+            logger.info( "Serialized {} applet serializer(s) in {:.2f} seconds"
+                         .format( count, timer.seconds() ) )
+
+    def _copyProjectFile(self, newPath):
+        """
+        Copy the current project file (as it is on disk) to the given path.
+        """
+        if not self.currentProjectIsReadOnly:
+            # Make sure everything we wrote so far is on disk.
+            self.currentProjectFile.flush()
+        self._copyFile(self.currentProjectPath, newPath)
+
+    @staticmethod
+    def _copyFile(srcPath, dstPath):
+        """
+        Copy a project file byte for byte and log the throughput.
+
+        Copying the whole file at once is much faster than copying each
+        group through HDF5 (the datasets aren't decompressed either way,
+        but each object copy has a high overhead for projects with many
+        small datasets, like label blocks).
+        """
+        with Timer() as timer:
+            shutil.copyfile(srcPath, dstPath)
+        size_mb = os.path.getsize(dstPath) / 1e6
+        logger.info( "Copied project file ({:.1f} MB) in {:.2f} seconds ({:.1f} MB/s)"
+                     .format( size_mb, timer.seconds(), size_mb / max(timer.seconds(), 1e-6) ) )
+
     @timeLogged(logger, logging.DEBUG)
     def _loadProject(self, hdf5File, projectFilePath, readOnly):
         """
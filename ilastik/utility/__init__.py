@@ -24,4 +24,5 @@ from multiLaneOperator import MultiLaneOperatorABC
 from operatorSubView import OperatorSubView
 from opMultiLaneWrapper import OpMultiLaneWrapper
 from log_exception import log_exception
-from autocleaned_tempdir import autocleaned_tempdir
\ No newline at end of file
+from autocleaned_tempdir import autocleaned_tempdir
+from labelMerging import mergeLabels
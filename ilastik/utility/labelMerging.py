@@ -0,0 +1,47 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+def mergeLabels(nlabels, pairs):
+    """
+    Return a lookup table for the labels 0..nlabels that maps all labels connected
+    by the given pairs (a list of (n,2) arrays) to the same label.
+    The resulting labels are consecutive, and 0 maps to 0.
+    """
+    roots = numpy.arange(nlabels + 1, dtype=numpy.uint32)
+    if pairs:
+        pairs = numpy.concatenate(pairs)
+        a, b = pairs[:,0], pairs[:,1]
+        while True:
+            root_a, root_b = roots[a], roots[b]
+            if (root_a == root_b).all():
+                break
+            # Hook both roots to the smaller one, then compress the paths
+            low = numpy.minimum(root_a, root_b)
+            numpy.minimum.at(roots, root_a, low)
+            numpy.minimum.at(roots, root_b, low)
+            while True:
+                compressed = roots[roots]
+                if (compressed == roots).all():
+                    break
+                roots = compressed
+    _, lut = numpy.unique(roots, return_inverse=True)
+    return lut.astype(numpy.uint32)
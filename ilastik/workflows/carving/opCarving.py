@@ -41,6 +41,62 @@ logger = logging.getLogger(__name__)
 
 #===----------------------------------------------------------------------------------------------------------------===
 
+class SupervoxelObjectIndex(object):
+    """
+    Inverted index from supervoxels to the carved objects that contain them.
+
+    For every supervoxel, 'count' holds the number of indexed objects containing it and
+    'number' the object number of one of them (0 if there is none).  These are exactly
+    the 'done' lookup tables of OpCarving, and adding or removing a single object only
+    touches the entries of its own supervoxels.
+    """
+    def __init__(self, numNodes):
+        self.count = numpy.zeros(numNodes+1, dtype=numpy.int32)
+        self.number = numpy.zeros(numNodes+1, dtype=numpy.int32)
+        self._objects = {} # name -> (object number, supervoxels)
+        self._names = {}   # object number -> name
+
+    def __contains__(self, name):
+        return name in self._objects
+
+    def add(self, name, objNr, objectSupervoxels):
+        if name in self._objects:
+            self.remove(name)
+        supervoxels = numpy.unique(numpy.asarray(objectSupervoxels).ravel())
+        self.count[supervoxels] += 1
+        self.number[supervoxels] = objNr
+        self._objects[name] = (objNr, supervoxels)
+        self._names[objNr] = name
+
+    def remove(self, name):
+        objNr, supervoxels = self._objects.pop(name)
+        del self._names[objNr]
+        self.count[supervoxels] -= 1
+        self.number[supervoxels[self.count[supervoxels] == 0]] = 0
+
+        # Supervoxels that are still part of another object need that object's number
+        stale = supervoxels[self.number[supervoxels] == objNr]
+        for otherNr, otherSupervoxels in self._objects.itervalues():
+            if len(stale) == 0:
+                break
+            shared = numpy.in1d(stale, otherSupervoxels)
+            self.number[stale[shared]] = otherNr
+            stale = stale[~shared]
+
+    def discard(self, name):
+        if name in self._objects:
+            self.remove(name)
+
+    def names(self, supervoxel):
+        """Returns the names of the indexed objects that contain the supervoxel."""
+        count = self.count[supervoxel]
+        if count == 0:
+            return []
+        if count == 1:
+            return [self._names[self.number[supervoxel]]]
+        return [name for name, (_, supervoxels) in self._objects.iteritems()
+                if numpy.any(supervoxels == supervoxel)]
+
 class OpCarving(Operator):
     name = "Carving"
     category = "interactive segmentation"
@@ -124,6 +180,8 @@ class OpCarving(Operator):
         #supervoxels of finished and saved objects
         self._done_lut = None
         self._done_seg_lut = None
+        self._doneIndex = None
+        self._doneIndexMst = None
         self._hints = None
         self._pmap = None
         if hintOverlayFile is not None:
@@ -195,22 +253,36 @@ class OpCarving(Operator):
 
     def _buildDone(self):
         """
-        Builds the done segmentation anew, for example after saving an object or
-        deleting an object.
+        Builds the done segmentation anew, for example after loading a project.
         """
         if self._mst is None:
             return
         with Timer() as timer:
-            self._done_lut = numpy.zeros(self._mst.numNodes+1, dtype=numpy.int32)
-            self._done_seg_lut = numpy.zeros(self._mst.numNodes+1, dtype=numpy.int32)
             logger.info( "building 'done' luts" )
-            for name, objectSupervoxels in self._mst.object_lut.iteritems():
-                if name == self._currObjectName:
-                    continue
-                self._done_lut[objectSupervoxels] += 1
-                assert name in self._mst.object_names, "%s not in self._mst.object_names, keys are %r" % (name, self._mst.object_names.keys())
-                self._done_seg_lut[objectSupervoxels] = self._mst.object_names[name]
+            self._doneIndex = SupervoxelObjectIndex(self._mst.numNodes)
+            self._doneIndexMst = self._mst
+            self._done_lut = self._doneIndex.count
+            self._done_seg_lut = self._doneIndex.number
+            for name in self._mst.object_lut.keys():
+                self._updateDone(name)
         logger.info( "building the 'done' luts took {} seconds".format( timer.seconds() ) )
+
+    def _updateDone(self, *names):
+        """
+        Updates the done segmentation for the given objects only, after they have
+        been saved, loaded (i.e. became the current object) or deleted.
+        """
+        if self._mst is None:
+            return
+        if self._doneIndex is None or self._doneIndexMst is not self._mst:
+            self._buildDone()
+            return
+        for name in names:
+            if name in self._mst.object_lut and name != self._currObjectName:
+                assert name in self._mst.object_names, "%s not in self._mst.object_names, keys are %r" % (name, self._mst.object_names.keys())
+                self._doneIndex.add(name, self._mst.object_names[name], self._mst.object_lut[name])
+            else:
+                self._doneIndex.discard(name)
     
     def dataIsStorable(self):
         if self._mst is None:
@@ -290,10 +362,13 @@ class OpCarving(Operator):
 
         #find the supervoxel that was clicked
         sv = self._mst.supervoxelUint32[position3d]
-        names = []
-        for name, objectSupervoxels in self._mst.object_lut.iteritems():
-            if numpy.sum(sv == objectSupervoxels) > 0:
-                names.append(name)
+        if self._doneIndex is None or self._doneIndexMst is not self._mst:
+            self._buildDone()
+        names = self._doneIndex.names(sv)
+        # The current object is not part of the done objects
+        current = self._currObjectName
+        if current in self._mst.object_lut and numpy.any(sv == self._mst.object_lut[current]):
+            names.append(current)
         logger.info( "click on %r, supervoxel=%d: %r" % (position3d, sv, names) )
         return names
 
@@ -360,11 +435,12 @@ class OpCarving(Operator):
         #newSegmentation[ self._mst.object_lut[name] ] = 2
         #lut_segmentation[:] = newSegmentation
 
+        previousName = self._currObjectName
         self._setCurrObjectName(name)
         self.HasSegmentation.setValue(True)
 
-        #now that 'name' is no longer part of the set of finished objects, rebuild the done overlay
-        self._buildDone()
+        #now that 'name' is no longer part of the set of finished objects, update the done overlay
+        self._updateDone(name, previousName)
         return (fgVoxelsSeedPos, bgVoxelsSeedPos)
     
     def loadObject(self, name):
@@ -453,10 +529,11 @@ class OpCarving(Operator):
         if name in self._mst.object_names:
             del self._mst.object_names[name]
 
+        previousName = self._currObjectName
         self._setCurrObjectName("<not saved yet>")
 
-        #now that 'name' has been deleted, rebuild the done overlay
-        self._buildDone()
+        #now that 'name' has been deleted, update the done overlay
+        self._updateDone(name, previousName)
         #self.updatePreprocessing()
     
     def deleteObject(self, name):
@@ -524,14 +601,15 @@ class OpCarving(Operator):
 
      
 
+        previousName = self._currObjectName
         self._setCurrObjectName("<not saved yet>")
         self.HasSegmentation.setValue(False)
 
         objects = self._mst.object_names.keys()
         self.AllObjectNames.meta.shape = (len(objects),)
         
-        #now that 'name' is no longer part of the set of finished objects, rebuild the done overlay
-        self._buildDone()
+        #now that 'name' is a finished object, update the done overlay
+        self._updateDone(name, previousName)
             
         #self.updatePreprocessing()
 
@@ -20,18 +20,21 @@
 ###############################################################################
 #Python
 import sys
+from functools import partial
 
 #SciPy
 import numpy
 import vigra
 
 #lazyflow
-from lazyflow.roi import roiFromShape
+from lazyflow.roi import roiFromShape, getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.operators import OpArrayCache
+from lazyflow.operators import OpArrayCache, OpBlockedArrayCache
+from lazyflow.request import Request, RequestPool, RequestLock
 
 from lazyflow.utility.timer import Timer
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility import mergeLabels
 
 #carving Cython module
 from watershed_segmentor import WatershedSegmentor
@@ -52,6 +55,9 @@ class OpFilter(Operator):
     
     Output = OutputSlot()
 
+    #: The requested region is filtered in blocks of this (spatial) shape, each read with a halo.
+    BLOCK_SHAPE = (256, 256, 256)
+
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.Input.meta )
         self.Output.meta.dtype = numpy.float32
@@ -66,91 +72,127 @@ class OpFilter(Operator):
             assert ax[i].isSpatial()
         assert ax[4].key == "c" and sh[4] == 1
         
-        volume5d = self.Input.value
         sigma = self.Sigma.value
-        volume = volume5d[0,:,:,:,0]
-        result_view = result[0,:,:,:,0]
-        
-        logger.info( "input volume shape: %r" %  (volume.shape,) )
-        logger.info( "input volume size: %r MB", (volume.nbytes / 1024**2,) )
-        fvol = numpy.asarray(volume, numpy.float32)
-
-        #Choose filter selected by user
         volume_filter = self.Filter.value
+        # Beyond this distance the filter kernels are zero
+        halo = int(numpy.ceil(4.0 * sigma))
 
-        logger.info( "applying filter on shape = %r" % (fvol.shape,) )
-        with Timer() as filterTimer:        
-            if fvol.shape[2] > 1:
-                # true 3D volume
-                if volume_filter == OpFilter.HESSIAN_BRIGHT:
-                    logger.info( "lowest eigenvalue of Hessian of Gaussian" )
-                    options = vigra.blockwise.BlockwiseConvolutionOptions3D()
-                    options.stdDev = (sigma, )*3 
-                    result_view[...] = vigra.blockwise.hessianOfGaussianLastEigenvalue(fvol,options)[:,:,:]
-                    result_view[:] = numpy.max(result_view) - result_view
-                
-                elif volume_filter == OpFilter.HESSIAN_DARK:
-                    logger.info( "greatest eigenvalue of Hessian of Gaussian" )
-                    options = vigra.blockwise.BlockwiseConvolutionOptions3D()
-                    options.stdDev = (sigma, )*3 
-                    result_view[...] = vigra.blockwise.hessianOfGaussianFirstEigenvalue(fvol,options)[:,:,:]
-                     
-                elif volume_filter == OpFilter.STEP_EDGES:
-                    logger.info( "Gaussian Gradient Magnitude" )
-                    result_view[...] = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
-                    
-                elif volume_filter == OpFilter.RAW:
-                    logger.info( "Gaussian Smoothing" )
-                    result_view[...] = vigra.filters.gaussianSmoothing(fvol,sigma)
-                    
-                elif volume_filter == OpFilter.RAW_INVERTED:
-                    logger.info( "negative Gaussian Smoothing" )
-                    result_view[...] = vigra.filters.gaussianSmoothing(-fvol,sigma)
-
-                logger.info( "Filter took {} seconds".format( filterTimer.seconds() ) )
-            else:
-                # 2D Image
-                fvol = fvol[:,:,0]
-                if volume_filter == OpFilter.HESSIAN_BRIGHT:
-                    logger.info( "lowest eigenvalue of Hessian of Gaussian" )
-                    volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,1]
-                    volume_feat[:] = numpy.max(volume_feat) - volume_feat
-                
-                elif volume_filter == OpFilter.HESSIAN_DARK:
-                    logger.info( "greatest eigenvalue of Hessian of Gaussian" )
-                    volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,0]
-                     
-                elif volume_filter == OpFilter.STEP_EDGES:
-                    logger.info( "Gaussian Gradient Magnitude" )
-                    volume_feat = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
-                    
-                elif volume_filter == OpFilter.RAW:
-                    logger.info( "Gaussian Smoothing" )
-                    volume_feat = vigra.filters.gaussianSmoothing(fvol,sigma)
-                    
-                elif volume_filter == OpFilter.RAW_INVERTED:
-                    logger.info( "negative Gaussian Smoothing" )
-                    volume_feat = vigra.filters.gaussianSmoothing(-fvol,sigma)
-
-                result_view[:,:,0] = volume_feat
-                logger.info( "Filter took {} seconds".format( filterTimer.seconds() ) )
+        shape = numpy.array(sh[1:4])
+        blockshape = numpy.minimum(self.BLOCK_SHAPE, shape)
+        spatial_roi = (numpy.array(roi.start[1:4]), numpy.array(roi.stop[1:4]))
+        result_view = result[0,:,:,:,0]
+
+        def filter_block(block_start):
+            block_roi = getIntersection( getBlockBounds(shape, blockshape, block_start), spatial_roi )
+            halo_start = numpy.maximum(block_roi[0] - halo, 0)
+            halo_stop = numpy.minimum(block_roi[1] + halo, shape)
+            # vigra refuses to filter lines shorter than its kernels, so small border blocks read more context
+            halo_start = numpy.maximum(numpy.minimum(halo_start, halo_stop - (2*halo + 1)), 0)
+            halo_stop = numpy.minimum(numpy.maximum(halo_stop, halo_start + (2*halo + 1)), shape)
+            volume = self.Input( [0] + list(halo_start) + [0], [1] + list(halo_stop) + [1] ).wait()
+            filtered = self._filter( numpy.asarray(volume[0,:,:,:,0], numpy.float32), volume_filter, sigma )
+            core = roiToSlice( block_roi[0] - halo_start, block_roi[1] - halo_start )
+            result_view[roiToSlice( block_roi[0] - spatial_roi[0], block_roi[1] - spatial_roi[0] )] = filtered[core]
+
+        logger.info( "applying filter {} on shape = {}".format( volume_filter, tuple(spatial_roi[1] - spatial_roi[0]) ) )
+        with Timer() as filterTimer:
+            pool = RequestPool()
+            for block_start in getIntersectingBlocks( blockshape, spatial_roi ):
+                pool.add( Request( partial(filter_block, block_start) ) )
+            pool.wait()
+        logger.info( "Filter took {} seconds".format( filterTimer.seconds() ) )
         return result
 
+    @staticmethod
+    def _filter(fvol, volume_filter, sigma):
+        """
+        Apply the selected filter to a 3D float32 volume (with a singleton z-axis for 2D images).
+        The Hessian filters are negated rather than subtracted from their maximum,
+        so that blocks can be filtered independently; the subsequent
+        normalization (OpNormalize255) gives the same result.
+        """
+        if fvol.shape[2] > 1:
+            # true 3D volume
+            if volume_filter == OpFilter.HESSIAN_BRIGHT:
+                # lowest eigenvalue of Hessian of Gaussian
+                return -vigra.filters.hessianOfGaussianEigenvalues(fvol, sigma)[:,:,:,2]
+            elif volume_filter == OpFilter.HESSIAN_DARK:
+                # greatest eigenvalue of Hessian of Gaussian
+                return vigra.filters.hessianOfGaussianEigenvalues(fvol, sigma)[:,:,:,0]
+            elif volume_filter == OpFilter.STEP_EDGES:
+                return vigra.filters.gaussianGradientMagnitude(fvol, sigma)
+            elif volume_filter == OpFilter.RAW:
+                return vigra.filters.gaussianSmoothing(fvol, sigma)
+            elif volume_filter == OpFilter.RAW_INVERTED:
+                return vigra.filters.gaussianSmoothing(-fvol, sigma)
+        else:
+            # 2D Image
+            fvol = fvol[:,:,0]
+            if volume_filter == OpFilter.HESSIAN_BRIGHT:
+                volume_feat = -vigra.filters.hessianOfGaussianEigenvalues(fvol, sigma)[:,:,1]
+            elif volume_filter == OpFilter.HESSIAN_DARK:
+                volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol, sigma)[:,:,0]
+            elif volume_filter == OpFilter.STEP_EDGES:
+                volume_feat = vigra.filters.gaussianGradientMagnitude(fvol, sigma)
+            elif volume_filter == OpFilter.RAW:
+                volume_feat = vigra.filters.gaussianSmoothing(fvol, sigma)
+            elif volume_filter == OpFilter.RAW_INVERTED:
+                volume_feat = vigra.filters.gaussianSmoothing(-fvol, sigma)
+            return numpy.asarray(volume_feat)[:,:,numpy.newaxis]
+        raise ValueError( "Unknown filter: {}".format( volume_filter ) )
+
     def propagateDirty(self, slot, subindex, roi):
         self.Output.setDirty(slice(None))
 
 class OpNormalize255(Operator):
+    """
+    Stretches the values of the whole input volume to 0..255.
+
+    The minimum and maximum of the input are found once, block by block, so
+    every request is normalized the same way as the whole volume would be.
+    """
     Input = InputSlot()
     Output = OutputSlot()
 
+    #: The input range is found in blocks of this (spatial) shape.
+    BLOCK_SHAPE = (256, 256, 256)
+
+    def __init__(self, *args, **kwargs):
+        super(OpNormalize255, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._range = None
+
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.Input.meta )
-    
+        self._range = None
+
+    def _inputRange(self):
+        """
+        Return (min, max) of the whole input.
+        """
+        with self._lock:
+            if self._range is None:
+                shape = numpy.array(self.Input.meta.shape)
+                blockshape = numpy.minimum( (1,) + self.BLOCK_SHAPE + (1,), shape )
+                minima = []
+                maxima = []
+                def block_range(block_start):
+                    block = self.Input( *getBlockBounds(shape, blockshape, block_start) ).wait()
+                    minima.append( numpy.min(block) )
+                    maxima.append( numpy.max(block) )
+
+                pool = RequestPool()
+                for block_start in getIntersectingBlocks( blockshape, roiFromShape(shape) ):
+                    pool.add( Request( partial(block_range, block_start) ) )
+                pool.wait()
+                self._range = (min(minima), max(maxima))
+            return self._range
+
     def execute(self, slot, subindex, roi, result):
+        volume_min, volume_max = self._inputRange()
+
         # Save memory: use result as a temporary
         self.Input( roi.start, roi.stop ).writeInto(result).wait()
-        volume_max = numpy.max(result)
-        volume_min = numpy.min(result)
 
         # result[...] = (result - volume_min) * 255.0 / (volume_max-volume_min)
         # Avoid temporaries...
@@ -160,37 +202,121 @@ class OpNormalize255(Operator):
         return result
 
     def propagateDirty(self, slot, subindex, roi):
-        self.Output.setDirty(roi.start, roi.stop)
+        # The input range may have changed, and with it every output value.
+        self._range = None
+        self.Output.setDirty(slice(None))
 
 class OpSimpleWatershed(Operator):
+    """
+    Watershed (supervoxel) segmentation of the whole volume.
+
+    The volume is segmented in blocks, in parallel, each with a halo of context.
+    Two supervoxels of neighboring blocks are merged if both blocks agree
+    that the voxels on either side of their common face belong to the same basin.
+    A volume that fits into a single block gives exactly the plain watershed.
+    """
     Input = InputSlot()
     Output = OutputSlot()
 
+    #: Spatial block shape of the blockwise watershed
+    BLOCK_SHAPE = (256, 256, 256)
+    #: Context read around each block
+    HALO = 16
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Input.meta)
         self.Output.meta.dtype = numpy.uint32
 
     def execute(self, slot, subindex, roi, result):
         assert roi.stop - roi.start == self.Output.meta.shape, "Watershed must be run on the entire volume."
-        input_image = self.Input(roi.start, roi.stop).wait()
-        volume_feat = input_image[0,...,0]
+        shape = numpy.array(self.Input.meta.shape[1:4])
+        blockshape = numpy.minimum(self.BLOCK_SHAPE, shape)
         result_view = result[0,...,0]
-        with Timer() as watershedTimer:
-            if self.Input.meta.getTaggedShape()['z'] > 1:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                #result_view[...] = vigra.analysis.watersheds(volume_feat[:,:])[0].astype(numpy.int32)
-                result_view[...] = vigra.analysis.watersheds(volume_feat[:,:].astype(numpy.uint8))[0]
-                logger.info( "done {}".format(numpy.max(result[...]) ) )
-            else:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                
-                labelVolume = vigra.analysis.watersheds(volume_feat[:,:,0])[0]#.view(dtype=numpy.int32)
-                result_view[...] = labelVolume[:,:,numpy.newaxis]
-                logger.info( "done {}".format(numpy.max(labelVolume)) )
 
+        sys.stdout.write("Watershed..."); sys.stdout.flush()
+        with Timer() as watershedTimer:
+            block_starts = [ tuple(block_start) for block_start in getIntersectingBlocks( blockshape, roiFromShape(shape) ) ]
+            blocks = {}
+            pool = RequestPool()
+            for block_start in block_starts:
+                pool.add( Request( partial(self._watershedBlock, shape, blockshape, block_start, result_view, blocks) ) )
+            pool.wait()
+
+            # Give each block its own range of labels
+            offsets = {}
+            nlabels = 0
+            for block_start in block_starts:
+                offsets[block_start] = nlabels
+                nlabels += blocks[block_start][1]
+
+            # Merge supervoxels across block faces
+            pairs = []
+            for block_start in block_starts:
+                faces = blocks[block_start][2]
+                for axis in range(3):
+                    neighbor = list(block_start)
+                    neighbor[axis] += blockshape[axis]
+                    neighbor = tuple(neighbor)
+                    if neighbor not in blocks:
+                        continue
+                    labels, agree = faces[(axis, 'upper')]
+                    neighbor_labels, neighbor_agree = blocks[neighbor][2][(axis, 'lower')]
+                    agree = agree & neighbor_agree
+                    pairs.append( numpy.column_stack( (labels[agree] + offsets[block_start],
+                                                       neighbor_labels[agree] + offsets[neighbor]) ) )
+            lut = mergeLabels(nlabels, pairs)
+
+            def relabel_block(block_start):
+                core = result_view[blocks[block_start][0]]
+                core += numpy.uint32(offsets[block_start])
+                lut.take(core, out=core, mode='clip')
+
+            pool = RequestPool()
+            for block_start in block_starts:
+                pool.add( Request( partial(relabel_block, block_start) ) )
+            pool.wait()
+
+        logger.info( "done {}".format( lut.max() ) )
         logger.info( "Watershed took {} seconds".format( watershedTimer.seconds() ) )
         return result
 
+    def _watershedBlock(self, shape, blockshape, block_start, result_view, blocks):
+        """
+        Segment one block (with halo) and write its core labels (1..n) into result_view.
+        Stores the core slicing, n, and the data of the block faces needed for merging in blocks[block_start].
+        """
+        block_roi = getBlockBounds(shape, blockshape, block_start)
+        halo_start = numpy.maximum(block_roi[0] - self.HALO, 0)
+        halo_stop = numpy.minimum(block_roi[1] + self.HALO, shape)
+        volume_feat = self.Input( [0] + list(halo_start) + [0], [1] + list(halo_stop) + [1] ).wait()[0,...,0]
+        if volume_feat.shape[2] > 1:
+            labels = vigra.analysis.watersheds(volume_feat.astype(numpy.uint8))[0]
+        else:
+            labels = vigra.analysis.watersheds(volume_feat[:,:,0])[0][:,:,numpy.newaxis]
+        labels = numpy.asarray(labels)
+
+        core_start = block_roi[0] - halo_start
+        core_stop = block_roi[1] - halo_start
+        core_slicing = roiToSlice(core_start, core_stop)
+        ids, core_labels = numpy.unique(labels[core_slicing], return_inverse=True)
+        core_labels = (core_labels + 1).astype(numpy.uint32).reshape(core_stop - core_start)
+        result_view[roiToSlice(*block_roi)] = core_labels
+
+        # For each face, remember the labels on its inner side and whether
+        # this block's watershed continues the basin to the other side.
+        faces = {}
+        for axis in range(3):
+            sides = []
+            if block_roi[0][axis] > 0:
+                sides.append( ('lower', 0, core_start[axis], core_start[axis] - 1) )
+            if block_roi[1][axis] < shape[axis]:
+                sides.append( ('upper', -1, core_stop[axis] - 1, core_stop[axis]) )
+            for side, core_index, inner, outer in sides:
+                inner_labels = numpy.take(labels, inner, axis=axis)[roiToSlice(numpy.delete(core_start, axis), numpy.delete(core_stop, axis))]
+                outer_labels = numpy.take(labels, outer, axis=axis)[roiToSlice(numpy.delete(core_start, axis), numpy.delete(core_stop, axis))]
+                faces[(axis, side)] = ( numpy.take(core_labels, core_index, axis=axis), inner_labels == outer_labels )
+        blocks[block_start] = (roiToSlice(*block_roi), len(ids), faces)
+
     def propagateDirty(self, slot, subindex, roi):
         self.Output.setDirty(slice(None))
     
@@ -269,7 +395,7 @@ class OpPreprocessing(Operator):
     #                                                                   \                                                                /
     # InputData --> -- opInputFilter*--------> opInputNormalize -------> (SELECT by WatershedSource) --> opWatershed --> opWatershedCache --> opMstProvider --> [via execute()] --> PreprocessedData
     #              \                                                    /                                                                    /
-    # Sigma ------> opFilter --> opFilterNormalize --> opFilterCache --> --------------------------------------------------------------------
+    # Sigma ------> opFilter --> opFilterCache --> opFilterNormalize --> --------------------------------------------------------------------
     #              /                                                \
     # Filter ------                                                  --> FilteredImage
 
@@ -292,10 +418,13 @@ class OpPreprocessing(Operator):
         self._opFilter.Sigma.connect( self.Sigma )
         self._opFilter.Filter.connect( self.Filter )
 
+        # Cache the filter output blockwise, and normalize it when it is read.
+        self._opFilterCache = OpBlockedArrayCache( parent=self )
+        self._opFilterCache.fixAtCurrent.setValue( False )
+        self._opFilterCache.Input.connect( self._opFilter.Output )
+
         self._opFilterNormalize = OpNormalize255( parent=self )
-        self._opFilterNormalize.Input.connect( self._opFilter.Output )
-        
-        self._opFilterCache = OpArrayCache( parent=self )
+        self._opFilterNormalize.Input.connect( self._opFilterCache.Output )
         
         self._opWatershed = OpSimpleWatershed( parent=self )
         
@@ -316,15 +445,13 @@ class OpPreprocessing(Operator):
         self._opInputNormalize.Input.connect( self._opInputFilter.Output )
         
         self._opMstProvider = OpMstSegmentorProvider( self.applet, parent=self )
-        self._opMstProvider.Image.connect( self._opFilterCache.Output )
+        self._opMstProvider.Image.connect( self._opFilterNormalize.Output )
         self._opMstProvider.LabelImage.connect( self._opWatershedCache.Output )
 
-        self._opWatershedSourceCache = OpArrayCache( parent=self )
-
         #self.PreprocessedData.connect( self._opMstProvider.MST )
         
         # Display slots
-        self.FilteredImage.connect( self._opFilterCache.Output )
+        self.FilteredImage.connect( self._opFilterNormalize.Output )
         self.WatershedImage.connect( self._opWatershedCache.Output )
         
         self.InputData.notifyReady( self._checkConstraints )
@@ -359,8 +486,9 @@ class OpPreprocessing(Operator):
         self.PreprocessedData.meta.shape = (1,)
         self.PreprocessedData.meta.dtype = object
 
-        self._opFilterCache.blockShape.setValue( self.InputData.meta.shape )
-        self._opFilterCache.Input.connect( self._opFilterNormalize.Output )
+        blockshape = tuple( numpy.minimum( (1,) + OpFilter.BLOCK_SHAPE + (1,), self.InputData.meta.shape ) )
+        self._opFilterCache.innerBlockShape.setValue( blockshape )
+        self._opFilterCache.outerBlockShape.setValue( blockshape )
 
         # If the user's boundaries are dark, then invert the special watershed sources
         if self.InvertWatershedSource.value:
@@ -373,21 +501,23 @@ class OpPreprocessing(Operator):
         ws_source = self.WatershedSource.value
         if ws_source == 'raw':
             if self.RawData.ready():
-                self._opWatershed.Input.connect( self._opRawNormalize.Output )
+                ws_input = self._opRawNormalize.Output
             else:
-                self._opWatershed.Input.connect( self._opInputNormalize.Output )
+                ws_input = self._opInputNormalize.Output
         elif ws_source == 'input':
-            self._opWatershed.Input.connect( self._opInputNormalize.Output )
+            ws_input = self._opInputNormalize.Output
         elif ws_source == 'filtered':
-            self._opWatershed.Input.connect( self._opFilterCache.Output )
+            ws_input = self._opFilterNormalize.Output
         else:
             assert False, "Unknown Watershed source option: {}".format( ws_source )
 
-        self._opWatershedSourceCache.blockShape.setValue( self.InputData.meta.shape )
-        self._opWatershedSourceCache.Input.connect( self._opWatershed.Input )
+        # OpNormalize255 uses the range of the whole volume, so the watershed can read its input in blocks.
+        self._opWatershed.Input.connect( ws_input )
 
-        self.WatershedSourceImage.connect( self._opWatershedSourceCache.Output )
+        self.WatershedSourceImage.connect( ws_input )
 
+        # The watershed labels the whole volume at once (its blocks are merged afterwards),
+        #  and the MST needs all of the labels anyway.
         self._opWatershedCache.blockShape.setValue( self._opWatershed.Output.meta.shape )
         self._opWatershedCache.Input.connect( self._opWatershed.Output )
 
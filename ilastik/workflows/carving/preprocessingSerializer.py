@@ -47,7 +47,6 @@ class PreprocessingSerializer( AppletSerializer ):
                 deleteIfPresent(preproc, "filter")
                 deleteIfPresent(preproc, "watershed_source")
                 deleteIfPresent(preproc, "invert_watershed_source")
-                deleteIfPresent(preproc, "graph")
                 
                 preproc.create_dataset("sigma",data= opPre.initialSigma)
                 preproc.create_dataset("filter",data= opPre.initialFilter)
@@ -56,6 +55,7 @@ class PreprocessingSerializer( AppletSerializer ):
                 preproc.create_dataset("watershed_source", data=ws_source)                 
                 preproc.create_dataset("invert_watershed_source", data=opPre.InvertWatershedSource.value)
                 
+                # Only the parts of the graph that changed are rewritten
                 preprocgraph = getOrCreateGroup(preproc, "graph")
                 mst.saveH5G(preprocgraph)
             
@@ -1,11 +1,17 @@
+import uuid
+
 import vigra
 from vigra import graphs as vgraph
 #from vigra import ilastiktools
 import ilastiktools
 import numpy
+import h5py
 
 
 class WatershedSegmentor(object):
+    #: Chunk shape of the stored supervoxel volume
+    LABEL_CHUNKS = (64, 64, 64)
+
     def __init__(self, labels = None, volume_feat = None, edgeWeightFunctor = None, progressCallback = None,
                  h5file = None):
         self.object_names = dict()
@@ -21,19 +27,25 @@ class WatershedSegmentor(object):
 
         if h5file is None:
             self.supervoxelUint32 = labels
-            self.volumeFeat = volume_feat.squeeze()
             self.gridSegmentor = ilastiktools.GridSegmentor_3D_UInt32()
-            self.gridSegmentor.preprocessing(self.supervoxelUint32,self.volumeFeat)
+            # The features are only needed to compute the edge weights, don't keep them around.
+            self.gridSegmentor.preprocessing(self.supervoxelUint32,volume_feat.squeeze())
 
             # fixe! which of both??!
             self.nodeNum = self.gridSegmentor.nodeNum()
             self.numNodes = self.nodeNum
        
             self.hasSeg = False
+            self.segmentorId = uuid.uuid4().hex
         else:
             self.numNodes = h5file.attrs["numNodes"]
             self.nodeNum = self.numNodes
-            self.supervoxelUint32 = h5file['labels'][:]
+            # Identifies the stored graph, so that saving again only updates what can change
+            self.segmentorId = h5file.attrs.get("segmentorId", None) or uuid.uuid4().hex
+
+            labels = h5file['labels']
+            self.supervoxelUint32 = numpy.empty(labels.shape, dtype=numpy.uint32)
+            labels.read_direct(self.supervoxelUint32)
 
             self.gridSegmentor = ilastiktools.GridSegmentor_3D_UInt32()
 
@@ -89,20 +101,50 @@ class WatershedSegmentor(object):
         self.saveH5G(h5g)
 
     def saveH5G(self, h5g):
+        """
+        Save the segmentor to the given group as chunked, compressed datasets.
 
+        The supervoxels, graph and edge weights never change after preprocessing,
+        so if the group already holds them for this segmentor, only the node seeds
+        and the result segmentation are updated (in place).
+        """
         g = h5g
+        gridSeg = self.gridSegmentor
 
-        g.attrs["numNodes"] = self.numNodes
-        g.create_dataset("labels", data = self.supervoxelUint32)
+        if g.attrs.get("segmentorId", None) != self.segmentorId or \
+           not all(name in g for name in ("labels", "graph", "edgeWeights")):
+            for name in ("labels", "graph", "edgeWeights", "nodeSeeds", "resultSegmentation"):
+                if name in g:
+                    del g[name]
+            g.attrs["numNodes"] = self.numNodes
+            chunks = tuple(min(c, s) for c, s in zip(self.LABEL_CHUNKS, self.supervoxelUint32.shape))
+            self._createDataset(g, "labels", self.supervoxelUint32, chunks)
+            self._createDataset(g, "graph", gridSeg.serializeGraph())
+            self._createDataset(g, "edgeWeights", gridSeg.getEdgeWeights())
+            g.attrs["segmentorId"] = self.segmentorId
+
+        self._updateDataset(g, "nodeSeeds", gridSeg.getNodeSeeds())
+        self._updateDataset(g, "resultSegmentation", gridSeg.getResultSegmentation())
 
-        gridSeg = self.gridSegmentor
-        g.create_dataset("graph", data = gridSeg.serializeGraph())
-        g.create_dataset("edgeWeights", data = gridSeg.getEdgeWeights())
-        g.create_dataset("nodeSeeds", data = gridSeg.getNodeSeeds())
-        g.create_dataset("resultSegmentation", data = gridSeg.getResultSegmentation())
-        
         g.file.flush()
 
+    @staticmethod
+    def _createDataset(g, name, data, chunks=True):
+        data = numpy.asarray(data)
+        if data.size == 0:
+            return g.create_dataset(name, data=data)
+        return g.create_dataset(name, data=data, chunks=chunks, compression="gzip", compression_opts=1)
+
+    @classmethod
+    def _updateDataset(cls, g, name, data):
+        data = numpy.asarray(data)
+        if name in g and g[name].shape == data.shape and g[name].dtype == data.dtype:
+            g[name][...] = data
+        else:
+            if name in g:
+                del g[name]
+            cls._createDataset(g, name, data)
+
 
     def setResulFgObj(self, fgNodes):
         self.gridSegmentor.setResulFgObj(fgNodes)
\ No newline at end of file
@@ -67,6 +67,9 @@ class ObjectClassificationWorkflow(Workflow):
     workflowName = "Object Classification Workflow Base"
     defaultAppletIndex = 1 # show DataSelection by default
 
+    #: Rows per HDF5 chunk of the streamed export table
+    EXPORT_TABLE_CHUNK_LENGTH = 10000
+
     def __init__(self, shell, headless,
                  workflow_cmdline_args,
                  project_creation_args,
@@ -388,12 +391,11 @@ class ObjectClassificationWorkflow(Workflow):
                 # Export the CSV
                 csv_filename = self._export_args.table_filename
                 if csv_filename:
-                    feature_table = opSingleBlockClassify._opPredict.createExportTable([])
                     if len(self.opBatchClassify) > 1:
                         base, ext = os.path.splitext( csv_filename )
                         csv_filename = base + '-' + str(lane_index) + ext
                     print "Exporting object table for image #{}:\n{}".format( lane_index, csv_filename )
-                    self.record_array_to_csv(feature_table, csv_filename)
+                    self.stream_export_table( opSingleBlockClassify._opPredict, csv_filename )
                 
                 print "FINISHED."
 
@@ -431,23 +433,48 @@ class ObjectClassificationWorkflow(Workflow):
         # Restore original format
         opBatchExport.OutputFilenameFormat.setValue( default_output_path )
 
-    def record_array_to_csv(self, record_array, filename):
+    def stream_export_table(self, opPredict, filename):
+        """
+        Export the object feature/prediction table one time step at a time,
+        so the table for the whole dataset is never held in memory at once.
+        Writes HDF5 (dataset 'table') if the filename ends with .h5, otherwise CSV.
+        """
+        if not opPredict.Predictions.ready() or not opPredict.Features.ready():
+            logger.warn( "Object features or predictions are not available.  Not exporting the table to {}".format( filename ) )
+            return
+
+        ntimes = opPredict.Features.meta.shape[0]
+        # All time steps are written with the same layout, even if the first one has no objects
+        layout = opPredict.exportTableLayout()
+        if os.path.splitext(filename)[1] in ('.h5', '.hdf5'):
+            with h5py.File(filename, 'w') as f:
+                dataset = f.create_dataset('table', shape=(0,), maxshape=(None,), dtype=layout[0],
+                                           chunks=(self.EXPORT_TABLE_CHUNK_LENGTH,), compression='gzip')
+                for t in range(ntimes):
+                    table = opPredict.createExportTable([t], layout)
+                    if len(table) == 0:
+                        continue
+                    dataset.resize( (dataset.shape[0] + len(table),) )
+                    dataset[-len(table):] = table
+        else:
+            with open(filename, 'w') as csv_file:
+                for t in range(ntimes):
+                    table = opPredict.createExportTable([t], layout)
+                    self.record_array_to_csv(table, csv_file, write_header=(t == 0))
+
+    def record_array_to_csv(self, record_array, csv_file, write_header=True):
         """
-        Save the given record array to a CSV file.
+        Write the given record array to an open CSV file.
         """
         # Sort by offset
-        with open(filename, 'w') as csv_file:
-            sorted_fields = sorted( record_array.dtype.fields.items(), key=lambda (k,v): v[1] )
-            field_names = map( lambda (k,v): k, sorted_fields )
-            for name in field_names:
-                # Remove any commas in the header (this is csv, after all)
-                name = name.replace(',', '/')
-                csv_file.write(name + ',')
+        sorted_fields = sorted( record_array.dtype.fields.items(), key=lambda (k,v): v[1] )
+        field_names = map( lambda (k,v): k, sorted_fields )
+        if write_header:
+            # Remove any commas in the header (this is csv, after all)
+            csv_file.write( "".join( name.replace(',', '/') + ',' for name in field_names ) )
             csv_file.write('\n')
-            for row in record_array:
-                for name in field_names:
-                    csv_file.write(str(row[name]) + ',')
-                csv_file.write('\n')
+        if len(record_array) > 0:
+            numpy.savetxt( csv_file, record_array, fmt='%s', delimiter=',', newline=',\n' )
 
     def getHeadlessOutputSlot(self, slotId):
         if slotId == "BatchPredictionImage":
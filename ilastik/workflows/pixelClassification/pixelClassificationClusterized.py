@@ -204,6 +204,11 @@ def prepare_master_cluster_operator(cluster_args, finalOutputSlot):
     opClusterizeMaster.OutputDatasetDescription.setValue( cluster_args.output_description_file )
     opClusterizeMaster.ConfigFilePath.setValue( cluster_args.option_config_file )
 
+    # Only reported when the tasks are run on the local process pool.
+    def report_progress( progress ):
+        logger.info( "Cluster tasks: {:.1f}% complete".format( progress ) )
+    opClusterizeMaster.innerOperators[0].progressSignal.subscribe( report_progress )
+
     resultSlot = opClusterizeMaster.ReturnCode
     clusterOperator = opClusterizeMaster
     return (clusterOperator, resultSlot)
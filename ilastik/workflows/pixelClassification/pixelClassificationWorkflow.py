@@ -109,6 +109,11 @@ class PixelClassificationWorkflow(Workflow):
 
         self.pcApplet = self.createPixelClassificationApplet()
         opClassify = self.pcApplet.topLevelOperator
+        if self._headless:
+            # Batch prediction with a stored classifier doesn't need the labels,
+            #  so don't read them until we know (see onProjectLoaded).
+            for serializer in self.pcApplet.dataSerializers:
+                serializer.deferBlockLoading()
 
         self.dataExportApplet = PixelClassificationDataExportApplet(self, "Prediction Export")
         opDataExport = self.dataExportApplet.topLevelOperator
@@ -379,6 +384,12 @@ class PixelClassificationWorkflow(Workflow):
         the workflow for batch mode and export all results.
         (This workflow's headless mode supports only batch mode for now.)
         """
+        # The labels are only needed if they are inspected or changed, or the classifier must be trained.
+        if self.generate_random_labels or self.print_labels_by_slice or self.retrain \
+           or self.pcApplet.topLevelOperator.classifier_cache._dirty:
+            for serializer in self.pcApplet.dataSerializers:
+                serializer.loadDeferredData()
+
         if self.generate_random_labels:
             self._generate_random_labels(self.random_label_count, self.random_label_value)
             logger.info("Saving project...")
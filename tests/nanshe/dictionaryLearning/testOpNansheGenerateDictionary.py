@@ -96,6 +96,53 @@ class TestOpNansheGenerateDictionary(object):
 
         assert(len(unmatched_g) == 0)
 
+    def test_OpNansheGenerateDictionary_memoized(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+        gv = g[..., None]
+        gv = gv.astype(float)
+        gv = vigra.taggedView(gv, "tyxc")
+
+        graph = Graph()
+        op = OpNansheGenerateDictionary(graph=graph)
+
+        opPrep = OpArrayPiper(graph=graph)
+        opPrep.Input.setValue(gv)
+
+        op.Input.connect(opPrep.Output)
+
+        op.K.setValue(len(g))
+        op.NumIter.setValue(10)
+        op.Lambda1.setValue(0.2)
+
+        d = op.Output[...].wait()
+
+        # Tiles are cut out of the same dictionary
+        d_tile = op.Output[:, 20:60, 40:90].wait()
+        assert((d_tile == d[:, 20:60, 40:90]).all())
+        assert(op._dictionary is not None)
+
+        # Resume training with more iterations
+        op.WarmStart.setValue(True)
+        op.NumIter.setValue(20)
+
+        d = op.Output[...].wait()
+        d = (d != 0)
+
+        assert(g.shape == d.shape)
+        assert((g.astype(bool).max(axis = 0) == d.astype(bool).max(axis = 0)).all())
+
+        # New input data discards the dictionary
+        generation = op._generation
+        opPrep.Input.setValue(gv.copy())
+        assert(op._generation > generation)
+
     def test_OpNansheGenerateDictionaryCached(self):
         p = numpy.array([[27, 51],
                          [66, 85],
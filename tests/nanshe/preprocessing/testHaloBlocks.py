@@ -0,0 +1,92 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import numpy
+
+from ilastik.applets.nanshe.preprocessing.haloBlocks import halo_of, halo_block_shape, redundancy_factor, \
+                                                          default_block_shape, padded_voxels, MAX_BLOCK_VOXELS
+
+class TestHaloBlocks(object):
+    # Halos (t, y, x, c) of the preprocessing stages with the default parameters
+    F0_HALO = (400, 25, 25, 0)
+    WAVELET_HALO = (30, 30, 30, 0)
+
+    DEFAULT_BLOCK_SHAPE = (50, 256, 256, 1)
+
+    def testHaloOf(self):
+        assert(halo_of((slice(100, 901), slice(5, 56), slice(0, 1)),
+                       (slice(500, 501), slice(30, 31), slice(0, 1))) == (400, 25, 0))
+
+    def testSmallData(self):
+        shape = (20, 30, 40, 1)
+        block_shape = halo_block_shape(shape, self.F0_HALO, self.DEFAULT_BLOCK_SHAPE)
+
+        assert(block_shape == shape)
+        assert(redundancy_factor(shape, block_shape, self.F0_HALO) == 1.0)
+
+    def testNoHalo(self):
+        shape = (1000, 512, 512, 1)
+        block_shape = halo_block_shape(shape, (0, 0, 0, 0), self.DEFAULT_BLOCK_SHAPE)
+
+        assert(block_shape == self.DEFAULT_BLOCK_SHAPE)
+
+    def testRedundancy(self):
+        shape = (10000, 512, 512, 1)
+
+        # Redundancy factor that must be reached, without making the padded blocks
+        # (i.e. the work for the first request of a tile) larger than before.
+        targets = {"F0" : 1.9, "wavelet" : 2.1}
+
+        print("")
+        print("Redundancy factor and first request size (padded block, Mvoxels) for a movie of shape {}:".format(shape))
+
+        for name, halo in [("F0", self.F0_HALO), ("wavelet", self.WAVELET_HALO)]:
+            old_block_shape = default_block_shape(shape, halo, self.DEFAULT_BLOCK_SHAPE)
+            new_block_shape = halo_block_shape(shape, halo, self.DEFAULT_BLOCK_SHAPE)
+            # Without the cap, the first request of a tile would have to wait for much larger blocks
+            uncapped_block_shape = halo_block_shape(shape, halo, self.DEFAULT_BLOCK_SHAPE,
+                                                    max_padded_voxels=numpy.inf)
+
+            for label, block_shape in [("before", old_block_shape),
+                                       ("after", new_block_shape),
+                                       ("uncapped", uncapped_block_shape)]:
+                print("  {:8} {:9} {:.2f}, first request {:6.1f} (blocks {})".format(
+                    name, label + ":", redundancy_factor(shape, block_shape, halo),
+                    padded_voxels(shape, block_shape, halo) / 1e6, block_shape))
+
+            new = redundancy_factor(shape, new_block_shape, halo)
+
+            assert(numpy.prod(new_block_shape) <= MAX_BLOCK_VOXELS)
+            assert(padded_voxels(shape, new_block_shape, halo) <= padded_voxels(shape, old_block_shape, halo))
+            assert(new <= targets[name])
+            assert(new <= redundancy_factor(shape, old_block_shape, halo))
+
+            # Blocks that fit into the data entirely aren't split
+            assert(halo_block_shape((500, 64, 64, 1), halo, self.DEFAULT_BLOCK_SHAPE)[1:] == (64, 64, 1))
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -90,6 +90,35 @@ class TestOpMeanProjection(object):
 
         assert((b == expected_b).all())
 
+    def testChunked(self):
+        a = numpy.random.random((17,6,5,))
+        a = a[..., None]
+        a = vigra.taggedView(a, "tyxc")
+
+        expected_b = a.mean(axis=0)
+        expected_b = vigra.taggedView(expected_b, "yxc")
+
+
+        graph = Graph()
+        op = OpMeanProjection(graph=graph)
+        # Reduce 2 frames at a time
+        op.ChunkBytes = 2 * 6 * 5 * a.dtype.itemsize
+
+        opPrep = OpArrayPiper(graph=graph)
+        opPrep.Input.setValue(a)
+
+        op.Input.connect(opPrep.Output)
+        op.Axis.setValue(0)
+
+        b = op.Output[...].wait()
+        b = vigra.taggedView(b, "yxc")
+
+        assert(numpy.allclose(b, expected_b))
+
+        b = op.Output[1:4, 2:5].wait()
+
+        assert(numpy.allclose(b, expected_b[1:4, 2:5]))
+
 
 if __name__ == "__main__":
     import sys
@@ -779,5 +779,167 @@ class TestSerialBlockSlot2(unittest.TestCase):
         shutil.rmtree(tmp_dir)
 
 
+class TestSerialBlockSlotIncremental(unittest.TestCase):
+    """Saving again must only rewrite the blocks that changed."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.h5_filepath = os.path.join(self.tmp_dir, 'serial_blockslot_test.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _init_objects(self):
+        raw_data = numpy.zeros((100,100,100,1), dtype=numpy.uint32)
+        raw_data = vigra.taggedView(raw_data, 'zyxc')
+
+        opLabelArrays = OperatorWrapper( OpCompressedUserLabelArray, graph=Graph() )
+        opLabelArrays.Input.resize(1)
+        opLabelArrays.Input[0].setValue( raw_data )
+        opLabelArrays.shape.setValue( raw_data.shape )
+        opLabelArrays.eraser.setValue( 255 )
+        opLabelArrays.deleteLabel.setValue( -1 )
+        opLabelArrays.blockShape.setValue( (10,10,10,1) )
+
+        slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks )
+        return opLabelArrays, slotSerializer
+
+    def _untouchedBlocks(self, label_group, name):
+        untouched = set()
+        stored = set()
+        for subgroup in label_group[name].values():
+            for blockData in subgroup.values():
+                stored.add(blockData.attrs['sourceBlock'])
+                if blockData.attrs.get('untouched', False):
+                    untouched.add(blockData.attrs['sourceBlock'])
+        return stored, untouched
+
+    def testIncremental(self):
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(self.h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            name = slotSerializer.name
+
+            for subgroup in label_group[name].values():
+                for blockData in subgroup.values():
+                    assert blockData.compression == 'gzip'
+                    blockData.attrs['untouched'] = True
+
+            # Change one block, erase another one and add a new one.
+            opLabelArrays.Input[0][30:31, 30:35, 30:35, 0:1] = 1*numpy.ones((1,5,5,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 255*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][70:71, 70:80, 70:80, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            assert slotSerializer.shouldSerialize( label_group )
+            slotSerializer.serialize( label_group )
+            assert not slotSerializer.shouldSerialize( label_group )
+
+            stored, untouched = self._untouchedBlocks( label_group, name )
+            assert untouched == set(['[10:20,10:20,10:20,0:1]']), untouched
+            assert set(['[30:40,30:40,30:40,0:1]', '[70:80,70:80,70:80,0:1]']) <= stored, stored
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(self.h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][30:31, 30:35, 30:35, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][30:31, 35:40, 30:40, 0:1].wait() == 2 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 0 ).all()
+        assert ( opLabelArrays.Output[0][70:71, 70:80, 70:80, 0:1].wait() == 2 ).all()
+
+    def testValueChangedRewritesEverything(self):
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(self.h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            name = slotSerializer.name
+            for subgroup in label_group[name].values():
+                for blockData in subgroup.values():
+                    blockData.attrs['untouched'] = True
+
+            slotSerializer.setDirty( opLabelArrays.Output[0] )
+            slotSerializer.serialize( label_group )
+            stored, untouched = self._untouchedBlocks( label_group, name )
+            assert stored == set(['[10:20,10:20,10:20,0:1]'])
+            assert len(untouched) == 0
+
+
+    def testDeferredLoading(self):
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        with h5py.File(self.h5_filepath, 'w') as f:
+            slotSerializer.serialize( f.create_group('label_data') )
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        slotSerializer.deferLoading = True
+        with h5py.File(self.h5_filepath, 'r') as f:
+            label_group = f['label_data']
+            slotSerializer.deserialize( label_group )
+
+            # Nothing has been read yet, and there is nothing to save.
+            assert slotSerializer.hasDeferredData
+            assert ( opLabelArrays.Output[0][:].wait() == 0 ).all()
+            assert not slotSerializer.shouldSerialize( label_group )
+
+            slotSerializer.loadDeferred()
+            assert not slotSerializer.hasDeferredData
+            assert not slotSerializer.dirty
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+
+class TestSerialBlockSlotBenchmark(unittest.TestCase):
+    """Time repeated saves of a large label volume after a small change."""
+
+    @classmethod
+    def setUpClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        import nose
+        raise nose.SkipTest
+
+    def test(self):
+        from lazyflow.utility.timer import Timer
+        raw_data = vigra.taggedView( numpy.zeros((200,500,500,1), dtype=numpy.uint8), 'zyxc' )
+        opLabelArrays = OperatorWrapper( OpCompressedUserLabelArray, graph=Graph() )
+        opLabelArrays.Input.resize(1)
+        opLabelArrays.Input[0].setValue( raw_data )
+        opLabelArrays.shape.setValue( raw_data.shape )
+        opLabelArrays.eraser.setValue( 255 )
+        opLabelArrays.deleteLabel.setValue( -1 )
+        opLabelArrays.blockShape.setValue( (32,64,64,1) )
+        slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks )
+
+        # Label every block
+        opLabelArrays.Input[0][:] = numpy.random.randint(0, 3, raw_data.shape).astype(numpy.uint8)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with h5py.File(os.path.join(tmp_dir, 'benchmark.h5'), 'w') as f:
+                label_group = f.create_group('label_data')
+                with Timer() as timer:
+                    slotSerializer.serialize( label_group )
+                print "Initial save: {:.2f} seconds".format( timer.seconds() )
+
+                # A single brush stroke
+                opLabelArrays.Input[0][100:101, 10:20, 10:20, 0:1] = numpy.ones((1,10,10,1), dtype=numpy.uint8)
+                with Timer() as timer:
+                    slotSerializer.serialize( label_group )
+                print "Incremental save: {:.2f} seconds".format( timer.seconds() )
+
+                slotSerializer.setDirty()
+                with Timer() as timer:
+                    slotSerializer.serialize( label_group )
+                print "Full save: {:.2f} seconds".format( timer.seconds() )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,107 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.roi import getIntersectingBlocks, roiFromShape
+from ilastik.workflows.carving.opPreprocessing import OpSimpleWatershed, OpNormalize255
+
+def basinVolume(shape, nseeds):
+    '''
+    A boundary map with one basin around each of nseeds random points.
+    '''
+    seeds = numpy.random.rand(nseeds, 3) * shape
+    coords = numpy.indices(shape).reshape(3, -1).T
+    dist = numpy.sqrt( ((coords[:, None, :] - seeds[None, :, :])**2).sum(-1) )
+    dist.sort(axis=1)
+    # Low inside the basins, high where the two nearest seeds are about equally far
+    volume = 255 * numpy.exp( -(dist[:, 1] - dist[:, 0]) / 2.0 )
+    volume = volume.reshape(shape).astype(numpy.float32)
+    volume = volume[numpy.newaxis, ..., numpy.newaxis].view(vigra.VigraArray)
+    volume.axistags = vigra.defaultAxistags('txyzc')
+    return volume
+
+class TestOpSimpleWatershed(object):
+    def setUp(self):
+        numpy.random.seed(0)
+        self.volume = basinVolume((40, 35, 30), 20)
+        self.op = OpSimpleWatershed(graph=Graph())
+        self.op.Input.setValue(self.volume)
+
+    def testSingleBlock(self):
+        # A volume that fits into a single block gives exactly the plain watershed.
+        labels = self.op.Output[:].wait()
+        expected = vigra.analysis.watersheds(self.volume[0,...,0].astype(numpy.uint8))[0]
+        assert (labels[0,...,0] == expected).all()
+
+    def testBlocks(self):
+        self.op.BLOCK_SHAPE = (10, 10, 10)
+        self.op.HALO = 4
+        labels = self.op.Output[:].wait()[0,...,0]
+
+        # The labels are consecutive
+        assert (numpy.unique(labels) == numpy.arange(1, labels.max() + 1)).all()
+
+        # Supervoxels are not split at faces where both blocks agree
+        shape = numpy.array(labels.shape)
+        blockshape = numpy.array(self.op.BLOCK_SHAPE)
+        blocks = {}
+        blockLabels = numpy.zeros(labels.shape, dtype=numpy.uint32)
+        for block_start in getIntersectingBlocks( blockshape, roiFromShape(shape) ):
+            self.op._watershedBlock( shape, blockshape, tuple(block_start), blockLabels, blocks )
+
+        nagree = 0
+        for block_start, (slicing, _, faces) in blocks.items():
+            for axis in range(3):
+                neighbor = list(block_start)
+                neighbor[axis] += blockshape[axis]
+                neighbor = tuple(neighbor)
+                if neighbor not in blocks:
+                    continue
+                agree = faces[(axis, 'upper')][1] & blocks[neighbor][2][(axis, 'lower')][1]
+                upper = numpy.take( labels[slicing], -1, axis=axis )
+                lower = numpy.take( labels[blocks[neighbor][0]], 0, axis=axis )
+                assert (upper[agree] == lower[agree]).all()
+                nagree += agree.sum()
+        assert nagree > 0
+        assert labels.max() < sum( n for _, n, _ in blocks.values() )
+
+class TestOpNormalize255(object):
+    def testBlocks(self):
+        numpy.random.seed(0)
+        volume = basinVolume((40, 35, 30), 20)
+        op = OpNormalize255(graph=Graph())
+        op.BLOCK_SHAPE = (16, 16, 16)
+        op.Input.setValue(volume)
+
+        # Every request is normalized with the range of the whole volume
+        expected = (volume - volume.min()) * 255.0 / (volume.max() - volume.min())
+        normalized = op.Output[:, 5:20, 10:30, 3:8, :].wait()
+        numpy.testing.assert_allclose( normalized, expected[:, 5:20, 10:30, 3:8, :], rtol=1e-5, atol=1e-3 )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
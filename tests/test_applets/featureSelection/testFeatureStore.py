@@ -0,0 +1,88 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from ilastik.applets.featureSelection.featureStore import FeatureStore
+
+class TestFeatureStore(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = [ numpy.random.random((20,30,40)).astype(numpy.float32) for _ in range(3) ]
+        self.paths = []
+        for i, (data, chunks) in enumerate(zip(self.data, [None, (10,10,10), None])):
+            path = os.path.join(self.tmpdir, 'feature{}.h5'.format(i))
+            with h5py.File(path, 'w') as f:
+                if chunks is None:
+                    f.create_dataset('data', data=data)
+                else:
+                    f.create_dataset('data', data=data, chunks=chunks, compression='gzip')
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        store = FeatureStore(self.paths)
+        try:
+            assert store.shape == (20,30,40)
+            assert len(store) == 3
+            # The contiguous datasets are memory-mapped, the compressed one is not.
+            assert isinstance(store._sources[0], numpy.memmap)
+            assert isinstance(store._sources[1], h5py.Dataset)
+
+            key = (slice(2,12), slice(5,30), slice(0,17))
+            result = numpy.zeros((10,25,17,2), dtype=numpy.float32)
+            store.read(key, [2,1], result)
+            assert (result[...,0] == self.data[2][key]).all()
+            assert (result[...,1] == self.data[1][key]).all()
+
+            # Channels of a multi-channel result are not contiguous,
+            # so the h5py dataset is read through a contiguous buffer.
+            reads = []
+            dataset = store._sources[1]
+            read_direct = dataset.read_direct
+            def recording_read_direct(dest, source_sel=None):
+                reads.append( dest.flags.c_contiguous )
+                read_direct(dest, source_sel=source_sel)
+            dataset.read_direct = recording_read_direct
+            result[:] = 0
+            store.read(key, [0,1], result)
+            assert reads == [True]
+            assert (result[...,0] == self.data[0][key]).all()
+            assert (result[...,1] == self.data[1][key]).all()
+
+            channel = numpy.zeros((10,25,17), dtype=numpy.float32)
+            store.readChannel(1, key, channel)
+            assert (channel == self.data[1][key]).all()
+        finally:
+            store.close()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
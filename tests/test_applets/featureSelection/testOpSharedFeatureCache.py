@@ -0,0 +1,101 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from ilastik.applets.featureSelection.opSharedFeatureCache import OpSharedFeatureCache, SharedBlockCache
+
+class OpCountingPiper(Operator):
+    """Passes its input through and counts the requested pixels."""
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super( OpCountingPiper, self ).__init__( *args, **kwargs )
+        self.requested_pixels = 0
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        self.requested_pixels += numpy.prod(result.shape)
+        self.Input(roi.start, roi.stop).writeInto(result).wait()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
+class TestOpSharedFeatureCache(object):
+    def setUp(self):
+        self.data = vigra.taggedView( numpy.random.random((1,200,150,1,3)).astype(numpy.float32), 'txyzc' )
+        self.graph = Graph()
+        self.cache = SharedBlockCache(max_bytes=100*1e6)
+
+    def _makePipeline(self, key):
+        opPiper = OpCountingPiper(graph=self.graph)
+        opPiper.Input.setValue(self.data)
+        opCache = OpSharedFeatureCache(graph=self.graph)
+        opCache._cache = self.cache
+        opCache.Input.connect(opPiper.Output)
+        if key is not None:
+            opCache.CacheKey.setValue(key)
+        return opPiper, opCache
+
+    def test_shared(self):
+        opPiper1, opCache1 = self._makePipeline('dataset')
+        opPiper2, opCache2 = self._makePipeline('dataset')
+
+        result1 = opCache1.Output[:, 10:150, 20:100, :, 1:2].wait()
+        assert (result1 == self.data[:, 10:150, 20:100, :, 1:2]).all()
+        assert opPiper1.requested_pixels > 0
+
+        # Overlapping request from another operator with the same key: no recomputation
+        result2 = opCache2.Output[:, 50:120, 30:90, :, :].wait()
+        assert (result2 == self.data[:, 50:120, 30:90, :, :]).all()
+        assert opPiper2.requested_pixels == 0
+
+    def test_different_keys(self):
+        opPiper1, opCache1 = self._makePipeline('dataset1')
+        opPiper2, opCache2 = self._makePipeline('dataset2')
+        opCache1.Output[:].wait()
+        opCache2.Output[:].wait()
+        assert opPiper2.requested_pixels == self.data.size
+
+    def test_memory_budget(self):
+        self.cache = SharedBlockCache(max_bytes=200*1e3)
+        opPiper, opCache = self._makePipeline('dataset')
+        result = opCache.Output[:].wait()
+        assert (result == self.data).all()
+        assert self.cache.used_bytes <= 200*1e3
+
+    def test_no_key(self):
+        opPiper, opCache = self._makePipeline(None)
+        result = opCache.Output[:, 0:10, 0:10].wait()
+        assert (result == self.data[:, 0:10, 0:10]).all()
+        assert self.cache.used_bytes == 0
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -85,6 +85,53 @@ class TestOpRelabelSegmentation(object):
         assert (np.all(img[1, 10:20, 10:20, 10:20, 0] == 60))
         assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 70))
 
+    def testCachedLut(self):
+        segimg = segImage()
+        map_ = {0 : np.array([10, 20]), # object 2 is missing from the map
+                1 : np.array([40, 50, 60, 70])}
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue(map_)
+        self.op.Features._setReady() # hack because we do not use features
+        img = self.op.Output[:].wait()
+        assert (np.all(img[0, 20:25, 20:25, 20:25, 0] == 0))
+        assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 70))
+
+        # Changing the map in place must be noticed once the map is marked dirty
+        map_[1][3] = 80
+        self.op.ObjectMap.setDirty([1])
+        img = self.op.Output[:].wait()
+        assert (np.all(img[0,  0:10,  0:10,  0:10, 0] == 20))
+        assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 80))
+
+
+class TestOpRelabelSegmentationBenchmark(object):
+    """Render many viewer tiles of a large segmentation."""
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        import nose
+        raise nose.SkipTest
+
+    def test(self):
+        from lazyflow.utility.timer import Timer
+        nobjects = 100000
+        segimg = np.random.randint(0, nobjects, (1, 1000, 1000, 100, 1)).astype(np.uint32)
+        segimg = vigra.taggedView(segimg, 'txyzc')
+        map_ = {0 : np.random.random(nobjects).astype(np.float32)}
+
+        op = OpRelabelSegmentation(graph=Graph())
+        op.Image.setValue(segimg)
+        op.ObjectMap.setValue(map_)
+        op.Features._setReady() # hack because we do not use features
+
+        with Timer() as timer:
+            for x in range(0, 1000, 256):
+                for y in range(0, 1000, 256):
+                    op.Output[0:1, x:x+256, y:y+256, 50:51, :].wait()
+        print "Rendered tiles in {:.3f} seconds".format( timer.seconds() )
+
 class TestOpObjectTrain(unittest.TestCase):
     
     nRandomForests = 1
@@ -236,9 +283,115 @@ class TestOpObjectPredict(unittest.TestCase):
         
         self.assertTrue( np.all(probChannel0Time01[0]==probs[0][:, 0]) )
         self.assertTrue( np.all(probChannel0Time01[1]==probs[1][:, 0]) )
+
+    def test_concurrent(self):
+        ###
+        # concurrent requests must predict each time step only once
+        ###
+        from lazyflow.request import Request, RequestPool
+        predicted = []
+        predictTimestep = self.op._predictTimestep
+        def countingPredictTimestep(t, *args):
+            predicted.append(t)
+            return predictTimestep(t, *args)
+        self.op._predictTimestep = countingPredictTimestep
+
+        results = []
+        pool = RequestPool()
+        for times in [[0], [1], [0, 1]] * 5:
+            req = self.op.Predictions(times)
+            req.notify_finished( results.append )
+            pool.add(req)
+        pool.wait()
+
+        self.assertEqual( sorted(predicted), [0, 1] )
+        for preds in results:
+            if 0 in preds:
+                self.assertTrue(np.all(preds[0] == np.array([0, 1, 2])))
+            if 1 in preds:
+                self.assertTrue(np.all(preds[1] == np.array([0, 1, 1, 2])))
+
+        # After the classifier changes, everything is predicted again.
+        self.op.Classifier.setDirty()
+        self.op.Predictions([0, 1]).wait()
+        self.assertEqual( sorted(predicted), [0, 0, 1, 1] )
+
+    def test_restored_probabilities(self):
+        ###
+        # probabilities restored from the project file still come with bad objects
+        ###
+        probs = self.op.Probabilities([0, 1]).wait()
+        badObjects = self.op.BadObjects([0, 1]).wait()
+
+        self.op.InputProbabilities.setValue(probs)
+        self.op._predictTimestep = None # Nothing must be predicted again
+        restoredProbs = self.op.Probabilities([0, 1]).wait()
+        restoredBadObjects = self.op.BadObjects([0, 1]).wait()
+        for t in [0, 1]:
+            self.assertTrue( np.all(restoredProbs[t] == probs[t]) )
+            self.assertIsNotNone( restoredBadObjects[t] )
+            self.assertTrue( np.all(restoredBadObjects[t] == badObjects[t]) )
         
 
  
+class TestExportTable(unittest.TestCase):
+    def setUp(self):
+        # The first time step has no objects
+        segimg = segImage()
+        segimg[0] = 0
+        labels = {0 : np.array([0]),
+                  1 : np.array([0, 1, 1, 2])}
+
+        rawimg = np.indices(segimg.shape).sum(0).astype(np.float32)
+        rawimg = rawimg.view(vigra.VigraArray)
+        rawimg.axistags = vigra.defaultAxistags('txyzc')
+
+        g = Graph()
+
+        features = {"Standard Object Features": {"Count":{}}}
+
+        self.featsop = OpRegionFeatures(graph=g)
+        self.featsop.LabelVolume.setValue(segimg)
+        self.featsop.RawVolume.setValue( rawimg )
+        self.featsop.Features.setValue(features)
+
+        self._opRegFeatsAdaptOutput = OpAdaptTimeListRoi(graph=g)
+        self._opRegFeatsAdaptOutput.Input.connect(self.featsop.Output)
+
+        self.trainop = OpObjectTrain(graph=g)
+        self.trainop.Features.resize(1)
+        self.trainop.Features[0].connect(self._opRegFeatsAdaptOutput.Output)
+        self.trainop.SelectedFeatures.setValue(features)
+        self.trainop.LabelsCount.setValue(2)
+        self.trainop.Labels.resize(1)
+        self.trainop.Labels.setValues([labels])
+        self.trainop.FixClassifier.setValue(False)
+        self.trainop.ForestCount.setValue(1)
+
+        self.op = OpObjectPredict(graph=g)
+        self.op.Classifier.connect(self.trainop.Classifier)
+        self.op.Features.connect(self._opRegFeatsAdaptOutput.Output)
+        self.op.SelectedFeatures.setValue(features)
+        self.op.LabelsCount.connect( self.trainop.LabelsCount )
+
+    def testEmptyFirstFrame(self):
+        layout = self.op.exportTableLayout()
+        tables = [self.op.createExportTable([t], layout) for t in (0, 1)]
+
+        # Both time steps have the full layout, including predictions and probabilities
+        for table in tables:
+            self.assertEqual( table.dtype, layout[0] )
+        for name in ["Prediction", "Probability of class 0", "Probability of class 1"]:
+            self.assertTrue( name in layout[0].names )
+
+        self.assertTrue( np.all(tables[1]["Prediction"] == [0, 1, 1, 2]) )
+        self.assertTrue( np.all(tables[1]["Time"] == 1) )
+
+        # The table of all time steps is the concatenation of the single ones
+        table = self.op.createExportTable([])
+        self.assertEqual( table.dtype, layout[0] )
+        self.assertTrue( np.all(table == np.concatenate(tables)) )
+
 class TestFeatureSelection(unittest.TestCase):
     def setUp(self):
         segimg = segImage()
@@ -426,6 +579,44 @@ class TestFullOperator(unittest.TestCase):
         print table["Default features, RegionCenter_ch_1"]
         print table["Prediction"]
         
+    def _moveSegmentation(self):
+        # Move all objects by one pixel along x
+        segimg = segImage()
+        segimg[:, 1:] = segimg[:, :-1].copy()
+        segimg[:, 0] = 0
+        binimg = (segimg>0).astype(np.uint8)
+        self.extrOp.BinaryImage.setValue(binimg)
+        self.classOp.BinaryImages.setValues([binimg])
+        self.classOp.SegmentationImages.setValues([segimg])
+
+    def testTransferLabels(self):
+        # Labeling requests the objects of all labeled time steps
+        self.classOp.assignObjectLabel(0, (0, 2, 2, 2, 0), 1)
+        for t in (0, 1):
+            self.classOp._labelBBoxes[0][t].wait()
+
+        self._moveSegmentation()
+        labels, old_labels_lost, new_labels_lost = self.classOp.triggerTransferLabels(0)
+        assert list(labels[0]) == [0, 1, 2]
+        assert list(labels[1]) == [0, 1, 1, 2]
+        assert sum(len(v) for v in old_labels_lost.values()) == 0
+
+    def testTransferUnknownLabels(self):
+        # Labels whose objects are not known (e.g. their computation failed) are reported
+        self.classOp._labelBBoxes[0].clear()
+        self._moveSegmentation()
+        labels, old_labels_lost, new_labels_lost = self.classOp.triggerTransferLabels(0)
+        assert not np.any(labels[0]) and not np.any(labels[1])
+        assert old_labels_lost["unknown"] == [(0, 1), (0, 2), (1, 1), (1, 2), (1, 3)]
+
+    def testTransferDisabled(self):
+        self.classOp.EnableLabelTransfer.setValue(False)
+        self._moveSegmentation()
+        assert self.classOp.triggerTransferLabels(0) is None
+        labels = self.classOp.LabelInputs[0].value
+        assert list(labels[0]) == [0, 1, 2]
+        assert list(labels[1]) == [0, 1, 1, 2]
+
     def test_unfavorable_conditions(self):
         #TODO write test with not so nice input
         pass
@@ -52,6 +52,63 @@ class TestTransferLabelsFunction(object):
         newmin4 =  coords_new["Coord<Minimum>"][4]
         newmax4 = coords_new["Coord<Maximum>"][4]
         assert numpy.all(newlost["conflict"]==(newmin4+(newmax4-newmin4)/2.))
+
+
+    def testManyObjects(self):
+        # Shift a segmentation with many objects by one pixel: every label must survive.
+        numpy.random.seed(0)
+        n = 5000
+        mins = numpy.random.randint(0, 1000, (n, 3))
+        mins[:, 2] = numpy.arange(n) * 20 # no overlaps within a segmentation
+        maxs = mins + numpy.random.randint(2, 10, (n, 3))
+        coords_old = { "Coord<Minimum>" : mins, "Coord<Maximum>" : maxs }
+        coords_new = { "Coord<Minimum>" : mins + 1, "Coord<Maximum>" : maxs + 1 }
+        labels = numpy.random.randint(0, 3, (n,))
+        labels[0] = 0
+
+        newlabels, oldlost, newlost = OpObjectClassification.transferLabels(labels, coords_old, coords_new, None)
+        assert numpy.all(newlabels == labels)
+        assert len(oldlost["full"]) == 0
+        assert len(oldlost["partial"]) == 0
+        assert len(newlost["conflict"]) == 0
+
+
+class TestOverlappingBBoxes(object):
+    def test(self):
+        numpy.random.seed(0)
+        for ndim in (2, 3):
+            mins_a = numpy.random.randint(0, 100, (200, ndim))
+            maxs_a = mins_a + numpy.random.randint(0, 30, (200, ndim))
+            mins_b = numpy.random.randint(0, 100, (300, ndim))
+            maxs_b = mins_b + numpy.random.randint(0, 10, (300, ndim))
+
+            index_a, index_b, overlap = OpObjectClassification.overlappingBBoxes(mins_a, maxs_a, mins_b, maxs_b)
+            found = dict( ((i, j), o) for i, j, o in zip(index_a, index_b, overlap) )
+
+            # Compare with all pairs
+            rad_a = 0.5*(maxs_a - mins_a)
+            rad_b = 0.5*(maxs_b - mins_b)
+            over = rad_a[:, None] + rad_b[None, :] - numpy.abs( (mins_a + rad_a)[:, None] - (mins_b + rad_b)[None, :] )
+            expected = numpy.all(over > 0, axis=2)
+            assert len(found) == expected.sum()
+            for i, j in zip(*numpy.nonzero(expected)):
+                assert found[(i, j)] == numpy.prod(over[i, j])
+
+    def testLargeBox(self):
+        # One box covering everything and many tiny boxes: the grid cells must not be
+        #  sized by the tiny boxes alone (that would enumerate ~1e9 cells for the large box).
+        numpy.random.seed(0)
+        mins_b = numpy.random.randint(0, 1000, (10000, 3))
+        mins_b[:2] = [[10, 10, 10], [11, 11, 10]]
+        maxs_b = mins_b + 1
+        mins_a = numpy.array([[0, 0, 0], [10, 10, 10]])
+        maxs_a = numpy.array([[1000, 1000, 1000], [12, 12, 12]])
+
+        index_a, index_b, overlap = OpObjectClassification.overlappingBBoxes(mins_a, maxs_a, mins_b, maxs_b)
+        assert numpy.all( numpy.sort(index_b[index_a == 0]) == numpy.arange(10000) )
+        expected = numpy.flatnonzero( ((mins_b >= 10) & (maxs_b <= 12)).all(axis=1) )
+        assert len(expected) > 0
+        assert numpy.all( numpy.sort(index_b[index_a == 1]) == expected )
     
     
 if __name__ == "__main__":
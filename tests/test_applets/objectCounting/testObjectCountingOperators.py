@@ -28,7 +28,7 @@ ilastik.ilastik_logging.default_config.init()
 import unittest
 import numpy as np
 import vigra
-from lazyflow.graph import Graph
+from lazyflow.graph import Graph, Operator, OutputSlot
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
@@ -38,6 +38,8 @@ from ilastik.applets.counting.opCounting import \
     OpPredictionPipelineNoCache,OpPredictionPipeline
 
 from ilastik.applets.counting.countingOperators import OpTrainCounter, OpPredictCounter, OpLabelPreviewer
+from ilastik.applets.counting.countingsvr import SVR
+from ilastik.applets.counting.sparseTrainingSet import sparseTrainingSet
 
  
 # def segImage():
@@ -89,6 +91,177 @@ class TestOpMean(object):
         #FIXME: why is it this the region ?
         np.testing.assert_allclose(np.mean(rimg.view(np.ndarray),axis=2),mean.view(np.ndarray)[...,0:1,0])
 
+class TestOpVolumeOperator(object):
+    def setUp(self):
+        g = Graph()
+        self.op = OpVolumeOperator(graph=g)
+        self.calls = []
+        def countingSum(data):
+            self.calls.append(data.size)
+            return np.sum(data)
+        self.op.Function.setValue(countingSum)
+        self.op.blockShape.setValue(20)
+
+    def test(self):
+        rimg = imageWithRandomNoise()
+        self.op.Input.setValue(rimg)
+        # setupOutputs() tries the Function once
+        self.calls[:] = []
+        total = self.op.Output.value
+        np.testing.assert_allclose(total, rimg.view(np.ndarray).sum())
+        # 1*3*3*3*1 blocks, plus the reduction of the block results
+        assert len(self.calls) == 28
+
+        # Cached
+        self.calls[:] = []
+        self.op.Output.value
+        assert len(self.calls) == 0
+
+    def testDirtyBlocks(self):
+        rimg = imageWithRandomNoise()
+        self.op.Input.setValue(rimg)
+        self.op.Output.value
+
+        rimg[1, 5:25, 0:10, 0:10, 0] += 1
+        self.op.Input.setDirty((slice(1,2), slice(5,25), slice(0,10), slice(0,10), slice(None)))
+        self.calls[:] = []
+        total = self.op.Output.value
+        np.testing.assert_allclose(total, rimg.view(np.ndarray).sum())
+        # Only the two blocks along x are recomputed
+        assert len(self.calls) == 3
+
+    def testResetDuringExecute(self):
+        rimg = imageWithRandomNoise()
+        self.op.Input.setValue(rimg)
+
+        def resettingSum(data):
+            # All blocks are discarded (e.g. by a new Function) while the first round is computed
+            if not self.calls:
+                self.op._resetBlocks()
+            self.calls.append(data.size)
+            return np.sum(data)
+        self.op.Function.setValue(resettingSum)
+        self.calls[:] = []
+
+        total = self.op.Output.value
+        np.testing.assert_allclose(total, rimg.view(np.ndarray).sum())
+        # The results of the first round are dropped and computed again
+        assert len(self.calls) == 27 + 28
+
+
+class OpLabelBlocks(Operator):
+    """
+    Provides the label blocks of a 2D label image, split into 30x30 blocks.
+    """
+    NonzeroBlocks = OutputSlot(stype='object')
+
+    def __init__(self, labels, *args, **kwargs):
+        super(OpLabelBlocks, self).__init__(*args, **kwargs)
+        self._labels = labels
+
+    def setupOutputs(self):
+        self.NonzeroBlocks.meta.shape = (1,)
+        self.NonzeroBlocks.meta.dtype = object
+
+    def execute(self, slot, subindex, roi, result):
+        blocks = []
+        for x in range(0, self._labels.shape[0], 30):
+            for y in range(0, self._labels.shape[1], 30):
+                block = [slice(x, x+30), slice(y, y+30), slice(0, 1)]
+                if (self._labels[tuple(block)] != 0).any():
+                    blocks.append(block)
+        result[0] = blocks
+
+    def propagateDirty(self, slot, subindex, roi):
+        pass
+
+class TestOpTrainCounter(object):
+    """
+    Checks the training set that OpTrainCounter assembles from the label
+    blocks.  The regressors are not trained, SVR.fitPrepared() only records
+    its arguments.
+    """
+    def setUp(self):
+        self.fits = []
+        def recordFit(svr, img, dot, tags, boxConstraints = [], numRegressors = 1, trainAll = True):
+            self.fits.append((img.copy(), dot.copy(), list(tags)))
+        self._fitPrepared = SVR.__dict__["fitPrepared"]
+        self._maxBackground = SVR.MAX_BACKGROUND_SAMPLES
+        SVR.fitPrepared = recordFit
+
+        random = np.random.RandomState(0)
+        labels = np.zeros((60, 60, 1), dtype=np.uint8)
+        flat = labels.reshape(-1)
+        flat[random.choice(flat.size, 200, replace=False)] = 2
+        flat[random.choice(flat.size, 20, replace=False)] = 1
+        # A dot next to the block borders, and background annotations next to it
+        labels[29, 30] = 1
+        labels[30, 30] = 2
+        labels[29, 31] = 2
+        self.labels = labels
+
+        # The first feature is the index of the pixel
+        features = np.zeros((60, 60, 2), dtype=np.float32)
+        features[..., 0] = np.arange(60*60).reshape(60, 60)
+        features[..., 1] = random.rand(60, 60)
+
+        g = Graph()
+        self.opBlocks = OpLabelBlocks(labels, graph=g)
+        self.op = OpTrainCounter(graph=g)
+        self.op.Images.resize(1)
+        self.op.Images[0].setValue(vigra.taggedView(features, 'xyc'))
+        self.op.ForegroundLabels.resize(1)
+        self.op.ForegroundLabels[0].setValue(vigra.taggedView(np.where(labels == 2, 0, labels).astype(np.float32), 'xyc'))
+        self.op.BackgroundLabels.resize(1)
+        self.op.BackgroundLabels[0].setValue(vigra.taggedView(labels, 'xyc'))
+        self.op.nonzeroLabelBlocks.resize(1)
+        self.op.nonzeroLabelBlocks[0].connect(self.opBlocks.NonzeroBlocks)
+        self.op.BoxConstraintRois.resize(1)
+        self.op.BoxConstraintValues.resize(1)
+        self.op.UpperBound.setValue(1)
+        self.op.Sigma.setValue(2.5)
+        self.op.fixClassifier.setValue(False)
+
+    def tearDown(self):
+        SVR.fitPrepared = self._fitPrepared
+        SVR.MAX_BACKGROUND_SAMPLES = self._maxBackground
+
+    def train(self):
+        self.op.Classifier[:].wait()
+        assert len(self.fits) == OpTrainCounter.numRegressors
+        img, dot, tags = self.fits[0]
+        assert len(img) == len(dot) == sum(tags)
+        pixels = img[:, 0].astype(np.int64)
+        return pixels[:tags[0]], dot[:tags[0]], pixels[tags[0]:], dot[tags[0]:]
+
+    def testTrainingSet(self):
+        foreground, foregroundDensity, background, backgroundDensity = self.train()
+
+        # The blocks give the same training set as the whole image
+        expectedDensity, expectedMapping, expectedTags = sparseTrainingSet(self.labels[..., 0], 2.5)
+        order = np.argsort(foreground)
+        assert (foreground[order] == expectedMapping[:expectedTags[0]]).all()
+        np.testing.assert_allclose(foregroundDensity[order], expectedDensity[:expectedTags[0]], rtol=1e-4, atol=1e-6)
+
+        # All background annotations are used, with target 0, also next to a dot
+        assert (np.sort(background) == np.flatnonzero(self.labels == 2)).all()
+        assert np.ravel_multi_index((30, 30), (60, 60)) in background
+        assert np.ravel_multi_index((29, 31), (60, 60)) in background
+        assert (backgroundDensity == 0).all()
+
+    def testBackgroundSampling(self):
+        SVR.MAX_BACKGROUND_SAMPLES = 50
+        foreground, foregroundDensity, background, backgroundDensity = self.train()
+        expectedDensity, expectedMapping, expectedTags = sparseTrainingSet(self.labels[..., 0], 2.5)
+        assert len(foreground) == expectedTags[0]
+        assert len(background) == 50
+        assert (self.labels.reshape(-1)[background] == 2).all()
+        assert len(np.unique(background)) == 50
+
+        # The sample is reproducible
+        self.fits[:] = []
+        assert (self.train()[2] == background).all()
+
         
 # class TestOpObjectTrain(unittest.TestCase):
 #     
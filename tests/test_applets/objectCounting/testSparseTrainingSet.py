@@ -0,0 +1,162 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+
+import numpy as np
+import vigra
+
+from ilastik.applets.counting.sparseTrainingSet import sparseTrainingSet, blockTrainingSet, sampleBackground, kernelRadius
+
+def denseTrainingSet(labels, sigma):
+    '''
+    The training set as it was assembled before: smooth the whole dot image.
+    '''
+    dot = labels.astype(np.float32)
+    backgroundIndices = np.where(dot == 2)
+    dot[backgroundIndices] = 0
+    if sigma > 0:
+        dot = vigra.filters.gaussianSmoothing(dot.squeeze(), sigma).reshape(labels.shape)
+    dot[backgroundIndices] = 0
+
+    nindices = np.ravel_multi_index(backgroundIndices, labels.shape)
+    dot = dot.reshape(-1)
+    pindices = np.where(dot > 0.0001)[0]
+    mapping = np.concatenate((pindices, nindices))
+    return dot[mapping], mapping, [len(pindices), len(nindices)]
+
+def randomLabels(shape, ndots, nbackground):
+    labels = np.zeros(shape, dtype=np.uint8)
+    flat = labels.reshape(-1)
+    flat[np.random.choice(flat.size, nbackground, replace=False)] = 2
+    flat[np.random.choice(flat.size, ndots, replace=False)] = 1
+    return labels
+
+class TestSparseTrainingSet(object):
+    def setUp(self):
+        np.random.seed(0)
+
+    def testSameAsDense(self):
+        for shape in [(50, 60), (50, 60, 1), (20, 30, 25)]:
+            for sigma in [0, 1.0, 2.5]:
+                labels = randomLabels(shape, 20, 200)
+                # Dots at the border
+                labels[0, 0] = 1
+                labels[-1, 5] = 1
+
+                density, mapping, tags = sparseTrainingSet(labels, sigma)
+                expectedDensity, expectedMapping, expectedTags = denseTrainingSet(labels, sigma)
+
+                assert tags == expectedTags
+                assert (mapping == expectedMapping).all()
+                np.testing.assert_allclose(density, expectedDensity, rtol=1e-4, atol=1e-6)
+
+    def testNoDots(self):
+        labels = randomLabels((30, 30), 0, 10)
+        density, mapping, tags = sparseTrainingSet(labels, 2.5)
+        assert tags == [0, 10]
+        assert (density == 0).all()
+
+    def testBackgroundSampling(self):
+        labels = randomLabels((100, 100), 10, 1000)
+        density, mapping, tags = sparseTrainingSet(labels, 2.5, maxBackground=100)
+        assert tags[1] == 100
+        background = mapping[tags[0]:]
+        assert (labels.reshape(-1)[background] == 2).all()
+        assert (np.diff(background) > 0).all()
+
+        indices = np.arange(50)
+        assert sampleBackground(indices, None) is indices
+        assert sampleBackground(indices, 50) is indices
+
+        # The sample is reproducible
+        assert (sampleBackground(np.arange(1000), 10) == sampleBackground(np.arange(1000), 10)).all()
+
+    def testBlocks(self):
+        shape = (50, 60)
+        sigma = 2.5
+        labels = randomLabels(shape, 20, 200)
+        labels[0, 0] = 1
+        labels[29, 30] = 1
+        expectedDensity, expectedMapping, expectedTags = sparseTrainingSet(labels, sigma)
+        expected = np.zeros(labels.size)
+        expected[expectedMapping] = expectedDensity
+        isForeground = np.zeros(labels.size, dtype=bool)
+        isForeground[expectedMapping[:expectedTags[0]]] = True
+        expected = expected.reshape(shape)
+        isForeground = isForeground.reshape(shape)
+
+        radius = kernelRadius(sigma)
+        dots = np.where(labels == 2, 0, labels)
+        for start in [(0, 0), (0, 30), (30, 0), (30, 30)]:
+            start = np.array(start)
+            stop = np.minimum(start + 30, shape)
+            haloStart = np.maximum(start - radius, 0)
+            haloStop = np.minimum(stop + radius, shape)
+            block = tuple(slice(a, b) for a, b in zip(start, stop))
+            halo = tuple(slice(a, b) for a, b in zip(haloStart, haloStop))
+
+            density, mapping, tags, _ = blockTrainingSet(dots[halo], labels[block] == 2, sigma,
+                                                      (start - haloStart, stop - haloStart))
+            blockShape = tuple(stop - start)
+            assert (labels[block].reshape(-1)[mapping[tags[0]:]] == 2).all()
+            assert tags[0] == isForeground[block].sum()
+            assert (np.flatnonzero(isForeground[block]) == mapping[:tags[0]]).all()
+            np.testing.assert_allclose(density, expected[block].reshape(-1)[mapping])
+            assert len(mapping) == len(density) == sum(tags)
+            assert (mapping < np.prod(blockShape)).all()
+
+class TestSparseTrainingSetBenchmark(object):
+    """Compare the sparse training set with the dense one on large label images."""
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        import nose
+        raise nose.SkipTest
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test(self):
+        print("")
+        print("Training set assembly with 300 dots and 20000 background pixels:")
+        for size in [512, 1024, 2048, 4096]:
+            labels = randomLabels((size, size), 300, 20000)
+
+            start = time.time()
+            denseTrainingSet(labels, 2.5)
+            dense = time.time() - start
+
+            start = time.time()
+            sparseTrainingSet(labels, 2.5)
+            sparse = time.time() - start
+
+            print("  {0}x{0}: dense {1:.3f}s, sparse {2:.3f}s".format(size, dense, sparse))
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -19,6 +19,7 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 import unittest
+from copy import deepcopy
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
@@ -110,7 +111,19 @@ class TestOpRegionFeatures(object):
 
         feats = opAdapt.Output([0, 1]).wait()
         print "feature length:", len(feats)
-        OpObjectExtraction.createExportTable(feats)
+        table = OpObjectExtraction.createExportTable(feats)
+
+        nobjs = [feats[t][NAME]['Count'].shape[0] for t in (0, 1)]
+        assert table.shape[0] == sum(nobjs)
+        assert (table["Time"] == [0]*nobjs[0] + [1]*nobjs[1]).all()
+        assert (table[NAME + ", Count"][nobjs[0]:] == feats[1][NAME]['Count'][:, 0]).all()
+        for ich in range(3):
+            column = table[NAME + ", RegionCenter_ch_%d" % ich]
+            assert (column[:nobjs[0]] == feats[0][NAME]['RegionCenter'][:, ich]).all()
+
+        # A single time step (e.g. when streaming the export) keeps its time value
+        table1 = OpObjectExtraction.createExportTable({1: feats[1]})
+        assert (table1 == table[nobjs[0]:]).all()
 
 
 class testOpRegionFeaturesAgainstNumpy(object):
@@ -185,6 +198,176 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     assert abs(coord-center_good)<0.01
 
 
+class TestOpRegionFeaturesBlockwise(object):
+    """Blockwise features must equal the features of the whole volume,
+    including for objects that span block boundaries."""
+    features = {
+        NAME : {
+            "Count" : {},
+            "Sum" : {},
+            "Mean" : {},
+            "Variance" : {},
+            "Minimum" : {},
+            "Maximum" : {},
+            "RegionCenter" : {},
+            "Coord<Minimum>" : {},
+            "Coord<Maximum>" : {},
+        }
+    }
+
+    def _computeFeatures(self, blockShape=None):
+        g = Graph()
+        labelop = OpLabelVolume(graph=g)
+        labelop.Input.setValue(binaryImage())
+        op = OpRegionFeatures(graph=g)
+        op.LabelVolume.connect(labelop.Output)
+        op.RawVolume.setValue(rawImage())
+        op.Features.setValue(self.features)
+        if blockShape is not None:
+            op.BlockShape.setValue(blockShape)
+        return op.Output[0:2].wait()
+
+    def test(self):
+        whole = self._computeFeatures()
+        blockwise = self._computeFeatures({'x': 16, 'y': 16, 'z': 7})
+        for t in range(2):
+            for group in (NAME, "Default features"):
+                assert set(whole[t][group].keys()) == set(blockwise[t][group].keys())
+                for key in whole[t][group]:
+                    assert np.allclose(whole[t][group][key], blockwise[t][group][key], rtol=1e-4), \
+                        "Feature {} differs at t={}".format(key, t)
+
+    def test_fallback(self):
+        # Features with a neighborhood can't be computed blockwise
+        self.features = deepcopy(self.features)
+        self.features[NAME]["Mean in neighborhood"] = {"margin" : (5, 5, 1)}
+        whole = self._computeFeatures()
+        blockwise = self._computeFeatures({'x': 16, 'y': 16, 'z': 7})
+        assert np.allclose(whole[0][NAME]["Mean in neighborhood"], blockwise[0][NAME]["Mean in neighborhood"])
+
+
+def manyObjectsImage(n_per_axis):
+    """A single 3d time slice with n_per_axis**2 small, separated objects."""
+    size = 4 * n_per_axis
+    img = np.zeros((1, size, size, 3, 1), dtype=np.float32)
+    for i in range(n_per_axis):
+        for j in range(n_per_axis):
+            img[0, 4*i:4*i+2, 4*j:4*j+2+(i+j)%2, 1, 0] = 1 + (i*n_per_axis + j) % 7
+    img = img.view(vigra.VigraArray)
+    img.axistags = vigra.defaultAxistags('txyzc')
+    return img
+
+
+class TestOpRegionFeaturesLocalBatches(object):
+    """The batched local feature computation must match the serial loop."""
+    features = {
+        NAME : {
+            "Count" : {},
+            "Mean in neighborhood" : {"margin" : (3, 3, 1)},
+            "Sum in neighborhood" : {"margin" : (3, 3, 1)},
+        }
+    }
+
+    def _computeFeatures(self, batch_size):
+        g = Graph()
+        raw = manyObjectsImage(20)
+        labelop = OpLabelVolume(graph=g)
+        labelop.Input.setValue(raw)
+        op = OpRegionFeatures(graph=g)
+        op.LabelVolume.connect(labelop.Output)
+        op.RawVolume.setValue(raw)
+        op.Features.setValue(self.features)
+        op.LOCAL_FEATURES_BATCH_SIZE = batch_size
+        return op.Output[0:1].wait()[0]
+
+    def test(self):
+        serial = self._computeFeatures(10**6)
+        batched = self._computeFeatures(7)
+        assert serial[NAME].keys() == batched[NAME].keys()
+        for key in serial[NAME]:
+            assert serial[NAME][key].shape[0] == 20*20 + 1
+            assert np.allclose(serial[NAME][key], batched[NAME][key], equal_nan=True), \
+                "Feature {} differs".format(key)
+
+
+class TestOpRegionFeaturesLocalBenchmark(object):
+    """Compare the old serial object loop with the batched, parallel local features."""
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        import nose
+        raise nose.SkipTest
+
+    def test(self):
+        from lazyflow.utility.timer import Timer
+        features = { NAME : { "Mean in neighborhood" : {"margin" : (3, 3, 1)} } }
+        for n_per_axis in (25, 50, 100, 200):
+            raw = manyObjectsImage(n_per_axis)
+            labels = vigra.analysis.labelVolumeWithBackground(np.asarray(raw[0, ..., 0] > 0, dtype=np.uint8))
+            labels = vigra.taggedView(labels[..., None], 'xyzc')
+            raw = raw[0].withAxes(*'xyzc')
+
+            op = OpRegionFeatures(graph=Graph())
+            op.Features.setValue(features)
+            # A single batch reproduces the old serial loop over all objects
+            for batch_size in (10**9, OpRegionFeatures.LOCAL_FEATURES_BATCH_SIZE):
+                op.LOCAL_FEATURES_BATCH_SIZE = batch_size
+                with Timer() as timer:
+                    op._extract(raw, labels)
+                print "{} objects, batch size {}: {:.2f} seconds".format(n_per_axis**2, batch_size, timer.seconds())
+
+
+class TestOpObjectCenterImage(object):
+    def setUp(self):
+        g = Graph()
+        self.op = OpObjectExtraction(graph=g)
+        self.op.BinaryImage.setValue(binaryImage())
+        self.op.RawImage.setValue(rawImage())
+        self.op.Features.setValue(FEATURES)
+
+    def test(self):
+        centerImage = self.op.ObjectCenterImage[:].wait()
+        feats = self.op.RegionFeatures([0, 1]).wait()
+        for t in range(2):
+            centers = feats[t]["Default features"]["RegionCenter"][1:].astype(int)
+            assert centerImage[t].sum() == len(centers)
+            for x, y, z in centers:
+                assert centerImage[t, x, y, z, 0] == 1
+
+    def test_subregion(self):
+        full = self.op.ObjectCenterImage[:].wait()
+        part = self.op.ObjectCenterImage[1:2, 10:40, 0:30, 20:50, :].wait()
+        assert (part == full[1:2, 10:40, 0:30, 20:50, :]).all()
+
+
+class TestOpObjectCenterImageBenchmark(object):
+    """Time the rendering of the center image over the number of objects."""
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        import nose
+        raise nose.SkipTest
+
+    def test(self):
+        from lazyflow.utility.timer import Timer
+        from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectCenterImage
+        shape = (1, 1000, 1000, 1, 1)
+        binary = vigra.taggedView(np.zeros(shape, dtype=np.uint8), 'txyzc')
+        for nobj in (10**3, 10**4, 10**5):
+            centers = np.zeros((nobj + 1, 2), dtype=np.float32)
+            centers[1:] = np.random.random((nobj, 2)) * 1000
+            op = OpObjectCenterImage(graph=Graph())
+            op.BinaryImage.setValue(binary)
+            op.RegionCenters.setValue({0 : {"Default features" : {"RegionCenter" : centers}}})
+            with Timer() as timer:
+                op.Output[:, 0:256, 0:256, :, :].wait()
+            print "{} objects: {:.4f} seconds per tile".format(nobj, timer.seconds())
+
+
 if __name__ == '__main__':
     import sys
     import nose
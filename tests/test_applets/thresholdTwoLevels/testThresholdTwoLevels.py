@@ -20,9 +20,11 @@
 ###############################################################################
 import numpy
 import vigra
+import h5py
 np = numpy
 
 from lazyflow.graph import Graph
+from lazyflow.roi import roiToSlice
 from lazyflow.operators import Op5ifyer, OpArrayPiper
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels \
     import OpThresholdTwoLevels, OpSelectLabels
@@ -621,6 +623,89 @@ class TestThresholdTwoLevels(Generator2):
         print(output2[idx])
         numpy.testing.assert_array_almost_equal(ref, output)
 
+    def testBlockwise(self):
+        data = self.data.withAxes(*'txyzc')
+
+        def threshold(blockshape):
+            oper = OpThresholdTwoLevels5d(graph=Graph())
+            if blockshape is not None:
+                oper._opHysteresis.BLOCK_SHAPE = blockshape
+            oper.InputImage.setValue(data)
+            oper.MinSize.setValue(self.minSize)
+            oper.MaxSize.setValue(self.maxSize)
+            oper.HighThreshold.setValue(self.highThreshold)
+            oper.LowThreshold.setValue(self.lowThreshold)
+            return oper
+
+        whole = threshold(None).Output[:].wait().squeeze()
+
+        # Objects cross the block faces
+        oper = threshold((7, 9, 8))
+        output = oper.Output[:].wait().squeeze()
+        numpy.testing.assert_array_equal(output > 0, whole > 0)
+        numpy.testing.assert_array_equal(output > 0,
+                                         self.thresholdTwoLevels(data[0, ..., 0]) > 0)
+        # Same objects, possibly with different label values
+        pairs = set(zip(output.flat, whole.flat))
+        assert len(pairs) == len(numpy.unique(output)) == len(numpy.unique(whole))
+
+        # Requests that don't cover the whole volume are consistent
+        part = oper.Output[:, 3:40, 10:30, 5:25, :].wait().squeeze()
+        numpy.testing.assert_array_equal(part, output[3:40, 10:30, 5:25])
+
+        # The cache doesn't hold the whole volume in one block
+        assert oper._opCache.BlockShape.value == (1, 7, 9, 8, 1)
+
+    def testLoadOtherBlockShape(self):
+        # Projects store the cached output in the blocks of the cache that saved it
+        # (see ThresholdTwoLevelsSerializer).  Load them into caches with other blocks.
+        def threshold():
+            oper = OpThresholdTwoLevels(graph=Graph())
+            oper.InputImage.setValue(self.data5d)
+            oper.MinSize.setValue(self.minSize)
+            oper.MaxSize.setValue(self.maxSize)
+            oper.HighThreshold.setValue(self.highThreshold)
+            oper.LowThreshold.setValue(self.lowThreshold)
+            oper.SmootherSigma.setValue(self.sigma)
+            oper.CurOperator.setValue(1)
+            return oper
+
+        def save(oper, f):
+            # As SerialHdf5BlockSlot does it
+            group = f.create_group(str(len(f)))
+            for roi in oper.CleanBlocks.value:
+                req = oper.OutputHdf5(*roi)
+                req.writeInto(group)
+                req.wait()
+            return group
+
+        def load(oper, group):
+            for blockRoiString, blockDataset in group.items():
+                oper.InputHdf5[roiToSlice(*eval(blockRoiString))] = blockDataset
+
+        f = h5py.File("testLoadOtherBlockShape.h5", driver="core", backing_store=False)
+
+        # Saved with whole-volume blocks (the default), loaded with smaller blocks
+        oper = threshold()
+        expected = oper.CachedOutput[:].wait()
+        wholeVolumeBlocks = save(oper, f)
+        assert len(wholeVolumeBlocks) == self.data5d.shape[0]
+
+        oper = threshold()
+        oper._cache._cache.BlockShape.setValue((10, 10, 10, 1, 1))
+        load(oper, wholeVolumeBlocks)
+        assert len(oper.CleanBlocks.value) == 5*6*6*self.data5d.shape[0]
+        numpy.testing.assert_array_equal(oper.CachedOutput[:].wait(), expected)
+        smallBlocks = save(oper, f)
+
+        # Saved with smaller blocks, loaded with whole-volume blocks:
+        #  The saved blocks don't fill a block, so the output is computed again.
+        oper = threshold()
+        load(oper, smallBlocks)
+        assert len(oper.CleanBlocks.value) == 0
+        numpy.testing.assert_array_equal(oper.CachedOutput[:].wait(), expected)
+        f.close()
+
     def testPropagateDirty(self):
         g = Graph()
         oper = OpThresholdTwoLevels(graph=g)
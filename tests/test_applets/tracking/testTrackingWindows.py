@@ -0,0 +1,112 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from ilastik.applets.tracking.conservation.opConservationTracking import OpConservationTracking
+from ilastik.applets.tracking.base.trackingUtilities import merge_window_events, find_window_seam, stitch_window_seam
+
+def moves(*pairs):
+    # energies are irrelevant here
+    return np.asarray([(a, b, 1.0) for a, b in pairs])
+
+class TestTrackingWindows(object):
+    def testWindows(self):
+        windows = OpConservationTracking._trackingWindows(100, 40, 10)
+        assert windows == [(0, 40, 35), (30, 70, 65), (60, 100, 99)]
+
+        # every frame is covered and the default seams lie in both windows
+        for (start, stop, last_key), (next_start, next_stop, _) in zip(windows, windows[1:]):
+            assert next_start <= last_key < stop
+            assert stop - next_start == 10
+        assert windows[-1][1] == 100
+
+    def testSingleWindow(self):
+        assert OpConservationTracking._trackingWindows(30, 40, 10) == [(0, 30, 29)]
+        assert OpConservationTracking._trackingWindows(40, 40, 10) == [(0, 40, 39)]
+
+    def testMinimalOverlap(self):
+        windows = OpConservationTracking._trackingWindows(10, 4, 1)
+        assert windows == [(0, 4, 3), (3, 7, 6), (6, 10, 9)]
+
+class TestMergeWindowEvents(object):
+    def testMerge(self):
+        events = {"0": {}, "1": {"mov": moves((1, 1))}, "2": {"mov": moves((1, 2))}}
+        window_events = {"0": {}, "1": {"mov": moves((2, 3))}, "2": {"mov": moves((3, 3))}}
+        merge_window_events(events, window_events, 1, 2, 3)
+
+        assert sorted(events.keys()) == ["0", "1", "2", "3"]
+        assert (events["1"]["mov"] == moves((1, 1))).all()
+        assert (events["2"]["mov"] == moves((2, 3))).all()
+        assert (events["3"]["mov"] == moves((3, 3))).all()
+
+    def testMultiMoveShifted(self):
+        multi = np.asarray([(4, 5, 1, 1.0), (6, 7, -1, 1.0)])
+        events = merge_window_events({}, {"2": {"multiMove": multi}}, 10, 0, 20)
+        assert (events["12"]["multiMove"][:, 2] == [11, -1]).all()
+        # the window's own events are left alone
+        assert (multi[:, 2] == [1, -1]).all()
+
+class TestWindowSeam(object):
+    def setUp(self):
+        # Two tracks 1 -> 1 -> 1 -> 1 and 2 -> 2 (-> 3 in the first window)
+        self.events = {"0": {"app": np.asarray([(1, 1.0), (2, 1.0)])},
+                       "1": {"mov": moves((1, 1), (2, 2))},
+                       "2": {"mov": moves((1, 1), (2, 3))},
+                       "3": {"mov": moves((1, 1), (3, 2))}}
+        # The second window starts at frame 1 and only agrees in frame 3
+        self.window_events = {"0": {},
+                              "1": {"mov": moves((1, 1)), "app": np.asarray([(3, 1.0)])},
+                              "2": {"mov": moves((1, 1), (3, 2))},
+                              "3": {"mov": moves((1, 1), (2, 2))}}
+
+    def testFindSeam(self):
+        assert find_window_seam(self.events, self.window_events, 1, [2, 3]) == 3
+        assert find_window_seam(self.events, self.window_events, 1, [2]) is None
+        # energies don't matter
+        self.window_events["2"]["mov"][:, 2] = 5.0
+        assert find_window_seam(self.events, self.window_events, 1, [3, 2]) == 3
+
+    def testStitch(self):
+        merge_window_events(self.events, self.window_events, 1, 3, 4)
+        assert stitch_window_seam(self.events, 2) == 0
+
+        # a move out of an object that isn't tracked before the seam becomes an appearance
+        events = dict(self.events)
+        events["3"] = {"mov": moves((1, 1), (5, 2))}
+        assert stitch_window_seam(events, 2) == 1
+        assert (events["3"]["mov"] == moves((1, 1))).all()
+        assert (events["3"]["app"] == [(2, 1.0)]).all()
+
+    def testStitchDivision(self):
+        events = {"1": {"app": np.asarray([(1, 1.0)])},
+                  "2": {"div": np.asarray([(1, 2, 3, 1.0), (4, 5, 6, 1.0)])}}
+        assert stitch_window_seam(events, 1) == 1
+        assert (events["2"]["div"] == [(1, 2, 3, 1.0)]).all()
+        assert (events["2"]["app"] == [(5, 1.0), (6, 1.0)]).all()
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
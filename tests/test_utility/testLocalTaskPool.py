@@ -0,0 +1,103 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+from ilastik.clusterOps import LocalTaskPool, OpClusterize
+
+class LockedFileset(object):
+    """Stand-in for a BlockwiseFileset whose blocks are locked (and then written) for a number of polls."""
+    def __init__(self, polls):
+        self.polls = polls
+
+    def getBlockStatus(self, blockStart):
+        if self.polls > 0:
+            return BlockwiseFileset.BLOCK_NOT_AVAILABLE
+        return BlockwiseFileset.BLOCK_AVAILABLE
+
+    def isBlockLocked(self, blockStart):
+        self.polls -= 1
+        return self.polls >= 0
+
+class TestLocalTaskPool(object):
+    def setUp(self):
+        self.workingDirectory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workingDirectory)
+
+    def _taskInfos(self, commands):
+        taskInfos = {}
+        for i, command in enumerate(commands):
+            taskInfo = OpClusterize.TaskInfo()
+            taskInfo.taskName = "task{}".format(i)
+            taskInfo.command = command
+            taskInfos[((i,), (i+1,))] = taskInfo
+        return taskInfos
+
+    def _isTaskComplete(self, roi):
+        return os.path.exists( os.path.join(self.workingDirectory, "done{}".format(roi[0][0])) )
+
+    def testRun(self):
+        taskInfos = self._taskInfos( ["touch done{}".format(i) for i in range(5)] )
+        progress = []
+        pool = LocalTaskPool( self.workingDirectory, max_workers=2, poll_interval=0.01 )
+        pool.progressSignal.subscribe( progress.append )
+
+        assert pool.run( taskInfos, self._isTaskComplete )
+        assert pool.failedRois == []
+        assert set(pool.taskTimes.keys()) == set(taskInfos.keys())
+        assert all( self._isTaskComplete(roi) for roi in taskInfos )
+        assert progress[-1] == 100
+
+    def testRetries(self):
+        # The task fails on the first attempt and succeeds on the second
+        retry = "if [ -e tried ]; then touch done0; else touch tried; exit 1; fi"
+        taskInfos = self._taskInfos( [retry, "exit 1"] )
+        pool = LocalTaskPool( self.workingDirectory, max_workers=2, max_retries=1, poll_interval=0.01 )
+
+        assert not pool.run( taskInfos, self._isTaskComplete )
+        assert pool.failedRois == [((1,), (2,))]
+        assert len(pool.taskTimes[((0,), (1,))]) == 2
+        assert len(pool.taskTimes[((1,), (2,))]) == 2
+        assert self._isTaskComplete( ((0,), (1,)) )
+
+class TestWaitForLockedBlocks(object):
+    def testWait(self):
+        fileset = LockedFileset(3)
+        OpClusterize._waitForLockedBlocks( fileset, [((0,), (1,))], poll_interval=0.01 )
+        assert fileset.getBlockStatus((0,)) == BlockwiseFileset.BLOCK_AVAILABLE
+
+    def testTimeout(self):
+        fileset = LockedFileset(1000)
+        OpClusterize._waitForLockedBlocks( fileset, [((0,), (1,))], poll_interval=0.01, timeout=0.05 )
+        # Still locked, so the block is not available and the run counts as incomplete
+        assert fileset.getBlockStatus((0,)) != BlockwiseFileset.BLOCK_AVAILABLE
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)